@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import List, Iterator, Tuple, Union, Callable, Iterable
+from typing import List, Iterator, Tuple, Union, Callable, Iterable, Sequence
 
 from _py2tmp.ir0 import ir0, compute_template_dependency_graph, Visitor, is_expr_variadic
 from _py2tmp.utils import clang_format, compute_condensation_in_topological_order
@@ -471,7 +471,7 @@ def toplevel_elem_to_cpp(elem: Union[ir0.StaticAssert, ir0.ConstantDef, ir0.Type
                             writer=writer)
     elif isinstance(elem, ir0.Typedef):
         typedef_to_cpp(elem,
-                       enclosing_function_defn_args=[],
+                       enclosing_function_defn_args=elem.template_args,
                        writer=writer)
     else:
         raise NotImplementedError('Unexpected toplevel element: %s' % str(elem.__class__))
@@ -550,17 +550,69 @@ def compute_template_defns_that_must_come_before(template_defn: ir0.TemplateDefn
             for specialization in specializations
             for template_name in compute_template_defns_that_must_come_before_specialization(specialization)}
 
-def template_defns_to_cpp(template_defns: Iterable[ir0.TemplateDefn], writer: ToplevelWriter):
+def _get_nonlocal_referenced_identifiers(elem: Union[ir0.TemplateDefn, ir0.Expr]):
+    for expr in elem.get_transitive_subexpressions():
+        if isinstance(expr, ir0.AtomicTypeLiteral) and not expr.is_local:
+            yield expr.cpp_type
+
+def _get_toplevel_typedefs_referenced_by_templates(header: ir0.Header):
+    # Alias templates (e.g. the ones introduced by convert_templates_to_alias_templates()) are always emitted together
+    # with the templates, since they're usually referenced by templates.
+    typedef_by_name = {elem.name: elem
+                       for elem in header.toplevel_content
+                       if isinstance(elem, ir0.Typedef)}
+    referenced_typedef_names = set()
+    names_to_process = [identifier
+                        for template_defn in header.template_defns
+                        for identifier in _get_nonlocal_referenced_identifiers(template_defn)
+                        if identifier in typedef_by_name]
+    names_to_process.extend(elem.name
+                            for elem in header.toplevel_content
+                            if isinstance(elem, ir0.Typedef) and elem.template_args)
+    while names_to_process:
+        name = names_to_process.pop()
+        if name not in referenced_typedef_names:
+            referenced_typedef_names.add(name)
+            names_to_process.extend(identifier
+                                    for identifier in _get_nonlocal_referenced_identifiers(typedef_by_name[name].expr)
+                                    if identifier in typedef_by_name)
+    return [elem
+            for elem in header.toplevel_content
+            if isinstance(elem, ir0.Typedef) and elem.name in referenced_typedef_names]
+
+def template_defns_to_cpp(template_defns: Iterable[ir0.TemplateDefn],
+                          writer: ToplevelWriter,
+                          toplevel_typedefs: Sequence[ir0.Typedef] = ()):
+    # `toplevel_typedefs` are emitted together with the templates, each one after the templates that it references and
+    # before the templates that reference it (e.g. the aliases introduced by hoist_common_subexpressions()).
     template_defn_by_template_name = {elem.name: elem
                                       for elem in template_defns}
+    typedef_by_name = {typedef.name: typedef
+                       for typedef in toplevel_typedefs}
 
     template_dependency_graph = compute_template_dependency_graph(template_defns, template_defn_by_template_name)
+    for template_defn in template_defns:
+        for identifier in _get_nonlocal_referenced_identifiers(template_defn):
+            if identifier in typedef_by_name:
+                template_dependency_graph.add_edge(template_defn.name, identifier)
+    for typedef in toplevel_typedefs:
+        template_dependency_graph.add_node(typedef.name)
+        for identifier in _get_nonlocal_referenced_identifiers(typedef.expr):
+            if identifier in template_defn_by_template_name or identifier in typedef_by_name:
+                template_dependency_graph.add_edge(typedef.name, identifier)
+
     if template_dependency_graph.number_of_nodes():
         template_dependency_graph_condensed = compute_condensation_in_topological_order(template_dependency_graph)
     else:
         template_dependency_graph_condensed = []
 
     for connected_component_names in reversed(list(template_dependency_graph_condensed)):
+        if any(name in typedef_by_name for name in connected_component_names):
+            assert len(connected_component_names) == 1, 'Found a toplevel typedef in a dependency loop: ' + ', '.join(connected_component_names)
+            [typedef_name] = connected_component_names
+            toplevel_elem_to_cpp(typedef_by_name[typedef_name], writer)
+            continue
+
         connected_component = sorted([template_defn_by_template_name[template_name]
                                       for template_name in connected_component_names],
                                      key=lambda template_defn: template_defn.name)
@@ -631,10 +683,13 @@ def header_to_cpp(header: ir0.Header, identifier_generator: Iterator[str]):
         #include <tmppy/tmppy.h>
         #include <type_traits>
         ''')
-    template_defns_to_cpp(header.template_defns, writer)
+    toplevel_typedefs_referenced_by_templates = _get_toplevel_typedefs_referenced_by_templates(header)
+    template_defns_to_cpp(header.template_defns, writer, toplevel_typedefs_referenced_by_templates)
 
+    already_emitted_elem_ids = {id(typedef) for typedef in toplevel_typedefs_referenced_by_templates}
     for elem in header.toplevel_content:
-        toplevel_elem_to_cpp(elem, writer)
+        if id(elem) not in already_emitted_elem_ids:
+            toplevel_elem_to_cpp(elem, writer)
     return clang_format(''.join(writer.strings))
 
 def type_expr_to_cpp(expr: ir0.Expr,
@@ -12,7 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from _py2tmp.compiler.testing import main, assert_code_optimizes_to, assert_compilation_fails_with_generic_error
+from _py2tmp.compiler.testing import main, assert_code_optimizes_to, assert_compilation_fails_with_generic_error, \
+    assert_compilation_succeeds
 
 @assert_code_optimizes_to(r'''
 template <typename T> struct CheckIfError { using type = void; };
@@ -794,22 +795,22 @@ def test_optimization_is_in_type_set():
 
 @assert_code_optimizes_to(r'''
 template <typename T> struct CheckIfError { using type = void; };
-template <typename tmppy_internal_tmppy_builtins_x5,
-          bool tmppy_internal_tmppy_builtins_x58>
-struct tmppy_internal_tmppy_builtins_x260;
+template <typename tmppy_internal_tmppy_builtins_x35,
+          bool tmppy_internal_tmppy_builtins_x51>
+struct tmppy_internal_tmppy_builtins_x258;
 // Split that generates value of: (meta)function wrapping the result expression
 // in a list/set comprehension from the function BoolSetEquals
-template <bool... tmppy_internal_tmppy_builtins_x131,
-          bool tmppy_internal_tmppy_builtins_x58>
-struct tmppy_internal_tmppy_builtins_x260<
-    BoolList<tmppy_internal_tmppy_builtins_x131...>,
-    tmppy_internal_tmppy_builtins_x58> {
+template <bool... tmppy_internal_tmppy_builtins_x130,
+          bool tmppy_internal_tmppy_builtins_x51>
+struct tmppy_internal_tmppy_builtins_x258<
+    BoolList<tmppy_internal_tmppy_builtins_x130...>,
+    tmppy_internal_tmppy_builtins_x51> {
   static constexpr bool value =
       !(std::is_same<
-          BoolList<((tmppy_internal_tmppy_builtins_x58) ==
-                    (tmppy_internal_tmppy_builtins_x131))...>,
+          BoolList<((tmppy_internal_tmppy_builtins_x51) ==
+                    (tmppy_internal_tmppy_builtins_x130))...>,
           BoolList<(Select1stBoolBool<
-                    false, tmppy_internal_tmppy_builtins_x131>::value)...>>::
+                    false, tmppy_internal_tmppy_builtins_x130>::value)...>>::
             value);
 };
 template <typename L> struct tmppy_internal_tmppy_builtins_x268;
@@ -817,7 +818,7 @@ template <typename L> struct tmppy_internal_tmppy_builtins_x268;
 template <bool... elems>
 struct tmppy_internal_tmppy_builtins_x268<BoolList<elems...>> {
   template <typename tmppy_internal_tmppy_builtins_x5>
-  using type = BoolList<(tmppy_internal_tmppy_builtins_x260<
+  using type = BoolList<(tmppy_internal_tmppy_builtins_x258<
                          tmppy_internal_tmppy_builtins_x5, elems>::value)...>;
 };
 template <typename tmppy_internal_tmppy_builtins_x7>
@@ -855,24 +856,6 @@ struct tmppy_internal_tmppy_builtins_x276<tmppy_internal_tmppy_builtins_x35,
                                           false> {
   static constexpr bool value = false;
 };
-template <typename tmppy_internal_tmppy_builtins_x35,
-          bool tmppy_internal_tmppy_builtins_x51>
-struct tmppy_internal_tmppy_builtins_x258;
-// Split that generates value of: (meta)function wrapping the result expression
-// in a list/set comprehension from the function BoolSetEquals
-template <bool... tmppy_internal_tmppy_builtins_x130,
-          bool tmppy_internal_tmppy_builtins_x51>
-struct tmppy_internal_tmppy_builtins_x258<
-    BoolList<tmppy_internal_tmppy_builtins_x130...>,
-    tmppy_internal_tmppy_builtins_x51> {
-  static constexpr bool value =
-      !(std::is_same<
-          BoolList<((tmppy_internal_tmppy_builtins_x51) ==
-                    (tmppy_internal_tmppy_builtins_x130))...>,
-          BoolList<(Select1stBoolBool<
-                    false, tmppy_internal_tmppy_builtins_x130>::value)...>>::
-            value);
-};
 template <typename tmppy_internal_test_module_x5,
           typename tmppy_internal_test_module_x6>
 struct tmppy_internal_test_module_x23;
@@ -909,22 +892,22 @@ def test_optimization_bool_set_equals():
 
 @assert_code_optimizes_to(r'''
 template <typename T> struct CheckIfError { using type = void; };
-template <typename tmppy_internal_tmppy_builtins_x5,
-          int64_t tmppy_internal_tmppy_builtins_x58>
-struct tmppy_internal_tmppy_builtins_x286;
+template <typename tmppy_internal_tmppy_builtins_x35,
+          int64_t tmppy_internal_tmppy_builtins_x51>
+struct tmppy_internal_tmppy_builtins_x284;
 // Split that generates value of: (meta)function wrapping the result expression
 // in a list/set comprehension from the function Int64SetEquals
-template <int64_t... tmppy_internal_tmppy_builtins_x148,
-          int64_t tmppy_internal_tmppy_builtins_x58>
-struct tmppy_internal_tmppy_builtins_x286<
-    Int64List<tmppy_internal_tmppy_builtins_x148...>,
-    tmppy_internal_tmppy_builtins_x58> {
+template <int64_t... tmppy_internal_tmppy_builtins_x147,
+          int64_t tmppy_internal_tmppy_builtins_x51>
+struct tmppy_internal_tmppy_builtins_x284<
+    Int64List<tmppy_internal_tmppy_builtins_x147...>,
+    tmppy_internal_tmppy_builtins_x51> {
   static constexpr bool value =
       !(std::is_same<
-          BoolList<((tmppy_internal_tmppy_builtins_x58) ==
-                    (tmppy_internal_tmppy_builtins_x148))...>,
+          BoolList<((tmppy_internal_tmppy_builtins_x51) ==
+                    (tmppy_internal_tmppy_builtins_x147))...>,
           BoolList<(Select1stBoolInt64<
-                    false, tmppy_internal_tmppy_builtins_x148>::value)...>>::
+                    false, tmppy_internal_tmppy_builtins_x147>::value)...>>::
             value);
 };
 template <typename L> struct tmppy_internal_tmppy_builtins_x294;
@@ -932,7 +915,7 @@ template <typename L> struct tmppy_internal_tmppy_builtins_x294;
 template <int64_t... elems>
 struct tmppy_internal_tmppy_builtins_x294<Int64List<elems...>> {
   template <typename tmppy_internal_tmppy_builtins_x5>
-  using type = BoolList<(tmppy_internal_tmppy_builtins_x286<
+  using type = BoolList<(tmppy_internal_tmppy_builtins_x284<
                          tmppy_internal_tmppy_builtins_x5, elems>::value)...>;
 };
 template <typename tmppy_internal_tmppy_builtins_x7>
@@ -970,24 +953,6 @@ struct tmppy_internal_tmppy_builtins_x302<tmppy_internal_tmppy_builtins_x35,
                                           false> {
   static constexpr bool value = false;
 };
-template <typename tmppy_internal_tmppy_builtins_x35,
-          int64_t tmppy_internal_tmppy_builtins_x51>
-struct tmppy_internal_tmppy_builtins_x284;
-// Split that generates value of: (meta)function wrapping the result expression
-// in a list/set comprehension from the function Int64SetEquals
-template <int64_t... tmppy_internal_tmppy_builtins_x147,
-          int64_t tmppy_internal_tmppy_builtins_x51>
-struct tmppy_internal_tmppy_builtins_x284<
-    Int64List<tmppy_internal_tmppy_builtins_x147...>,
-    tmppy_internal_tmppy_builtins_x51> {
-  static constexpr bool value =
-      !(std::is_same<
-          BoolList<((tmppy_internal_tmppy_builtins_x51) ==
-                    (tmppy_internal_tmppy_builtins_x147))...>,
-          BoolList<(Select1stBoolInt64<
-                    false, tmppy_internal_tmppy_builtins_x147>::value)...>>::
-            value);
-};
 template <typename tmppy_internal_test_module_x5,
           typename tmppy_internal_test_module_x6>
 struct tmppy_internal_test_module_x23;
@@ -1024,23 +989,23 @@ def test_optimization_int_set_equals():
 
 @assert_code_optimizes_to(r'''
 template <typename T> struct CheckIfError { using type = void; };
-template <typename tmppy_internal_tmppy_builtins_x5,
-          typename tmppy_internal_tmppy_builtins_x58>
-struct tmppy_internal_tmppy_builtins_x312;
+template <typename tmppy_internal_tmppy_builtins_x35,
+          typename tmppy_internal_tmppy_builtins_x51>
+struct tmppy_internal_tmppy_builtins_x310;
 // Split that generates value of: (meta)function wrapping the result expression
 // in a list/set comprehension from the function TypeSetEquals
-template <typename... tmppy_internal_tmppy_builtins_x165,
-          typename tmppy_internal_tmppy_builtins_x58>
-struct tmppy_internal_tmppy_builtins_x312<
-    List<tmppy_internal_tmppy_builtins_x165...>,
-    tmppy_internal_tmppy_builtins_x58> {
+template <typename... tmppy_internal_tmppy_builtins_x164,
+          typename tmppy_internal_tmppy_builtins_x51>
+struct tmppy_internal_tmppy_builtins_x310<
+    List<tmppy_internal_tmppy_builtins_x164...>,
+    tmppy_internal_tmppy_builtins_x51> {
   static constexpr bool value =
       !(std::is_same<
           BoolList<(
-              std::is_same<tmppy_internal_tmppy_builtins_x58,
-                           tmppy_internal_tmppy_builtins_x165>::value)...>,
+              std::is_same<tmppy_internal_tmppy_builtins_x51,
+                           tmppy_internal_tmppy_builtins_x164>::value)...>,
           BoolList<(Select1stBoolType<
-                    false, tmppy_internal_tmppy_builtins_x165>::value)...>>::
+                    false, tmppy_internal_tmppy_builtins_x164>::value)...>>::
             value);
 };
 template <typename L> struct tmppy_internal_tmppy_builtins_x320;
@@ -1048,7 +1013,7 @@ template <typename L> struct tmppy_internal_tmppy_builtins_x320;
 template <typename... elems>
 struct tmppy_internal_tmppy_builtins_x320<List<elems...>> {
   template <typename tmppy_internal_tmppy_builtins_x5>
-  using type = BoolList<(tmppy_internal_tmppy_builtins_x312<
+  using type = BoolList<(tmppy_internal_tmppy_builtins_x310<
                          tmppy_internal_tmppy_builtins_x5, elems>::value)...>;
 };
 template <typename tmppy_internal_tmppy_builtins_x7>
@@ -1086,25 +1051,6 @@ struct tmppy_internal_tmppy_builtins_x328<tmppy_internal_tmppy_builtins_x35,
                                           false> {
   static constexpr bool value = false;
 };
-template <typename tmppy_internal_tmppy_builtins_x35,
-          typename tmppy_internal_tmppy_builtins_x51>
-struct tmppy_internal_tmppy_builtins_x310;
-// Split that generates value of: (meta)function wrapping the result expression
-// in a list/set comprehension from the function TypeSetEquals
-template <typename... tmppy_internal_tmppy_builtins_x164,
-          typename tmppy_internal_tmppy_builtins_x51>
-struct tmppy_internal_tmppy_builtins_x310<
-    List<tmppy_internal_tmppy_builtins_x164...>,
-    tmppy_internal_tmppy_builtins_x51> {
-  static constexpr bool value =
-      !(std::is_same<
-          BoolList<(
-              std::is_same<tmppy_internal_tmppy_builtins_x51,
-                           tmppy_internal_tmppy_builtins_x164>::value)...>,
-          BoolList<(Select1stBoolType<
-                    false, tmppy_internal_tmppy_builtins_x164>::value)...>>::
-            value);
-};
 template <typename tmppy_internal_test_module_x5,
           typename tmppy_internal_test_module_x6>
 struct tmppy_internal_test_module_x23;
@@ -1139,5 +1085,165 @@ def test_optimization_type_set_equals():
         return x == y
     assert eq({Type('int')}, {Type('float')}) == False
 
+@assert_code_optimizes_to(r'''
+template <typename T> struct CheckIfError { using type = void; };
+using TmppyInternal_0 = std::vector<int, float *>;
+template <typename tmppy_internal_test_module_x5> struct h {
+  using error = void;
+  using type = std::map<tmppy_internal_test_module_x5, TmppyInternal_0>;
+};
+template <typename tmppy_internal_test_module_x5> struct g {
+  using error = void;
+  using type =
+      std::vector<TmppyInternal_0, tmppy_internal_test_module_x5> const;
+};
+template <typename tmppy_internal_test_module_x5> struct f {
+  using error = void;
+  using type = std::vector<tmppy_internal_test_module_x5, TmppyInternal_0> *;
+};
+''', extra_cpp_prelude='''\
+#include <map>
+#include <vector>
+''')
+def test_global_common_subexpression_elimination():
+    from tmppy import Type
+    def f(x: Type):
+        return Type.pointer(Type.template_instantiation('std::vector', [x, Type.template_instantiation('std::vector', [Type('int'), Type.pointer(Type('float'))])]))
+    def g(x: Type):
+        return Type.const(Type.template_instantiation('std::vector', [Type.template_instantiation('std::vector', [Type('int'), Type.pointer(Type('float'))]), x]))
+    def h(x: Type):
+        return Type.template_instantiation('std::map', [x, Type.template_instantiation('std::vector', [Type('int'), Type.pointer(Type('float'))])])
+
+@assert_code_optimizes_to(r'''
+template <typename T> struct CheckIfError { using type = void; };
+template <int64_t tmppy_internal_test_module_x5,
+          bool tmppy_internal_test_module_x18>
+struct tmppy_internal_test_module_x23;
+template <int64_t tmppy_internal_test_module_x5>
+struct tmppy_internal_test_module_x25;
+// Split that generates value of: (meta)function generated for an if-else
+// statement
+template <int64_t tmppy_internal_test_module_x5>
+struct tmppy_internal_test_module_x23<tmppy_internal_test_module_x5, true> {
+  static constexpr int64_t value = 1LL;
+};
+// Split that generates value of: (meta)function generated for an if-else
+// statement
+template <int64_t tmppy_internal_test_module_x5>
+struct tmppy_internal_test_module_x23<tmppy_internal_test_module_x5, false> {
+  static constexpr int64_t value =
+      (tmppy_internal_test_module_x5) *
+      (tmppy_internal_test_module_x25<(tmppy_internal_test_module_x5) +
+                                      (-1LL)>::value);
+};
+// Split that generates value of: fact
+template <int64_t tmppy_internal_test_module_x5>
+struct tmppy_internal_test_module_x25 {
+  static constexpr int64_t value =
+      tmppy_internal_test_module_x23<tmppy_internal_test_module_x5,
+                                     (tmppy_internal_test_module_x5) ==
+                                         (0LL)>::value;
+};
+template <int64_t tmppy_internal_test_module_x5> struct fact {
+  using error = void;
+  static constexpr int64_t value =
+      tmppy_internal_test_module_x23<tmppy_internal_test_module_x5,
+                                     (tmppy_internal_test_module_x5) ==
+                                         (0LL)>::value;
+};
+''')
+def test_toplevel_assert_using_recursive_function_evaluated():
+    def fact(n: int) -> int:
+        if n == 0:
+            return 1
+        else:
+            return n * fact(n - 1)
+    assert fact(10) == 3628800
+
+@assert_code_optimizes_to(r'''
+template <typename T> struct CheckIfError { using type = void; };
+template <typename tmppy_internal_test_module_x5,
+          int64_t tmppy_internal_test_module_x6,
+          bool tmppy_internal_test_module_x23>
+struct tmppy_internal_test_module_x29;
+template <bool tmppy_internal_test_module_x25>
+struct tmppy_internal_test_module_x31;
+template <typename tmppy_internal_test_module_x5>
+struct tmppy_internal_test_module_x33;
+// Split that generates type of: (meta)function generated for an if-else
+// statement
+template <typename tmppy_internal_test_module_x5,
+          int64_t tmppy_internal_test_module_x6>
+struct tmppy_internal_test_module_x29<tmppy_internal_test_module_x5,
+                                      tmppy_internal_test_module_x6, true> {
+  using type =
+      typename tmppy_internal_test_module_x33<tmppy_internal_test_module_x5 *>::
+          template type<(tmppy_internal_test_module_x6) + (-1LL)>;
+};
+// Split that generates type of: (meta)function generated for an if-else
+// statement
+template <typename tmppy_internal_test_module_x5,
+          int64_t tmppy_internal_test_module_x6>
+struct tmppy_internal_test_module_x29<tmppy_internal_test_module_x5,
+                                      tmppy_internal_test_module_x6, false> {
+  static constexpr int64_t tmppy_internal_test_module_x16 =
+      (tmppy_internal_test_module_x6) / (2LL);
+  using type = typename tmppy_internal_test_module_x33<
+      typename tmppy_internal_test_module_x33<tmppy_internal_test_module_x5>::
+          template type<tmppy_internal_test_module_x16>>::
+      template type<(tmppy_internal_test_module_x6) -
+                    (tmppy_internal_test_module_x16)>;
+};
+// Split that generates type of: (meta)function generated for an if-else
+// statement
+template <> struct tmppy_internal_test_module_x31<true> {
+  template <typename tmppy_internal_test_module_x5,
+            int64_t tmppy_internal_test_module_x6>
+  using type = tmppy_internal_test_module_x5;
+};
+// Split that generates type of: (meta)function generated for an if-else
+// statement
+template <> struct tmppy_internal_test_module_x31<false> {
+  template <typename tmppy_internal_test_module_x5,
+            int64_t tmppy_internal_test_module_x6>
+  using type = typename tmppy_internal_test_module_x29<
+      tmppy_internal_test_module_x5, tmppy_internal_test_module_x6,
+      (tmppy_internal_test_module_x6) == (1LL)>::type;
+};
+// Split that generates type of: add_pointer_multiple
+template <typename tmppy_internal_test_module_x5>
+struct tmppy_internal_test_module_x33 {
+  template <int64_t tmppy_internal_test_module_x6>
+  using type = typename tmppy_internal_test_module_x31<
+      (tmppy_internal_test_module_x6) ==
+      (0LL)>::template type<tmppy_internal_test_module_x5,
+                            tmppy_internal_test_module_x6>;
+};
+template <typename tmppy_internal_test_module_x5,
+          int64_t tmppy_internal_test_module_x6>
+struct add_pointer_multiple {
+  using error = void;
+  using type = typename tmppy_internal_test_module_x31<
+      (tmppy_internal_test_module_x6) ==
+      (0LL)>::template type<tmppy_internal_test_module_x5,
+                            tmppy_internal_test_module_x6>;
+};
+''')
+def test_counting_recursion_rewritten_with_logarithmic_depth():
+    from tmppy import Type
+    def add_pointer_multiple(t: Type, n: int) -> Type:
+        if n == 0:
+            return t
+        else:
+            return add_pointer_multiple(Type.pointer(t), n-1)
+
+@assert_compilation_succeeds(always_allow_toplevel_static_asserts_after_optimization=True)
+def test_counting_recursion_with_n_above_template_depth_limit():
+    def add(x: int, k: int, n: int) -> int:
+        if n == 0:
+            return x
+        return add(x + k, k, n - 1)
+    assert add(1, 2, 1000) == 2001
+
 if __name__== '__main__':
     main(__file__)
@@ -0,0 +1,158 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Set, Dict
+
+from _py2tmp.ir0 import ir, Visitor, Transformation, compute_template_dependency_graph
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+from _py2tmp.utils import compute_condensation_in_topological_order
+
+
+def _get_alias_body(template_defn: ir.TemplateDefn):
+    # Returns the expr X if the template is of the form:
+    #
+    # template <typename... Args>
+    # struct F {
+    #   using type = X;
+    # };
+    #
+    # (with no specializations) and X references all the template args, otherwise returns None.
+    # The last condition ensures that F<...> stays dependent wherever F<...>::type was, e.g. in a pack expansion.
+    if (template_defn.specializations
+            or template_defn.main_definition is None
+            or not template_defn.main_definition.is_metafunction
+            or list(template_defn.result_element_names) != ['type']
+            or len(template_defn.main_definition.body) != 1):
+        return None
+    [elem] = template_defn.main_definition.body
+    if not isinstance(elem, ir.Typedef) or elem.name != 'type' or elem.template_args:
+        return None
+    if not template_defn.main_definition.args or not all(elem.expr.references_any_of({arg.name})
+                                                         for arg in template_defn.main_definition.args):
+        return None
+    return elem.expr
+
+class _DetermineTemplatesThatCantBeConverted(Visitor):
+    def __init__(self):
+        # Templates that are used in some way other than F<...>::type. Those can't be converted, e.g. an alias template
+        # can't be specialized by the C++ code using the header and std::is_same<F<int>, int> would become true.
+        self.template_names_that_cant_be_converted: Set[str] = set()
+
+    def visit_header(self, header: ir.Header):
+        super().visit_header(header)
+        for specialization in header.check_if_error_specializations:
+            self.visit_template_specialization(specialization)
+        for template_name in header.public_names:
+            self.template_names_that_cant_be_converted.add(template_name)
+
+    def visit_class_member_access(self, class_member_access: ir.ClassMemberAccess):
+        if (class_member_access.member_name == 'type'
+                and isinstance(class_member_access.expr, ir.TemplateInstantiation)
+                and isinstance(class_member_access.expr.template_expr, ir.AtomicTypeLiteral)
+                and not class_member_access.expr.template_expr.is_local
+                and not class_member_access.expr.template_expr.is_metafunction_that_may_return_error):
+            # We don't visit the AtomicTypeLiteral, this use doesn't prevent the conversion.
+            self.visit_exprs(class_member_access.expr.args)
+        else:
+            super().visit_class_member_access(class_member_access)
+
+    def visit_type_literal(self, type_literal: ir.AtomicTypeLiteral):
+        if isinstance(type_literal.expr_type, ir.TemplateType) and not type_literal.is_local:
+            self.template_names_that_cant_be_converted.add(type_literal.cpp_type)
+
+class _ReplaceTypeAccessWithAliasInstantiation(Transformation):
+    def __init__(self, alias_literal_by_template_name: Dict[str, ir.AtomicTypeLiteral]):
+        super().__init__()
+        self.alias_literal_by_template_name = alias_literal_by_template_name
+
+    def transform_class_member_access(self, class_member_access: ir.ClassMemberAccess):
+        if (class_member_access.member_name == 'type'
+                and isinstance(class_member_access.expr, ir.TemplateInstantiation)
+                and isinstance(class_member_access.expr.template_expr, ir.AtomicTypeLiteral)
+                and not class_member_access.expr.template_expr.is_local
+                and class_member_access.expr.template_expr.cpp_type in self.alias_literal_by_template_name):
+            # F<X, Y>::type -> F<X, Y>
+            return ir.TemplateInstantiation(template_expr=self.alias_literal_by_template_name[class_member_access.expr.template_expr.cpp_type],
+                                            args=self.transform_exprs(class_member_access.expr.args, class_member_access.expr),
+                                            instantiation_might_trigger_static_asserts=class_member_access.expr.instantiation_might_trigger_static_asserts)
+        return super().transform_class_member_access(class_member_access)
+
+# Converts metafunctions that just compute a type from their args into alias templates, e.g.:
+#
+# template <typename T>
+# struct F {
+#   using type = T*;
+# };
+#
+# becomes:
+#
+# template <typename T>
+# using F = T*;
+#
+# and F<...>::type becomes F<...>. This saves the C++ compiler a class instantiation and a member lookup for each use.
+# This can only be done when linking the final header, since other modules might use F in other ways.
+# Templates that (directly or indirectly) reference themselves are not converted since alias templates can't be
+# recursive, and templates that define "value" instead of "type" are not converted either since that would need a
+# C++14 variable template.
+def convert_templates_to_alias_templates(header: ir.Header) -> ir.Header:
+    visitor = _DetermineTemplatesThatCantBeConverted()
+    visitor.visit_header(header)
+
+    template_defn_by_name = {template_defn.name: template_defn
+                             for template_defn in header.template_defns}
+    template_dependency_graph = compute_template_dependency_graph(header.template_defns, template_defn_by_name)
+    recursive_template_names = {template_name
+                                for connected_component in compute_condensation_in_topological_order(template_dependency_graph)
+                                for template_name in connected_component
+                                if len(connected_component) > 1 or template_dependency_graph.has_edge(template_name, template_name)}
+
+    aliases = []
+    alias_literal_by_template_name: Dict[str, ir.AtomicTypeLiteral] = dict()
+    for template_defn in header.template_defns:
+        if template_defn.name in visitor.template_names_that_cant_be_converted or template_defn.name in recursive_template_names:
+            continue
+        alias_body = _get_alias_body(template_defn)
+        if alias_body is None:
+            continue
+        aliases.append(ir.Typedef(name=template_defn.name,
+                                  expr=alias_body,
+                                  description=template_defn.description,
+                                  template_args=list(template_defn.main_definition.args)))
+        alias_literal_by_template_name[template_defn.name] = ir.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_defn.name,
+                                                                                                        args=[ir.TemplateArgType(expr_type=arg.expr_type,
+                                                                                                                                 is_variadic=arg.is_variadic)
+                                                                                                              for arg in template_defn.main_definition.args],
+                                                                                                        is_metafunction_that_may_return_error=False,
+                                                                                                        may_be_alias=True)
+
+    if not aliases:
+        return header
+    ConfigurationKnobs.alias_templates_counter += len(aliases)
+
+    transformation = _ReplaceTypeAccessWithAliasInstantiation(alias_literal_by_template_name)
+    header = transformation.transform_header(header)
+    # The alias bodies can reference other converted templates.
+    aliases = [ir.Typedef(name=alias.name,
+                          expr=transformation.transform_expr(alias.expr),
+                          description=alias.description,
+                          template_args=alias.template_args)
+               for alias in aliases]
+
+    return ir.Header(template_defns=[template_defn
+                                     for template_defn in header.template_defns
+                                     if template_defn.name not in alias_literal_by_template_name],
+                     toplevel_content=aliases + list(header.toplevel_content),
+                     public_names=header.public_names,
+                     split_template_name_by_old_name_and_result_element_name=header.split_template_name_by_old_name_and_result_element_name,
+                     check_if_error_specializations=header.check_if_error_specializations)
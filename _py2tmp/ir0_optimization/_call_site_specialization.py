@@ -0,0 +1,256 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+from typing import Dict, Iterator, Optional, Tuple, List
+
+from _py2tmp.ir0 import ir, Visitor, Transformation, NameReplacementTransformation
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+from _py2tmp.ir0_optimization._local_optimizations import perform_local_optimizations_on_template_defn
+from _py2tmp.ir0_optimization._replace_var_with_expr import replace_var_with_expr_in_template_body_elements, \
+    replace_var_with_expr_in_expr
+from _py2tmp.ir0_optimization._unify import is_syntactically_equal
+
+# For each arg of a template instantiation, its value if it's a constant, or None.
+_ConstantArgs = Tuple[Optional[ir.Expr], ...]
+
+def _is_constant(expr: ir.Expr):
+    if isinstance(expr, ir.Literal):
+        return True
+    # For bool/int64 a non-local literal is a toplevel constant, so its value isn't known here.
+    return (isinstance(expr, ir.AtomicTypeLiteral)
+            and not expr.is_local
+            and not expr.may_be_alias
+            and expr.expr_type.kind in (ir.ExprKind.TYPE, ir.ExprKind.TEMPLATE))
+
+def _get_constant_args(template_instantiation: ir.TemplateInstantiation) -> Optional[_ConstantArgs]:
+    if any(isinstance(arg, ir.VariadicTypeExpansion) for arg in template_instantiation.args):
+        return None
+    constant_args = tuple(arg if _is_constant(arg) else None
+                          for arg in template_instantiation.args)
+    if all(arg is None for arg in constant_args) or all(arg is not None for arg in constant_args):
+        # If all args are constant we'd have to generate a class instead of a template. In that case it's better to
+        # evaluate the instantiation anyway.
+        return None
+    return constant_args
+
+def _get_called_template_name(class_member_access: ir.ClassMemberAccess):
+    if (isinstance(class_member_access.expr, ir.TemplateInstantiation)
+            and isinstance(class_member_access.expr.template_expr, ir.AtomicTypeLiteral)
+            and not class_member_access.expr.template_expr.is_local):
+        return class_member_access.expr.template_expr.cpp_type
+    return None
+
+class _CountCallSitesWithConstantArgs(Visitor):
+    def __init__(self, template_defn_by_name: Dict[str, ir.TemplateDefn]):
+        self.template_defn_by_name = template_defn_by_name
+        self.num_call_sites_by_key: Dict[Tuple[str, _ConstantArgs], int] = defaultdict(lambda: 0)
+        self.template_literal_by_name: Dict[str, ir.AtomicTypeLiteral] = dict()
+
+    def visit_class_member_access(self, class_member_access: ir.ClassMemberAccess):
+        super().visit_class_member_access(class_member_access)
+        template_name = _get_called_template_name(class_member_access)
+        if template_name in self.template_defn_by_name:
+            constant_args = _get_constant_args(class_member_access.expr)
+            if constant_args is not None:
+                self.num_call_sites_by_key[(template_name, constant_args)] += 1
+                self.template_literal_by_name[template_name] = class_member_access.expr.template_expr
+
+class _ReplaceCallsWithSpecializedTemplates(Transformation):
+    def __init__(self, specialized_template_literal_by_key: Dict[Tuple[str, _ConstantArgs], ir.AtomicTypeLiteral]):
+        super().__init__()
+        self.specialized_template_literal_by_key = specialized_template_literal_by_key
+
+    def transform_class_member_access(self, class_member_access: ir.ClassMemberAccess):
+        class_member_access = super().transform_class_member_access(class_member_access)
+        assert isinstance(class_member_access, ir.ClassMemberAccess)
+        template_name = _get_called_template_name(class_member_access)
+        if template_name is None:
+            return class_member_access
+        template_instantiation = class_member_access.expr
+        assert isinstance(template_instantiation, ir.TemplateInstantiation)
+        constant_args = _get_constant_args(template_instantiation)
+        specialized_template_literal = self.specialized_template_literal_by_key.get((template_name, constant_args))
+        if specialized_template_literal is None:
+            return class_member_access
+        return ir.ClassMemberAccess(class_type_expr=ir.TemplateInstantiation(template_expr=specialized_template_literal,
+                                                                             args=[arg
+                                                                                   for arg, constant_arg in zip(template_instantiation.args, constant_args)
+                                                                                   if constant_arg is None],
+                                                                             instantiation_might_trigger_static_asserts=template_instantiation.instantiation_might_trigger_static_asserts),
+                                    member_name=class_member_access.member_name,
+                                    member_type=class_member_access.expr_type)
+
+class _SpecializationNotPossibleException(Exception):
+    pass
+
+def _specialize_patterns(specialization: ir.TemplateSpecialization, constant_args: _ConstantArgs):
+    # Returns the args/patterns/body of the specialization with the constant args replaced, or None if the
+    # specialization can't match those constant args.
+    value_by_var: Dict[str, ir.Expr] = dict()
+    for pattern, constant_arg in zip(specialization.patterns, constant_args):
+        if constant_arg is None:
+            continue
+        if isinstance(pattern, ir.AtomicTypeLiteral) and pattern.is_local and not pattern.is_variadic:
+            if pattern.cpp_type in value_by_var and not is_syntactically_equal(value_by_var[pattern.cpp_type], constant_arg):
+                # E.g. F<T, T> with args int, float.
+                return None
+            value_by_var[pattern.cpp_type] = constant_arg
+        elif isinstance(pattern, ir.AtomicTypeLiteral) and not pattern.is_local and pattern.may_be_alias:
+            # We don't know if this matches, it depends on what the alias expands to.
+            raise _SpecializationNotPossibleException()
+        elif not is_syntactically_equal(pattern, constant_arg):
+            # The constant arg is a literal or a (non-alias) atomic type, so it can't match a different literal/atomic
+            # type or a compound pattern (e.g. "T*").
+            return None
+
+    patterns = [replace_var_with_expr_in_expr(pattern, value_by_var, dict())
+                for pattern, constant_arg in zip(specialization.patterns, constant_args)
+                if constant_arg is None]
+    args = [arg
+            for arg in specialization.args
+            if arg.name not in value_by_var]
+    body = replace_var_with_expr_in_template_body_elements(specialization.body, value_by_var, dict())
+    return args, patterns, body
+
+def _is_total(patterns: List[ir.Expr]):
+    # Whether these patterns match any args.
+    return (all(isinstance(pattern, ir.AtomicTypeLiteral) and pattern.is_local and not pattern.is_variadic
+                for pattern in patterns)
+            and len({pattern.cpp_type for pattern in patterns}) == len(patterns))
+
+def _specialize_template_defn(template_defn: ir.TemplateDefn,
+                              constant_args: _ConstantArgs,
+                              specialized_template_name: str):
+    args = [arg
+            for arg, constant_arg in zip(template_defn.args, constant_args)
+            if constant_arg is None]
+
+    main_definition = None
+    if template_defn.main_definition:
+        value_by_var = {arg.name: constant_arg
+                        for arg, constant_arg in zip(template_defn.main_definition.args, constant_args)
+                        if constant_arg is not None}
+        main_definition = ir.TemplateSpecialization(args=args,
+                                                    patterns=None,
+                                                    body=replace_var_with_expr_in_template_body_elements(template_defn.main_definition.body,
+                                                                                                         value_by_var,
+                                                                                                         dict()),
+                                                    is_metafunction=template_defn.main_definition.is_metafunction)
+
+    specializations = []
+    total_specializations = []
+    for specialization in template_defn.specializations:
+        result = _specialize_patterns(specialization, constant_args)
+        if result is None:
+            continue
+        specialization_args, patterns, body = result
+        if _is_total(patterns):
+            # This would always be preferred over the main definition, so it becomes the main definition.
+            name_replacements = {pattern.cpp_type: arg.name
+                                 for pattern, arg in zip(patterns, args)}
+            body = NameReplacementTransformation(name_replacements).transform_template_body_elems(body)
+            total_specializations.append(ir.TemplateSpecialization(args=args,
+                                                                   patterns=None,
+                                                                   body=body,
+                                                                   is_metafunction=specialization.is_metafunction))
+        else:
+            specializations.append(ir.TemplateSpecialization(args=specialization_args,
+                                                             patterns=patterns,
+                                                             body=body,
+                                                             is_metafunction=specialization.is_metafunction))
+
+    if len(total_specializations) > 1:
+        # This would be ambiguous in C++.
+        raise _SpecializationNotPossibleException()
+    if total_specializations:
+        [main_definition] = total_specializations
+    if not main_definition and not specializations:
+        raise _SpecializationNotPossibleException()
+
+    return ir.TemplateDefn(main_definition=main_definition,
+                           specializations=specializations,
+                           name=specialized_template_name,
+                           description=template_defn.description,
+                           result_element_names=template_defn.result_element_names,
+                           args=args)
+
+def _compute_size(template_defn: ir.TemplateDefn):
+    return sum(1 for _ in template_defn.get_transitive_subexpressions())
+
+# Creates copies of templates specialized for constant args (e.g. F<n, true> => F_true<n>) when they're used with the
+# same constant args in multiple places, and replaces the calls with calls to the copies. That way the C++ compiler
+# doesn't need to re-evaluate the parts of F that only depend on those args for each instantiation.
+# Copies are only created for calls that access a member of the instantiation (e.g. F<n, true>::value), since
+# F<n, true> and F_true<n> are different types.
+def specialize_templates_for_constant_args(header: ir.Header, identifier_generator: Iterator[str]) -> ir.Header:
+    template_defns = list(header.template_defns)
+    template_defn_by_name = {template_defn.name: template_defn
+                             for template_defn in template_defns
+                             if not any(arg.is_variadic for arg in template_defn.args)}
+    remaining_size_budget = int(ConfigurationKnobs.call_site_specialization_max_size_increase_ratio
+                                * sum(_compute_size(template_defn) for template_defn in template_defns))
+    specialized_template_literal_by_key: Dict[Tuple[str, _ConstantArgs], ir.AtomicTypeLiteral] = dict()
+    skipped_keys = set()
+
+    # The specialized templates can contain new calls with constant args, so we iterate until there's nothing left to
+    # specialize.
+    while True:
+        visitor = _CountCallSitesWithConstantArgs(template_defn_by_name)
+        visitor.visit_header(header)
+
+        keys = [key
+                for key, num_call_sites in sorted(visitor.num_call_sites_by_key.items(), key=lambda item: -item[1])
+                if num_call_sites >= ConfigurationKnobs.call_site_specialization_min_num_call_sites
+                and key not in specialized_template_literal_by_key
+                and key not in skipped_keys]
+        new_template_defns = []
+        for key in keys:
+            template_name, constant_args = key
+            template_defn = template_defn_by_name[template_name]
+            try:
+                specialized_template_defn = _specialize_template_defn(template_defn, constant_args, next(identifier_generator))
+            except _SpecializationNotPossibleException:
+                skipped_keys.add(key)
+                continue
+            specialized_template_defn, _ = perform_local_optimizations_on_template_defn(specialized_template_defn,
+                                                                                        identifier_generator,
+                                                                                        inline_template_instantiations_with_multiple_references=False)
+            size = _compute_size(specialized_template_defn)
+            if size > remaining_size_budget:
+                skipped_keys.add(key)
+                continue
+            remaining_size_budget -= size
+
+            if ConfigurationKnobs.verbose:
+                print('Specializing template %s for constant args: %s' % (template_name, ', '.join(str(arg) for arg in constant_args)))
+            ConfigurationKnobs.call_site_specialization_templates_counter += 1
+            new_template_defns.append(specialized_template_defn)
+            template_defn_by_name[specialized_template_defn.name] = specialized_template_defn
+            specialized_template_literal_by_key[key] = ir.AtomicTypeLiteral.for_nonlocal_template(
+                cpp_type=specialized_template_defn.name,
+                args=[ir.TemplateArgType(expr_type=arg.expr_type, is_variadic=arg.is_variadic)
+                      for arg in specialized_template_defn.args],
+                is_metafunction_that_may_return_error=visitor.template_literal_by_name[template_name].is_metafunction_that_may_return_error,
+                may_be_alias=False)
+
+        if not new_template_defns:
+            return header
+
+        header = _ReplaceCallsWithSpecializedTemplates(specialized_template_literal_by_key).transform_header(
+            ir.Header(template_defns=list(header.template_defns) + new_template_defns,
+                      toplevel_content=header.toplevel_content,
+                      public_names=header.public_names,
+                      split_template_name_by_old_name_and_result_element_name=header.split_template_name_by_old_name_and_result_element_name,
+                      check_if_error_specializations=header.check_if_error_specializations))
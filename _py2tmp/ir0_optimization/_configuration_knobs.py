@@ -20,3 +20,56 @@ class ConfigurationKnobs:
     optimization_step_counter = 0
     reached_max_num_remaining_loops_counter = 0
     verbose = DEFAULT_VERBOSE_SETTING
+
+    # Max number of entries kept in the cache of unification results (see _unify.py).
+    unification_cache_max_size = 10000
+    # These are reset at the start of each optimize_header() call.
+    unification_cache_hit_counter = 0
+    unification_cache_miss_counter = 0
+    # Stats for hoist_common_subexpressions() (see _global_common_subexpression_elimination.py). These are also reset at
+    # the start of each optimize_header() call.
+    global_cse_hoisted_exprs_counter = 0
+    global_cse_saved_tokens_counter = 0
+    # Limits for the evaluation of toplevel elems in evaluate_closed_toplevel_elems() (see _partial_evaluation.py). When
+    # they're reached, the elem is left for the C++ compiler to evaluate.
+    partial_evaluation_max_steps = 100000
+    partial_evaluation_max_depth = 64
+    # This is also reset at the start of each optimize_header() call.
+    partial_evaluation_removed_static_asserts_counter = 0
+    # Number of templates rewritten by rewrite_list_recursion_as_pack_expansion(). This is also reset at the start of each
+    # optimize_header() call.
+    recursion_to_pack_expansion_counter = 0
+    # Templates are specialized for some constant args by specialize_templates_for_constant_args() (see
+    # _call_site_specialization.py) only if they're called with those args in at least this many places, and as long as
+    # the total size of the specialized templates is at most this fraction of the size of the header's templates.
+    call_site_specialization_min_num_call_sites = 2
+    call_site_specialization_max_size_increase_ratio = 0.5
+    # This is also reset at the start of each optimize_header() call.
+    call_site_specialization_templates_counter = 0
+    # Number of templates removed by merge_equivalent_template_defns() (see _template_deduplication.py). This is also
+    # reset at the start of each optimize_header() call.
+    merged_template_defns_counter = 0
+    # Number of specializations removed by remove_unreachable_specializations() (see
+    # _dead_specialization_elimination.py). This is also reset at the start of each optimize_header() call.
+    dead_specializations_removed_counter = 0
+    # Number of template params removed by remove_dead_template_args() (see _dead_template_arg_elimination.py). This is
+    # also reset at the start of each optimize_header() call.
+    dead_template_args_removed_counter = 0
+    # Cost model used to decide whether to inline a template instantiation (see _template_instantiation_inlining.py).
+    # The estimated increase in the C++ compile cost is the number of IR nodes added by inlining (times
+    # inlining_cost_per_node) minus the cost of the saved template instantiation (divided by the number of references
+    # to the template, since the C++ compiler can reuse instantiations). Instantiations are not inlined when that's
+    # more than inlining_max_compile_cost_increase.
+    inlining_cost_per_node = 1
+    inlining_cost_per_template_instantiation = 20
+    inlining_max_compile_cost_increase = 100
+    # These are also reset at the start of each optimize_header() call.
+    inlined_template_instantiations_counter = 0
+    template_instantiations_not_inlined_due_to_cost_counter = 0
+    inlining_estimated_compile_cost_delta_counter = 0.0
+    # Number of templates converted to alias templates by convert_templates_to_alias_templates() (see
+    # _alias_template_conversion.py). This is also reset at the start of each optimize_header() call.
+    alias_templates_counter = 0
+    # Number of Select1st*/AlwaysTrueFrom* wrappers removed by eliminate_redundant_dependency_wrappers() (see
+    # _dependency_wrapper_elimination.py). This is also reset at the start of each optimize_header() call.
+    eliminated_dependency_wrappers_counter = 0
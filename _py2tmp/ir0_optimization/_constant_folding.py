@@ -13,13 +13,38 @@
 # limitations under the License.
 
 from collections import defaultdict
-from typing import List, Dict, Set, Sequence
+from typing import List, Dict, Set, Sequence, Callable
 
 from _py2tmp.ir0 import ir, Transformation
 from _py2tmp.ir0_optimization._recalculate_template_instantiation_can_trigger_static_asserts_info import elem_can_trigger_static_asserts
 from _py2tmp.ir0_optimization._replace_var_with_expr import replace_var_with_expr_in_template_body_element
 
 
+# A Fenwick tree (aka binary indexed tree) of ints, supporting point updates and prefix sums in O(log n).
+class _FenwickTree:
+    def __init__(self, size: int):
+        self.tree = [0] * (size + 1)
+
+    def add(self, index: int, delta: int):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    # Returns the sum of the values with index in [0, end).
+    def prefix_sum(self, end: int):
+        result = 0
+        while end > 0:
+            result += self.tree[end]
+            end -= end & -end
+        return result
+
+    # Returns the sum of the values with index in [begin, end).
+    def range_sum(self, begin: int, end: int):
+        if begin >= end:
+            return 0
+        return self.prefix_sum(end) - self.prefix_sum(begin)
+
 class ConstantFoldingTransformation(Transformation):
     def __init__(self, inline_template_instantiations_with_multiple_references: bool):
         super().__init__()
@@ -86,6 +111,29 @@ class ConstantFoldingTransformation(Transformation):
                                                     for stmt in stmts]
         was_inlined_by_stmt_index = [False for stmt in stmts]
 
+        # is_inlining_barrier_by_stmt_index[i] is True iff stmts[i] can trigger static asserts and will be emitted, so
+        # a var definition that can trigger static asserts can't be inlined across it (that might change the order in
+        # which the static asserts are triggered).
+        # inlining_barriers has a 1 at index i iff is_inlining_barrier_by_stmt_index[i], so that we can count the
+        # barriers crossed by an inlining in O(log n) instead of checking all stmts in between.
+        is_inlining_barrier_by_stmt_index = [False for stmt in stmts]
+        inlining_barriers = _FenwickTree(len(stmts))
+        def update_inlining_barrier(stmt_index: int):
+            stmt = stmts[stmt_index]
+            is_inlining_barrier = (can_trigger_static_asserts_by_stmt_index[stmt_index]
+                                   # If all references have been inlined, we won't emit this assignment; so we can
+                                   # disregard it in the crossing calculation.
+                                   and not (isinstance(stmt, (ir.ConstantDef, ir.Typedef))
+                                            and remaining_uses_of_var[stmt.name] == 0
+                                            and was_inlined_by_stmt_index[stmt_index]))
+            if is_inlining_barrier != is_inlining_barrier_by_stmt_index[stmt_index]:
+                is_inlining_barrier_by_stmt_index[stmt_index] = is_inlining_barrier
+                inlining_barriers.add(stmt_index, 1 if is_inlining_barrier else -1)
+        def update_inlining_barrier_for_var(var: str):
+            update_inlining_barrier(var_name_to_defining_stmt_index[var])
+        for i in range(len(stmts)):
+            update_inlining_barrier(i)
+
         # Disregard "uses" of vars in useless stmts that will be eliminated.
         already_useless_stmt_indexes = [i
                                         for i, stmt in enumerate(stmts)
@@ -101,6 +149,7 @@ class ConstantFoldingTransformation(Transformation):
                                               var_name_to_defining_stmt_index,
                                               can_trigger_static_asserts_by_stmt_index,
                                               was_inlined_by_stmt_index,
+                                              update_inlining_barrier_for_var,
                                               indirectly_unused_var,
                                               i,
                                               remaining_uses_of_var_by_stmt_index[i][indirectly_unused_var])
@@ -125,13 +174,7 @@ class ConstantFoldingTransformation(Transformation):
                 assert isinstance(defining_stmt, (ir.ConstantDef, ir.Typedef))
 
                 can_inline_var = (not can_trigger_static_asserts_by_stmt_index[defining_stmt_index]
-                                  or all(not can_trigger_static_asserts_by_stmt_index[crossed_stmt_index]
-                                         # If all references have been inlined, we won't emit this assignment; so we
-                                         # can disregard it in the crossing calculation.
-                                         or (isinstance(stmts[crossed_stmt_index], (ir.ConstantDef, ir.Typedef))
-                                             and remaining_uses_of_var[stmts[crossed_stmt_index].name] == 0
-                                             and was_inlined_by_stmt_index[crossed_stmt_index])
-                                         for crossed_stmt_index in range(defining_stmt_index + 1, i)))
+                                  or inlining_barriers.range_sum(defining_stmt_index + 1, i) == 0)
 
                 if self.inline_template_instantiations_with_multiple_references and isinstance(defining_stmt.expr, ir.TemplateInstantiation):
                     want_to_inline_var = True
@@ -154,15 +197,18 @@ class ConstantFoldingTransformation(Transformation):
                 for var2, num_uses_in_replacement_expr in remaining_uses_of_var_by_stmt_index[defining_stmt_index].items():
                     remaining_uses_of_var[var2] = remaining_uses_of_var[var2] + num_uses_in_replacement_expr * num_replacements
                     remaining_uses_of_var_by_stmt_index[i][var2] = remaining_uses_of_var_by_stmt_index[i][var2] + num_uses_in_replacement_expr * num_replacements
+                    update_inlining_barrier_for_var(var2)
 
                 if num_replacements > 0:
                     was_inlined_by_stmt_index[defining_stmt_index] = True
+                    update_inlining_barrier(defining_stmt_index)
                     self._decrease_remaining_uses(remaining_uses_of_var,
                                                   remaining_uses_of_var_by_stmt_index,
                                                   referenced_vars_by_stmt_index,
                                                   var_name_to_defining_stmt_index,
                                                   can_trigger_static_asserts_by_stmt_index,
                                                   was_inlined_by_stmt_index,
+                                                  update_inlining_barrier_for_var,
                                                   var=var,
                                                   from_stmt_index=i,
                                                   by=num_replacements)
@@ -175,6 +221,7 @@ class ConstantFoldingTransformation(Transformation):
                         referenced_var_list_by_stmt_index[i].append(var)
 
                 can_trigger_static_asserts_by_stmt_index[i] = can_trigger_static_asserts_by_stmt_index[i] or elem_can_trigger_static_asserts(defining_stmt)
+                update_inlining_barrier(i)
 
         return [stmt
                 for stmt in stmts
@@ -187,27 +234,30 @@ class ConstantFoldingTransformation(Transformation):
                                  var_name_to_defining_stmt_index: Dict[str, int],
                                  can_trigger_static_asserts_by_stmt_index: List[bool],
                                  was_inlined_by_stmt_index: List[bool],
+                                 update_inlining_barrier_for_var: Callable[[str], None],
                                  var: str,
                                  from_stmt_index: int,
                                  by: int):
-        assert by > 0
-        remaining_uses_of_var[var] -= by
-        remaining_uses_of_var_by_stmt_index[from_stmt_index][var] -= by
-
-        stmt_index_defining_var = var_name_to_defining_stmt_index[var]
-
-        if remaining_uses_of_var[var] == 0 and (
-                not can_trigger_static_asserts_by_stmt_index[stmt_index_defining_var]
-                or was_inlined_by_stmt_index[stmt_index_defining_var]):
-            # The assignment to `var` will be eliminated. So we also need to decrement the uses of the variables referenced
-            # in this assignment.
-            for referenced_var in referenced_vars_by_stmt_index[stmt_index_defining_var]:
-                self._decrease_remaining_uses(remaining_uses_of_var,
-                                              remaining_uses_of_var_by_stmt_index,
-                                              referenced_vars_by_stmt_index,
-                                              var_name_to_defining_stmt_index,
-                                              can_trigger_static_asserts_by_stmt_index,
-                                              was_inlined_by_stmt_index,
-                                              var=referenced_var,
-                                              from_stmt_index=stmt_index_defining_var,
-                                              by=remaining_uses_of_var_by_stmt_index[stmt_index_defining_var][referenced_var])
+        # This uses an explicit stack instead of recursion, since for long bodies the chains of assignments that
+        # become unused can be very long.
+        decreases_to_apply = [(var, from_stmt_index, by)]
+        while decreases_to_apply:
+            var, from_stmt_index, by = decreases_to_apply.pop()
+            assert by > 0
+            remaining_uses_of_var[var] -= by
+            remaining_uses_of_var_by_stmt_index[from_stmt_index][var] -= by
+            update_inlining_barrier_for_var(var)
+
+            stmt_index_defining_var = var_name_to_defining_stmt_index[var]
+
+            if remaining_uses_of_var[var] == 0 and (
+                    not can_trigger_static_asserts_by_stmt_index[stmt_index_defining_var]
+                    or was_inlined_by_stmt_index[stmt_index_defining_var]):
+                # The assignment to `var` will be eliminated. So we also need to decrement the uses of the variables
+                # referenced in this assignment.
+                # These are pushed in reverse order so that they're processed in the same order as the recursive
+                # version would.
+                for referenced_var in reversed(list(referenced_vars_by_stmt_index[stmt_index_defining_var])):
+                    decreases_to_apply.append((referenced_var,
+                                               stmt_index_defining_var,
+                                               remaining_uses_of_var_by_stmt_index[stmt_index_defining_var][referenced_var]))
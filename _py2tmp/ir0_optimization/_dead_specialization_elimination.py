@@ -0,0 +1,120 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+from collections import defaultdict
+from typing import Dict, Set, List
+
+from _py2tmp.ir0 import ir, Visitor
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+from _py2tmp.ir0_optimization._unify import find_matches_in_unification_of_template_instantiation_with_definition
+
+
+class _CollectTemplateInstantiations(Visitor):
+    def __init__(self):
+        # Templates that are used in some way other than instantiating them, e.g. passed as template template args. We
+        # can't know with which args those will be instantiated.
+        self.escaping_template_names: Set[str] = set()
+        self.template_instantiations_by_template_name: Dict[str, Dict[ir.TemplateInstantiation, None]] = defaultdict(dict)
+
+    def visit_header(self, header: ir.Header):
+        super().visit_header(header)
+        for specialization in header.check_if_error_specializations:
+            self.visit_template_specialization(specialization)
+        for template_name in header.public_names:
+            # These can be instantiated by the user's C++ code, with any args.
+            self.escaping_template_names.add(template_name)
+
+    def visit_template_instantiation(self, template_instantiation: ir.TemplateInstantiation):
+        if isinstance(template_instantiation.template_expr, ir.AtomicTypeLiteral) and not template_instantiation.template_expr.is_local:
+            # We use a dict as an ordered set, so that the unifications (and their identifiers) are deterministic.
+            self.template_instantiations_by_template_name[template_instantiation.template_expr.cpp_type][template_instantiation] = None
+            # We don't visit the AtomicTypeLiteral, this use doesn't make the template escape.
+            self.visit_exprs(template_instantiation.args)
+        else:
+            super().visit_template_instantiation(template_instantiation)
+
+    def visit_type_literal(self, type_literal: ir.AtomicTypeLiteral):
+        if isinstance(type_literal.expr_type, ir.TemplateType) and not type_literal.is_local:
+            self.escaping_template_names.add(type_literal.cpp_type)
+
+def _remove_unreachable_specializations(template_defn: ir.TemplateDefn,
+                                        template_instantiations: List[ir.TemplateInstantiation],
+                                        identifier_generator):
+    reachable_specialization_ids = set()
+    for template_instantiation in template_instantiations:
+        certain_matches, possible_matches = find_matches_in_unification_of_template_instantiation_with_definition(template_instantiation,
+                                                                                                                  local_var_definitions=dict(),
+                                                                                                                  template_defn=template_defn,
+                                                                                                                  identifier_generator=identifier_generator,
+                                                                                                                  verbose=ConfigurationKnobs.verbose)
+        for specialization in itertools.chain((specialization for specialization, _, _ in certain_matches), possible_matches):
+            reachable_specialization_ids.add(id(specialization))
+
+    specializations = [specialization
+                       for specialization in template_defn.specializations
+                       if id(specialization) in reachable_specialization_ids]
+    if len(specializations) == len(template_defn.specializations) or (not specializations and not template_defn.main_definition):
+        return template_defn
+
+    if ConfigurationKnobs.verbose:
+        print('Removing %s unreachable specializations of %s' % (len(template_defn.specializations) - len(specializations), template_defn.name))
+    ConfigurationKnobs.dead_specializations_removed_counter += len(template_defn.specializations) - len(specializations)
+
+    return ir.TemplateDefn(main_definition=template_defn.main_definition,
+                           specializations=specializations,
+                           name=template_defn.name,
+                           description=template_defn.description,
+                           result_element_names=template_defn.result_element_names,
+                           args=template_defn.args)
+
+# Removes the specializations that can't be selected by any instantiation of their template in the header.
+# This can only be done when linking the final header, since otherwise other modules might instantiate the templates
+# with other args.
+def remove_unreachable_specializations(header: ir.Header) -> ir.Header:
+    # The identifiers used by the unification don't appear in the result, so we use a separate generator to avoid
+    # affecting the names in the generated code.
+    identifier_generator = ('TmppyDeadSpecializationElimination_%s' % i for i in itertools.count())
+    template_defns = list(header.template_defns)
+    changed = False
+    while True:
+        # Removing a specialization also removes the instantiations in its body, so that might make more
+        # specializations unreachable.
+        visitor = _CollectTemplateInstantiations()
+        visitor.visit_header(ir.Header(template_defns=template_defns,
+                                       toplevel_content=header.toplevel_content,
+                                       public_names=header.public_names,
+                                       split_template_name_by_old_name_and_result_element_name=header.split_template_name_by_old_name_and_result_element_name,
+                                       check_if_error_specializations=header.check_if_error_specializations))
+
+        new_template_defns = [_remove_unreachable_specializations(template_defn,
+                                                                  list(visitor.template_instantiations_by_template_name[template_defn.name]),
+                                                                  identifier_generator)
+                              if template_defn.specializations and template_defn.name not in visitor.escaping_template_names
+                              else template_defn
+                              for template_defn in template_defns]
+        if all(new_template_defn is template_defn
+               for new_template_defn, template_defn in zip(new_template_defns, template_defns)):
+            break
+        template_defns = new_template_defns
+        changed = True
+
+    if not changed:
+        return header
+
+    return ir.Header(template_defns=template_defns,
+                     toplevel_content=header.toplevel_content,
+                     public_names=header.public_names,
+                     split_template_name_by_old_name_and_result_element_name=header.split_template_name_by_old_name_and_result_element_name,
+                     check_if_error_specializations=header.check_if_error_specializations)
@@ -0,0 +1,211 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+from typing import Dict, Set, List
+
+from _py2tmp.ir0 import ir, Visitor, Transformation
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+from _py2tmp.ir0_optimization._recalculate_template_instantiation_can_trigger_static_asserts_info import \
+    expr_can_trigger_static_asserts
+
+
+class _CollectTemplateInstantiations(Visitor):
+    def __init__(self):
+        # Templates whose args we can't change, e.g. because they're passed as template template args (so we don't
+        # know where they're instantiated) or because they're instantiated in a pattern.
+        self.unchangeable_template_names: Set[str] = set()
+        self.template_instantiations_by_template_name: Dict[str, List[ir.TemplateInstantiation]] = defaultdict(list)
+        self.in_pattern = False
+
+    def visit_header(self, header: ir.Header):
+        super().visit_header(header)
+        for specialization in header.check_if_error_specializations:
+            self.visit_template_specialization(specialization)
+        for template_name in header.public_names:
+            # These can be instantiated by the user's C++ code.
+            self.unchangeable_template_names.add(template_name)
+
+    def visit_pattern(self, expr: ir.Expr):
+        old_in_pattern = self.in_pattern
+        self.in_pattern = True
+        super().visit_pattern(expr)
+        self.in_pattern = old_in_pattern
+
+    def visit_template_instantiation(self, template_instantiation: ir.TemplateInstantiation):
+        if isinstance(template_instantiation.template_expr, ir.AtomicTypeLiteral) and not template_instantiation.template_expr.is_local:
+            template_name = template_instantiation.template_expr.cpp_type
+            if self.in_pattern or any(isinstance(arg, ir.VariadicTypeExpansion) for arg in template_instantiation.args):
+                # In these cases we can't easily tell which arg corresponds to which template param.
+                self.unchangeable_template_names.add(template_name)
+            else:
+                self.template_instantiations_by_template_name[template_name].append(template_instantiation)
+            # We don't visit the AtomicTypeLiteral, this use doesn't prevent the optimization.
+            self.visit_exprs(template_instantiation.args)
+        else:
+            super().visit_template_instantiation(template_instantiation)
+
+    def visit_type_literal(self, type_literal: ir.AtomicTypeLiteral):
+        if isinstance(type_literal.expr_type, ir.TemplateType) and not type_literal.is_local:
+            self.unchangeable_template_names.add(type_literal.cpp_type)
+
+def _is_arg_used_in_specialization(specialization: ir.TemplateSpecialization, arg_index: int):
+    used_identifiers = {identifier
+                        for elem in specialization.body
+                        for identifier in elem.get_referenced_identifiers()}
+    if specialization.patterns is None:
+        return specialization.args[arg_index].name in used_identifiers
+
+    # The arg is unused in a specialization only if the corresponding pattern is just a pattern variable that's not
+    # used anywhere else (in the other patterns or in the body).
+    pattern = specialization.patterns[arg_index]
+    if not (isinstance(pattern, ir.AtomicTypeLiteral)
+            and pattern.is_local
+            and not pattern.is_variadic
+            and pattern.cpp_type not in used_identifiers):
+        return True
+    return any(pattern.cpp_type in other_pattern.get_referenced_identifiers()
+               for i, other_pattern in enumerate(specialization.patterns)
+               if i != arg_index)
+
+def _compute_dead_arg_indexes(template_defn: ir.TemplateDefn,
+                              template_instantiations: List[ir.TemplateInstantiation]):
+    if any(arg.is_variadic for arg in template_defn.args):
+        return []
+    for template_instantiation in template_instantiations:
+        if len(template_instantiation.args) != len(template_defn.args):
+            return []
+
+    dead_arg_indexes = [arg_index
+                        for arg_index in range(len(template_defn.args))
+                        if not any(_is_arg_used_in_specialization(specialization, arg_index)
+                                   for specialization in template_defn.get_all_definitions())
+                        # We don't remove args that might trigger a static_assert when evaluated at some call site.
+                        and not any(expr_can_trigger_static_asserts(template_instantiation.args[arg_index])
+                                    for template_instantiation in template_instantiations)]
+
+    # We keep enough dead args that each instantiation still depends on the same variables as before. Otherwise e.g.
+    # F<T, int> in a template could become F<int>, that the C++ compiler would instantiate eagerly, even if the
+    # template containing it is never instantiated (or, for a specialization, is never selected).
+    needs_another_loop = True
+    while needs_another_loop:
+        needs_another_loop = False
+        for template_instantiation in template_instantiations:
+            remaining_free_var_names = {var.cpp_type
+                                        for arg_index, arg in enumerate(template_instantiation.args)
+                                        if arg_index not in dead_arg_indexes
+                                        for var in arg.get_free_vars()}
+            for arg_index in dead_arg_indexes:
+                if any(var.cpp_type not in remaining_free_var_names
+                       for var in template_instantiation.args[arg_index].get_free_vars()):
+                    dead_arg_indexes.remove(arg_index)
+                    needs_another_loop = True
+                    break
+
+    if len(dead_arg_indexes) == len(template_defn.args):
+        # A C++ template must have at least 1 param.
+        dead_arg_indexes = dead_arg_indexes[1:]
+
+    return dead_arg_indexes
+
+def _remove_args_from_specialization(specialization: ir.TemplateSpecialization, dead_arg_indexes: List[int]):
+    if specialization.patterns is None:
+        return ir.TemplateSpecialization(args=[arg
+                                               for arg_index, arg in enumerate(specialization.args)
+                                               if arg_index not in dead_arg_indexes],
+                                         patterns=None,
+                                         body=specialization.body,
+                                         is_metafunction=specialization.is_metafunction)
+
+    dead_pattern_var_names = {specialization.patterns[arg_index].cpp_type
+                              for arg_index in dead_arg_indexes}
+    return ir.TemplateSpecialization(args=[arg
+                                           for arg in specialization.args
+                                           if arg.name not in dead_pattern_var_names],
+                                     patterns=[pattern
+                                               for arg_index, pattern in enumerate(specialization.patterns)
+                                               if arg_index not in dead_arg_indexes],
+                                     body=specialization.body,
+                                     is_metafunction=specialization.is_metafunction)
+
+class _RemoveDeadArgsFromTemplateInstantiations(Transformation):
+    def __init__(self, dead_arg_indexes_by_template_name: Dict[str, List[int]]):
+        super().__init__()
+        self.dead_arg_indexes_by_template_name = dead_arg_indexes_by_template_name
+
+    def transform_template_instantiation(self, template_instantiation: ir.TemplateInstantiation):
+        template_expr = template_instantiation.template_expr
+        if (isinstance(template_expr, ir.AtomicTypeLiteral)
+                and not template_expr.is_local
+                and template_expr.cpp_type in self.dead_arg_indexes_by_template_name):
+            dead_arg_indexes = self.dead_arg_indexes_by_template_name[template_expr.cpp_type]
+            assert isinstance(template_expr.expr_type, ir.TemplateType)
+            template_expr = ir.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_expr.cpp_type,
+                                                                       args=[arg_type
+                                                                             for arg_index, arg_type in enumerate(template_expr.expr_type.args)
+                                                                             if arg_index not in dead_arg_indexes],
+                                                                       is_metafunction_that_may_return_error=template_expr.is_metafunction_that_may_return_error,
+                                                                       may_be_alias=template_expr.may_be_alias)
+            return ir.TemplateInstantiation(template_expr=template_expr,
+                                            args=[self.transform_expr(arg)
+                                                  for arg_index, arg in enumerate(template_instantiation.args)
+                                                  if arg_index not in dead_arg_indexes],
+                                            instantiation_might_trigger_static_asserts=template_instantiation.instantiation_might_trigger_static_asserts)
+        return super().transform_template_instantiation(template_instantiation)
+
+    def transform_template_defn(self, template_defn: ir.TemplateDefn):
+        if template_defn.name not in self.dead_arg_indexes_by_template_name:
+            return super().transform_template_defn(template_defn)
+        dead_arg_indexes = self.dead_arg_indexes_by_template_name[template_defn.name]
+        main_definition = template_defn.main_definition
+        if main_definition is not None:
+            main_definition = self.transform_template_specialization(_remove_args_from_specialization(main_definition, dead_arg_indexes))
+        self.writer.write(ir.TemplateDefn(main_definition=main_definition,
+                                          specializations=[self.transform_template_specialization(_remove_args_from_specialization(specialization, dead_arg_indexes))
+                                                           for specialization in template_defn.specializations],
+                                          name=template_defn.name,
+                                          description=template_defn.description,
+                                          result_element_names=template_defn.result_element_names,
+                                          args=[arg
+                                                for arg_index, arg in enumerate(template_defn.args)
+                                                if arg_index not in dead_arg_indexes]))
+
+# Removes the template params that aren't used in any specialization (and their args at all call sites). This makes the
+# C++ compiler's template instantiation keys (and the mangled names) shorter.
+# This can only be done when linking the final header, since otherwise other modules might instantiate the templates.
+def remove_dead_template_args(header: ir.Header) -> ir.Header:
+    while True:
+        # Removing an arg at a call site might make a param of the template containing it unused.
+        visitor = _CollectTemplateInstantiations()
+        visitor.visit_header(header)
+
+        dead_arg_indexes_by_template_name: Dict[str, List[int]] = dict()
+        for template_defn in header.template_defns:
+            if template_defn.name in visitor.unchangeable_template_names:
+                continue
+            dead_arg_indexes = _compute_dead_arg_indexes(template_defn,
+                                                         visitor.template_instantiations_by_template_name[template_defn.name])
+            if dead_arg_indexes:
+                dead_arg_indexes_by_template_name[template_defn.name] = dead_arg_indexes
+
+        if not dead_arg_indexes_by_template_name:
+            return header
+
+        if ConfigurationKnobs.verbose:
+            for template_name, dead_arg_indexes in dead_arg_indexes_by_template_name.items():
+                print('Removing %s unused args of %s' % (len(dead_arg_indexes), template_name))
+        ConfigurationKnobs.dead_template_args_removed_counter += sum(len(dead_arg_indexes)
+                                                                     for dead_arg_indexes in dead_arg_indexes_by_template_name.values())
+
+        header = _RemoveDeadArgsFromTemplateInstantiations(dead_arg_indexes_by_template_name).transform_header(header)
@@ -0,0 +1,101 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from _py2tmp.ir0 import ir, Transformation, select1st_literal
+from _py2tmp.ir0_optimization._compute_non_expanded_variadic_vars import compute_non_expanded_variadic_vars
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+
+
+def _get_wrapper_args(expr: ir.Expr, template_name_prefix: str):
+    if (isinstance(expr, ir.ClassMemberAccess)
+            and expr.member_name == 'value'
+            and isinstance(expr.expr, ir.TemplateInstantiation)
+            and isinstance(expr.expr.template_expr, ir.AtomicTypeLiteral)
+            and not expr.expr.template_expr.is_local
+            and expr.expr.template_expr.cpp_type.startswith(template_name_prefix)):
+        return expr.expr.args
+    return None
+
+def _carries_all_dependencies_of(expr: ir.Expr, dependency: ir.Expr):
+    # Returns true if replacing a wrapper of `expr` that depends on `dependency` with just `expr` keeps the same
+    # dependent-ness and the same non-expanded variadic vars (so that an enclosing pack expansion still expands over
+    # the same packs).
+    if not isinstance(dependency, ir.AtomicTypeLiteral):
+        # The wrapper might be the only place where `dependency` gets instantiated, we don't remove it.
+        return False
+    free_var_names = {var.cpp_type for var in expr.get_free_vars()}
+    return (all(var.cpp_type in free_var_names
+                for var in dependency.get_free_vars())
+            and set(compute_non_expanded_variadic_vars(dependency).keys())
+                    <= set(compute_non_expanded_variadic_vars(expr).keys()))
+
+class _DependencyWrapperEliminationTransformation(Transformation):
+    def transform_class_member_access(self, class_member_access: ir.ClassMemberAccess):
+        class_member_access = super().transform_class_member_access(class_member_access)
+        args = _get_wrapper_args(class_member_access, 'Select1st')
+        if not args or len(args) != 2:
+            return class_member_access
+        lhs, rhs = args
+
+        # Select1st*<X, Y>::value -> X
+        # if X already depends on Y (and on any variadic var in Y).
+        if _carries_all_dependencies_of(lhs, rhs):
+            ConfigurationKnobs.eliminated_dependency_wrappers_counter += 1
+            return lhs
+
+        # Select1st*<Select1st*<X, Y>::value, Z>::value -> Select1st*<X, Z>::value
+        # if Z already depends on Y.
+        inner_args = _get_wrapper_args(lhs, 'Select1st')
+        if inner_args and len(inner_args) == 2:
+            inner_lhs, inner_rhs = inner_args
+            if _carries_all_dependencies_of(rhs, inner_rhs):
+                ConfigurationKnobs.eliminated_dependency_wrappers_counter += 1
+                return ir.ClassMemberAccess(class_type_expr=ir.TemplateInstantiation(template_expr=select1st_literal(inner_lhs.expr_type, rhs.expr_type),
+                                                                                     args=[inner_lhs, rhs],
+                                                                                     instantiation_might_trigger_static_asserts=False),
+                                            member_type=inner_lhs.expr_type,
+                                            member_name='value')
+
+        return class_member_access
+
+    def transform_bool_binary_op_expr(self, binary_op: ir.BoolBinaryOpExpr):
+        binary_op = super().transform_bool_binary_op_expr(binary_op)
+        assert isinstance(binary_op, ir.BoolBinaryOpExpr)
+        if binary_op.op != '&&':
+            return binary_op
+
+        # AlwaysTrueFrom*<Y>::value && X -> X
+        # X && AlwaysTrueFrom*<Y>::value -> X
+        # if X already depends on Y.
+        for always_true_expr, expr in ((binary_op.lhs, binary_op.rhs), (binary_op.rhs, binary_op.lhs)):
+            args = _get_wrapper_args(always_true_expr, 'AlwaysTrueFrom')
+            if args and len(args) == 1 and _carries_all_dependencies_of(expr, args[0]):
+                ConfigurationKnobs.eliminated_dependency_wrappers_counter += 1
+                return expr
+
+        return binary_op
+
+# Removes the Select1st* and AlwaysTrueFrom* wrappers (added e.g. when inlining a template instantiation, to keep the
+# result dependent on a template arg or to keep it variadic in a pack expansion) when the wrapped expression already
+# depends on the same variables, e.g.:
+#
+# Select1stTypeType<F<Ts>, Ts>::value...
+#
+# becomes:
+#
+# F<Ts>...
+#
+# This saves a C++ template instantiation for each wrapper (and, in a pack expansion, for each element of the pack).
+def eliminate_redundant_dependency_wrappers(header: ir.Header) -> ir.Header:
+    return _DependencyWrapperEliminationTransformation().transform_header(header)
@@ -0,0 +1,194 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from collections import defaultdict
+from typing import Dict, Iterator, Set, List, Optional, Iterable
+
+import networkx as nx
+
+from _py2tmp.compiler.stages import expr_to_cpp_simple
+from _py2tmp.ir0 import ir, Transformation, Visitor, compute_template_dependency_graph
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+
+_CPP_TOKEN_REGEX = re.compile(r'[A-Za-z_][A-Za-z_0-9]*|[0-9]+|::|\S')
+
+def _count_cpp_tokens(expr: ir.Expr):
+    return len(_CPP_TOKEN_REGEX.findall(expr_to_cpp_simple(expr)))
+
+class _CountHoistableExprs(Visitor):
+    def __init__(self, toplevel_names: Set[str]):
+        self.toplevel_names = toplevel_names
+        self.num_occurrences_by_expr: Dict[ir.Expr, int] = defaultdict(lambda: 0)
+        self.template_names_by_expr: Dict[ir.Expr, Set[str]] = defaultdict(set)
+        self.current_template_name: Optional[str] = None
+        # Whether the current expr (and all its subexpressions visited so far) can be moved to namespace scope.
+        self.is_current_expr_non_dependent = True
+
+    def visit_template_defn(self, template_defn: ir.TemplateDefn):
+        self.current_template_name = template_defn.name
+        super().visit_template_defn(template_defn)
+        self.current_template_name = None
+
+    def visit_pattern(self, expr: ir.Expr):
+        # Exprs in patterns can't be replaced with an alias.
+        pass
+
+    def visit_expr(self, expr: ir.Expr):
+        is_parent_expr_non_dependent = self.is_current_expr_non_dependent
+        self.is_current_expr_non_dependent = not (isinstance(expr, ir.VariadicTypeExpansion)
+                                                  or (isinstance(expr, ir.AtomicTypeLiteral)
+                                                      and (expr.is_local or expr.cpp_type in self.toplevel_names)))
+        super().visit_expr(expr)
+
+        # We only hoist types that are just named (e.g. "F<int>", not "F<int>::type"). Naming a template instantiation
+        # doesn't instantiate it, so moving it to namespace scope doesn't change which static_assert()s are triggered.
+        if (self.is_current_expr_non_dependent
+                and isinstance(expr, ir.TemplateInstantiation)
+                and isinstance(expr.expr_type, ir.TypeType)):
+            self.num_occurrences_by_expr[expr] += 1
+            if self.current_template_name is not None:
+                self.template_names_by_expr[expr].add(self.current_template_name)
+
+        self.is_current_expr_non_dependent &= is_parent_expr_non_dependent
+
+class _ReplaceExprs(Transformation):
+    def __init__(self, replacement_by_expr: Dict[ir.Expr, ir.Expr]):
+        super().__init__()
+        self.replacement_by_expr = replacement_by_expr
+
+    def transform_pattern(self, expr: ir.Expr):
+        return expr
+
+    def transform_expr(self, expr: ir.Expr):
+        replacement = self.replacement_by_expr.get(expr)
+        if replacement is not None:
+            return replacement
+        return super().transform_expr(expr)
+
+def _get_referenced_identifiers_expanding_aliases(expr: ir.Expr, alias_by_name: Dict[str, ir.Typedef]) -> Iterable[str]:
+    for identifier in expr.get_referenced_identifiers():
+        if identifier in alias_by_name:
+            yield from _get_referenced_identifiers_expanding_aliases(alias_by_name[identifier].expr, alias_by_name)
+        else:
+            yield identifier
+
+def _sort_aliases(aliases: List[ir.Typedef]):
+    # Returns the aliases in an order where each alias is defined before the aliases that reference it.
+    alias_by_name = {alias.name: alias
+                     for alias in aliases}
+    result = []
+    visited_alias_names = set()
+    def visit(alias: ir.Typedef):
+        if alias.name in visited_alias_names:
+            return
+        visited_alias_names.add(alias.name)
+        for identifier in alias.expr.get_referenced_identifiers():
+            if identifier in alias_by_name:
+                visit(alias_by_name[identifier])
+        result.append(alias)
+    for alias in aliases:
+        visit(alias)
+    return result
+
+# Hoists non-dependent type exprs (e.g. "std::is_same<int, float>") that appear multiple times in a linked header into
+# namespace-scope "using" aliases, when that reduces the number of emitted tokens.
+# This is a global value numbering: IR0 exprs are compared structurally, so all equal exprs get the same alias.
+def hoist_common_subexpressions(header: ir.Header, identifier_generator: Iterator[str]) -> ir.Header:
+    template_defn_by_name = {template_defn.name: template_defn
+                             for template_defn in header.template_defns}
+    template_dependency_graph_transitive_closure = nx.transitive_closure(
+        compute_template_dependency_graph(header.template_defns, template_defn_by_name))
+
+    # Exprs that reference toplevel defns (including alias templates) are not hoisted, otherwise we'd need to order the
+    # aliases and the toplevel defns.
+    toplevel_names = {elem.name
+                      for elem in header.toplevel_content
+                      if isinstance(elem, (ir.ConstantDef, ir.Typedef))}
+    # We leave the alias templates (see convert_templates_to_alias_templates()) unchanged, for the same reason.
+    alias_templates = [elem
+                       for elem in header.toplevel_content
+                       if isinstance(elem, ir.Typedef) and elem.template_args]
+    original_header = header
+    header = ir.Header(template_defns=header.template_defns,
+                       toplevel_content=[elem
+                                         for elem in header.toplevel_content
+                                         if not (isinstance(elem, ir.Typedef) and elem.template_args)],
+                       public_names=header.public_names,
+                       split_template_name_by_old_name_and_result_element_name=header.split_template_name_by_old_name_and_result_element_name,
+                       check_if_error_specializations=header.check_if_error_specializations)
+    aliases: List[ir.Typedef] = []
+    alias_by_name: Dict[str, ir.Typedef] = dict()
+
+    # Each iteration reduces the number of tokens, so this terminates. We need more than 1 iteration when the hoisted
+    # exprs have subexpressions that are also worth hoisting.
+    while True:
+        visitor = _CountHoistableExprs(toplevel_names)
+        visitor.visit_header(header)
+        for alias in aliases:
+            visitor.visit_typedef(alias)
+
+        exprs_to_hoist = []
+        for expr, num_occurrences in visitor.num_occurrences_by_expr.items():
+            num_tokens = _count_cpp_tokens(expr)
+            # "using X = <expr>;" costs 4 tokens more than the expr, and then each occurrence costs 1 token.
+            if num_occurrences * num_tokens <= num_occurrences + num_tokens + 4:
+                continue
+            referenced_template_names = {identifier
+                                         for identifier in _get_referenced_identifiers_expanding_aliases(expr, alias_by_name)
+                                         if identifier in template_defn_by_name}
+            if any(template_name in referenced_template_names
+                   or any(template_dependency_graph_transitive_closure.has_edge(referenced_template_name, template_name)
+                          for referenced_template_name in referenced_template_names)
+                   for template_name in visitor.template_names_by_expr[expr]):
+                # The alias would need to be defined both before and after some template that uses it.
+                continue
+            exprs_to_hoist.append((expr, num_occurrences, num_tokens))
+
+        # We don't hoist subexpressions of other exprs that we're hoisting in the same iteration, since the occurrences
+        # in those exprs will be replaced. They'll be considered again in the next iteration.
+        exprs_to_hoist = [(expr, num_occurrences, num_tokens)
+                          for expr, num_occurrences, num_tokens in exprs_to_hoist
+                          if not any(other_expr is not expr and expr in other_expr.get_transitive_subexpressions()
+                                     for other_expr, _, _ in exprs_to_hoist)]
+        if not exprs_to_hoist:
+            break
+
+        replacement_by_expr: Dict[ir.Expr, ir.Expr] = dict()
+        new_aliases = []
+        for expr, num_occurrences, num_tokens in exprs_to_hoist:
+            alias = ir.Typedef(name=next(identifier_generator), expr=expr)
+            new_aliases.append(alias)
+            replacement_by_expr[expr] = ir.AtomicTypeLiteral.for_nonlocal_type(alias.name, may_be_alias=True)
+            ConfigurationKnobs.global_cse_hoisted_exprs_counter += 1
+            ConfigurationKnobs.global_cse_saved_tokens_counter += num_occurrences * (num_tokens - 1) - (num_tokens + 4)
+
+        transformation = _ReplaceExprs(replacement_by_expr)
+        header = transformation.transform_header(header)
+        # The existing aliases can contain the newly-hoisted exprs, but only as proper subexpressions.
+        aliases = [ir.Typedef(name=alias.name,
+                              expr=alias.expr.copy_with_subexpressions([transformation.transform_expr(subexpr)
+                                                                        for subexpr in alias.expr.get_direct_subexpressions()]))
+                   for alias in aliases] + new_aliases
+        alias_by_name = {alias.name: alias
+                         for alias in aliases}
+
+    if not aliases:
+        return original_header
+
+    return ir.Header(template_defns=header.template_defns,
+                     toplevel_content=alias_templates + _sort_aliases(aliases) + list(header.toplevel_content),
+                     public_names=header.public_names,
+                     split_template_name_by_old_name_and_result_element_name=header.split_template_name_by_old_name_and_result_element_name,
+                     check_if_error_specializations=header.check_if_error_specializations)
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+from collections import Counter
 from typing import Iterator, Any, Callable, Tuple
 
 import networkx as nx
@@ -20,18 +22,28 @@ from _py2tmp.compiler.output_files import ObjectFileContent
 from _py2tmp.compiler.stages import template_defn_to_cpp_simple, toplevel_elem_to_cpp_simple
 from _py2tmp.ir0 import compute_template_dependency_graph
 from _py2tmp.ir0 import ir
+from _py2tmp.ir0_optimization._alias_template_conversion import convert_templates_to_alias_templates
+from _py2tmp.ir0_optimization._call_site_specialization import specialize_templates_for_constant_args
 from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+from _py2tmp.ir0_optimization._dead_specialization_elimination import remove_unreachable_specializations
+from _py2tmp.ir0_optimization._dead_template_arg_elimination import remove_dead_template_args
+from _py2tmp.ir0_optimization._dependency_wrapper_elimination import eliminate_redundant_dependency_wrappers
+from _py2tmp.ir0_optimization._global_common_subexpression_elimination import hoist_common_subexpressions
 from _py2tmp.ir0_optimization._local_optimizations import perform_local_optimizations_on_template_defn, \
     perform_local_optimizations_on_toplevel_elems
 from _py2tmp.ir0_optimization._optimization_execution import apply_elem_optimization, describe_template_defns, \
     combine_optimizations, optimize_list, describe_headers
+from _py2tmp.ir0_optimization._partial_evaluation import evaluate_closed_toplevel_elems
+from _py2tmp.ir0_optimization._recursion_to_pack_expansion import rewrite_list_recursion_as_pack_expansion
 from _py2tmp.ir0_optimization._recalculate_template_instantiation_can_trigger_static_asserts_info import \
     recalculate_template_instantiation_can_trigger_static_asserts_info
 from _py2tmp.ir0_optimization._remove_unused_toplevel_elems import remove_unused_toplevel_elems
 from _py2tmp.ir0_optimization._split_template_defn_with_multiple_outputs import \
     split_template_defn_with_multiple_outputs, replace_metafunction_calls_with_split_template_calls
+from _py2tmp.ir0_optimization._template_deduplication import merge_equivalent_template_defns
 from _py2tmp.ir0_optimization._template_instantiation_inlining import perform_template_inlining, \
     perform_template_inlining_on_toplevel_elems
+from _py2tmp.ir0_optimization._unify import clear_unification_cache
 from _py2tmp.ir0_optimization.replace_templates_with_templated_using_declarations import \
     move_template_args_to_using_declarations
 from _py2tmp.utils import compute_condensation_in_topological_order
@@ -99,14 +111,31 @@ def _optimize_header_second_pass(header: ir.Header,
     template_dependency_graph_transitive_closure = nx.transitive_closure(template_dependency_graph)
     assert isinstance(template_dependency_graph_transitive_closure, nx.DiGraph)
 
+    # Inlining a recursive template into toplevel elems unrolls the recursion by one level in each loop, and if the
+    # recursion is not linear (e.g. after rewrite_counting_recursion_with_logarithmic_depth()) the size of the result
+    # can double in each loop. Closed toplevel elems that use recursive templates are instead handled by
+    # evaluate_closed_toplevel_elems().
+    recursive_template_names = {template_name
+                                for connected_component in compute_condensation_in_topological_order(template_dependency_graph)
+                                for template_name in connected_component
+                                if len(connected_component) > 1 or template_dependency_graph.has_edge(template_name, template_name)}
+
+    # This is used by the inlining cost model. It's computed once for the whole pass, so it's just an estimate.
+    num_references_by_template_name = Counter(identifier
+                                              for elem in itertools.chain(header.template_defns, header.toplevel_content)
+                                              for identifier in elem.get_referenced_identifiers()
+                                              if identifier in new_template_defns)
+
     optimizations = [
+        lambda template_defn: rewrite_list_recursion_as_pack_expansion(template_defn),
         lambda template_defn: perform_template_inlining(template_defn,
                                                         {other_node
                                                          for other_node in template_dependency_graph_transitive_closure.successors(template_defn.name)
                                                          if not template_dependency_graph_transitive_closure.has_edge(other_node, template_defn.name)},
                                                         new_template_defns,
                                                         identifier_generator,
-                                                        context_object_file_content),
+                                                        context_object_file_content,
+                                                        num_references_by_template_name),
         lambda template_defn: perform_local_optimizations_on_template_defn(template_defn,
                                                                            identifier_generator,
                                                                            inline_template_instantiations_with_multiple_references=False),
@@ -129,10 +158,11 @@ def _optimize_header_second_pass(header: ir.Header,
 
     optimizations = [
         lambda toplevel_content: perform_template_inlining_on_toplevel_elems(toplevel_content,
-                                                                             new_template_defns.keys(),
+                                                                             new_template_defns.keys() - recursive_template_names,
                                                                              new_template_defns,
                                                                              identifier_generator,
-                                                                             context_object_file_content),
+                                                                             context_object_file_content,
+                                                                             num_references_by_template_name),
         lambda toplevel_content: perform_local_optimizations_on_toplevel_elems(toplevel_content,
                                                                                identifier_generator,
                                                                                inline_template_instantiations_with_multiple_references=False),
@@ -160,6 +190,21 @@ def optimize_header(header: ir.Header,
                     context_object_file_content: ObjectFileContent,
                     identifier_generator: Iterator[str],
                     linking_final_header: bool):
+    clear_unification_cache()
+    ConfigurationKnobs.global_cse_hoisted_exprs_counter = 0
+    ConfigurationKnobs.global_cse_saved_tokens_counter = 0
+    ConfigurationKnobs.merged_template_defns_counter = 0
+    ConfigurationKnobs.partial_evaluation_removed_static_asserts_counter = 0
+    ConfigurationKnobs.call_site_specialization_templates_counter = 0
+    ConfigurationKnobs.recursion_to_pack_expansion_counter = 0
+    ConfigurationKnobs.dead_specializations_removed_counter = 0
+    ConfigurationKnobs.dead_template_args_removed_counter = 0
+    ConfigurationKnobs.alias_templates_counter = 0
+    ConfigurationKnobs.eliminated_dependency_wrappers_counter = 0
+    ConfigurationKnobs.inlined_template_instantiations_counter = 0
+    ConfigurationKnobs.template_instantiations_not_inlined_due_to_cost_counter = 0
+    ConfigurationKnobs.inlining_estimated_compile_cost_delta_counter = 0.0
+
     if linking_final_header:
         # This is just a performance optimization. Notably this removes any unused builtins, to avoid wasting time
         # optimizing those.
@@ -168,13 +213,89 @@ def optimize_header(header: ir.Header,
     header = recalculate_template_instantiation_can_trigger_static_asserts_info(header)
     header = _optimize_header_first_pass(header, identifier_generator, context_object_file_content)
     header = _optimize_header_second_pass(header, identifier_generator, context_object_file_content)
+    [header], _ = apply_elem_optimization([header],
+                                          lambda: ([specialize_templates_for_constant_args(header, identifier_generator)], False),
+                                          lambda headers: describe_headers(headers, identifier_generator),
+                                          optimization_name='specialize_templates_for_constant_args()',
+                                          other_context=lambda: '')
+    # This is after the other passes, so that we evaluate the optimized templates. It's before the third pass, so that
+    # any template that was only used by the elems that we evaluate gets removed.
+    [header], _ = apply_elem_optimization([header],
+                                          lambda: ([evaluate_closed_toplevel_elems(header, context_object_file_content)], False),
+                                          lambda headers: describe_headers(headers, identifier_generator),
+                                          optimization_name='evaluate_closed_toplevel_elems()',
+                                          other_context=lambda: '')
+    # This is after all the optimizations that might add Select1st* wrappers, and before the third pass so that any
+    # wrapper template that is no longer used gets removed.
+    [header], _ = apply_elem_optimization([header],
+                                          lambda: ([eliminate_redundant_dependency_wrappers(header)], False),
+                                          lambda headers: describe_headers(headers, identifier_generator),
+                                          optimization_name='eliminate_redundant_dependency_wrappers()',
+                                          other_context=lambda: '')
+    if linking_final_header:
+        # Only when linking we know all the instantiations of the templates. This is before the third pass, so that any
+        # template that was only used in the removed specializations gets removed.
+        [header], _ = apply_elem_optimization([header],
+                                              lambda: ([remove_unreachable_specializations(header)], False),
+                                              lambda headers: describe_headers(headers, identifier_generator),
+                                              optimization_name='remove_unreachable_specializations()',
+                                              other_context=lambda: '')
+        # This is after remove_unreachable_specializations(), since the removed specializations might have been the only
+        # ones using some template args.
+        [header], _ = apply_elem_optimization([header],
+                                              lambda: ([remove_dead_template_args(header)], False),
+                                              lambda headers: describe_headers(headers, identifier_generator),
+                                              optimization_name='remove_dead_template_args()',
+                                              other_context=lambda: '')
     header = _optimize_header_third_pass(header, linking_final_header)
 
     if linking_final_header:
+        # Only when linking we can see all the templates from the various modules, and know that no other module will
+        # reference the ones that we remove.
+        [header], _ = apply_elem_optimization([header],
+                                              lambda: ([merge_equivalent_template_defns(header)], False),
+                                              lambda headers: describe_headers(headers, identifier_generator),
+                                              optimization_name='merge_equivalent_template_defns()',
+                                              other_context=lambda: '')
+        [header], _ = apply_elem_optimization([header],
+                                              lambda: ([convert_templates_to_alias_templates(header)], False),
+                                              lambda headers: describe_headers(headers, identifier_generator),
+                                              optimization_name='convert_templates_to_alias_templates()',
+                                              other_context=lambda: '')
         [header], _ = apply_elem_optimization([header],
                                               lambda: ([move_template_args_to_using_declarations(header)], False),
                                               lambda headers: describe_headers(headers, identifier_generator),
                                               optimization_name='replace_templates_with_templated_using_declarations',
                                               other_context=lambda: '')
+        # This must be the last optimization: the aliases that it introduces hide the template instantiations from the
+        # other optimizations.
+        [header], _ = apply_elem_optimization([header],
+                                              lambda: ([hoist_common_subexpressions(header, identifier_generator)], False),
+                                              lambda headers: describe_headers(headers, identifier_generator),
+                                              optimization_name='hoist_common_subexpressions()',
+                                              other_context=lambda: '')
+
+    if ConfigurationKnobs.verbose:
+        num_unifications = ConfigurationKnobs.unification_cache_hit_counter + ConfigurationKnobs.unification_cache_miss_counter
+        print('Unification cache: %s hits, %s misses (hit rate: %.1f%%)' % (
+            ConfigurationKnobs.unification_cache_hit_counter,
+            ConfigurationKnobs.unification_cache_miss_counter,
+            100.0 * ConfigurationKnobs.unification_cache_hit_counter / num_unifications if num_unifications else 0.0))
+        print('Template inlining: inlined %s instantiations (estimated compile cost delta: %+.1f), %s not inlined due to their cost' % (
+            ConfigurationKnobs.inlined_template_instantiations_counter,
+            ConfigurationKnobs.inlining_estimated_compile_cost_delta_counter,
+            ConfigurationKnobs.template_instantiations_not_inlined_due_to_cost_counter))
+        print('Recursion to pack expansion: rewrote %s templates' % ConfigurationKnobs.recursion_to_pack_expansion_counter)
+        print('Call-site specialization: created %s specialized templates' % ConfigurationKnobs.call_site_specialization_templates_counter)
+        print('Partial evaluation: removed %s static_asserts' % ConfigurationKnobs.partial_evaluation_removed_static_asserts_counter)
+        print('Dependency wrapper elimination: removed %s wrappers' % ConfigurationKnobs.eliminated_dependency_wrappers_counter)
+        if linking_final_header:
+            print('Dead specialization elimination: removed %s specializations' % ConfigurationKnobs.dead_specializations_removed_counter)
+            print('Dead template arg elimination: removed %s template params' % ConfigurationKnobs.dead_template_args_removed_counter)
+            print('Template deduplication: merged %s templates' % ConfigurationKnobs.merged_template_defns_counter)
+            print('Alias template conversion: converted %s templates' % ConfigurationKnobs.alias_templates_counter)
+            print('Global CSE: hoisted %s exprs into aliases, saving %s emitted tokens' % (
+                ConfigurationKnobs.global_cse_hoisted_exprs_counter,
+                ConfigurationKnobs.global_cse_saved_tokens_counter))
 
     return header
@@ -0,0 +1,290 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+from typing import Dict, Tuple, Mapping, List
+
+from _py2tmp.compiler.output_files import ObjectFileContent
+from _py2tmp.ir0 import ir
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+from _py2tmp.ir0_optimization._replace_var_with_expr import replace_var_with_expr_in_template_body_elements, \
+    VariadicVarReplacementNotPossibleException
+from _py2tmp.ir0_optimization._template_instantiation_inlining import get_values_by_pattern_variable_name, \
+    TEMPLATE_DEFNS_DEFINED_AS_IR0
+from _py2tmp.ir0_optimization._unify import find_matches_in_unification_of_template_instantiation_with_definition
+
+_INT64_MIN = -2**63
+_INT64_MAX = 2**63 - 1
+
+_TYPE_EXPRS_THAT_CANT_BE_WRAPPED_BY = {
+    ir.PointerTypeExpr: (ir.ReferenceTypeExpr, ir.RvalueReferenceTypeExpr),
+    ir.ReferenceTypeExpr: (ir.ReferenceTypeExpr, ir.RvalueReferenceTypeExpr),
+    ir.RvalueReferenceTypeExpr: (ir.ReferenceTypeExpr, ir.RvalueReferenceTypeExpr),
+    ir.ConstTypeExpr: (ir.ReferenceTypeExpr, ir.RvalueReferenceTypeExpr, ir.ConstTypeExpr, ir.ArrayTypeExpr, ir.FunctionTypeExpr),
+    ir.ArrayTypeExpr: (ir.ReferenceTypeExpr, ir.RvalueReferenceTypeExpr, ir.FunctionTypeExpr),
+    ir.FunctionTypeExpr: (ir.ConstTypeExpr, ir.ArrayTypeExpr, ir.FunctionTypeExpr),
+}
+
+class _EvaluationNotPossibleException(Exception):
+    pass
+
+def _check_int64(value: int):
+    # In C++ an overflow in a constant expression is a compilation error, so we leave it to the C++ compiler to report.
+    if not _INT64_MIN <= value <= _INT64_MAX:
+        raise _EvaluationNotPossibleException('Overflow in int64 arithmetic')
+    return ir.Literal(value)
+
+def _divide_int64(lhs: int, rhs: int):
+    # Unlike Python's "//", C++ division truncates towards zero.
+    if rhs == 0:
+        raise _EvaluationNotPossibleException('Division by zero')
+    quotient = abs(lhs) // abs(rhs)
+    return quotient if (lhs < 0) == (rhs < 0) else -quotient
+
+class _Evaluator:
+    def __init__(self, template_defn_by_name: Mapping[str, ir.TemplateDefn]):
+        self.template_defn_by_name = template_defn_by_name
+        # The unification only uses these for temporary renames. We don't use the global identifier generator so that
+        # the evaluation doesn't affect the names in the generated code.
+        self.identifier_generator = ('TmppyPartialEvaluation_%s' % i for i in itertools.count())
+        # Values of the toplevel ConstantDefs/Typedefs evaluated so far.
+        self.value_by_toplevel_name: Dict[str, ir.Expr] = dict()
+        # Values of the members of the template instantiations evaluated so far (as in C++, each template is only
+        # instantiated once with each set of args).
+        self.member_value_by_name_by_instantiation: Dict[Tuple[str, Tuple[ir.Expr, ...]], Dict[str, ir.Expr]] = dict()
+        self.remaining_steps = 0
+        self.depth = 0
+
+    def evaluate_toplevel_expr(self, expr: ir.Expr):
+        self.remaining_steps = ConfigurationKnobs.partial_evaluation_max_steps
+        self.depth = 0
+        return self.evaluate_expr(expr, dict())
+
+    def evaluate_expr(self, expr: ir.Expr, value_by_local_name: Mapping[str, ir.Expr]) -> ir.Expr:
+        self.remaining_steps -= 1
+        if self.remaining_steps < 0:
+            raise _EvaluationNotPossibleException('Reached the max number of evaluation steps')
+
+        if isinstance(expr, ir.Literal):
+            return expr
+        elif isinstance(expr, ir.AtomicTypeLiteral):
+            return self._evaluate_type_literal(expr, value_by_local_name)
+        elif isinstance(expr, ir.ClassMemberAccess):
+            return self._evaluate_class_member_access(expr, value_by_local_name)
+        elif isinstance(expr, ir.NotExpr):
+            return ir.Literal(not self._evaluate_to_literal_value(expr.expr, value_by_local_name))
+        elif isinstance(expr, ir.UnaryMinusExpr):
+            return _check_int64(-self._evaluate_to_literal_value(expr.expr, value_by_local_name))
+        elif isinstance(expr, ir.ComparisonExpr):
+            return self._evaluate_comparison_expr(expr, value_by_local_name)
+        elif isinstance(expr, ir.Int64BinaryOpExpr):
+            return self._evaluate_int64_binary_op_expr(expr, value_by_local_name)
+        elif isinstance(expr, ir.BoolBinaryOpExpr):
+            # There's no short-circuiting here: even when the result is determined by the lhs, the C++ compiler
+            # instantiates the templates used in the rhs (and that might trigger static_asserts).
+            lhs = self._evaluate_to_literal_value(expr.lhs, value_by_local_name)
+            rhs = self._evaluate_to_literal_value(expr.rhs, value_by_local_name)
+            return ir.Literal((lhs and rhs) if expr.op == '&&' else (lhs or rhs))
+        elif isinstance(expr, ir.TemplateInstantiation):
+            return self._evaluate_template_instantiation(expr, value_by_local_name)
+        elif isinstance(expr, (ir.PointerTypeExpr, ir.ReferenceTypeExpr, ir.RvalueReferenceTypeExpr, ir.ConstTypeExpr,
+                               ir.ArrayTypeExpr, ir.FunctionTypeExpr)):
+            return self._evaluate_type_expr(expr, value_by_local_name)
+        elif isinstance(expr, ir.VariadicTypeExpansion):
+            raise _EvaluationNotPossibleException('Variadic type expansions are not supported')
+        else:
+            raise NotImplementedError('Unexpected expr: ' + expr.__class__.__name__)
+
+    def _evaluate_to_literal_value(self, expr: ir.Expr, value_by_local_name: Mapping[str, ir.Expr]):
+        result = self.evaluate_expr(expr, value_by_local_name)
+        if not isinstance(result, ir.Literal):
+            raise _EvaluationNotPossibleException('Expected a literal')
+        return result.value
+
+    def _evaluate_type_literal(self, type_literal: ir.AtomicTypeLiteral, value_by_local_name: Mapping[str, ir.Expr]):
+        if type_literal.is_local:
+            value = value_by_local_name.get(type_literal.cpp_type)
+        else:
+            value = self.value_by_toplevel_name.get(type_literal.cpp_type)
+            if value is None and type_literal.expr_type.kind in (ir.ExprKind.TYPE, ir.ExprKind.TEMPLATE):
+                # This is a type/template defined outside the header (e.g. "int" or "std::vector") or a template
+                # defined in the header. Both are already values.
+                value = type_literal
+        if value is None:
+            raise _EvaluationNotPossibleException('Unknown value for %s' % type_literal.cpp_type)
+        return value
+
+    def _evaluate_comparison_expr(self, comparison: ir.ComparisonExpr, value_by_local_name: Mapping[str, ir.Expr]):
+        lhs = self._evaluate_to_literal_value(comparison.lhs, value_by_local_name)
+        rhs = self._evaluate_to_literal_value(comparison.rhs, value_by_local_name)
+        return ir.Literal({
+            '==': lambda: lhs == rhs,
+            '!=': lambda: lhs != rhs,
+            '<': lambda: lhs < rhs,
+            '>': lambda: lhs > rhs,
+            '<=': lambda: lhs <= rhs,
+            '>=': lambda: lhs >= rhs,
+        }[comparison.op]())
+
+    def _evaluate_int64_binary_op_expr(self, binary_op: ir.Int64BinaryOpExpr, value_by_local_name: Mapping[str, ir.Expr]):
+        lhs = self._evaluate_to_literal_value(binary_op.lhs, value_by_local_name)
+        rhs = self._evaluate_to_literal_value(binary_op.rhs, value_by_local_name)
+        if binary_op.op == '+':
+            return _check_int64(lhs + rhs)
+        elif binary_op.op == '-':
+            return _check_int64(lhs - rhs)
+        elif binary_op.op == '*':
+            return _check_int64(lhs * rhs)
+        elif binary_op.op == '/':
+            return _check_int64(_divide_int64(lhs, rhs))
+        elif binary_op.op == '%':
+            return _check_int64(lhs - rhs * _divide_int64(lhs, rhs))
+        else:
+            raise NotImplementedError('Unexpected op: ' + binary_op.op)
+
+    def _evaluate_type_expr(self, expr: ir.Expr, value_by_local_name: Mapping[str, ir.Expr]):
+        subexpressions = [self.evaluate_expr(subexpr, value_by_local_name)
+                          for subexpr in expr.get_direct_subexpressions()]
+        # E.g. "T&" with T=int& is int& (due to reference collapsing), not "int& &", and "void(T)" with T=int[3] is
+        # void(int*). We don't try to normalize these, we leave them to the C++ compiler.
+        for subexpr in subexpressions:
+            if isinstance(subexpr, _TYPE_EXPRS_THAT_CANT_BE_WRAPPED_BY[expr.__class__]):
+                raise _EvaluationNotPossibleException('Unsupported type composition')
+        return expr.copy_with_subexpressions(subexpressions)
+
+    def _evaluate_template_instantiation(self,
+                                         template_instantiation: ir.TemplateInstantiation,
+                                         value_by_local_name: Mapping[str, ir.Expr]):
+        template_expr = self.evaluate_expr(template_instantiation.template_expr, value_by_local_name)
+        assert isinstance(template_expr, ir.AtomicTypeLiteral)
+        if template_expr.may_be_alias:
+            # An alias template might expand to something that's not a template instantiation.
+            raise _EvaluationNotPossibleException('Instantiation of a template that might be an alias')
+        # Naming a template instantiation doesn't instantiate it, so this is already a value.
+        return ir.TemplateInstantiation(template_expr=template_expr,
+                                        args=[self.evaluate_expr(arg, value_by_local_name)
+                                              for arg in template_instantiation.args],
+                                        instantiation_might_trigger_static_asserts=template_instantiation.instantiation_might_trigger_static_asserts)
+
+    def _evaluate_class_member_access(self,
+                                      class_member_access: ir.ClassMemberAccess,
+                                      value_by_local_name: Mapping[str, ir.Expr]):
+        template_instantiation = class_member_access.expr
+        if not isinstance(template_instantiation, ir.TemplateInstantiation):
+            raise _EvaluationNotPossibleException('Member access on something other than a template instantiation')
+        template_instantiation = self._evaluate_template_instantiation(template_instantiation, value_by_local_name)
+        assert isinstance(template_instantiation, ir.TemplateInstantiation)
+
+        member_value_by_name = self._instantiate_template(template_instantiation)
+        value = member_value_by_name.get(class_member_access.member_name)
+        if value is None:
+            raise _EvaluationNotPossibleException('Unknown member: %s' % class_member_access.member_name)
+        return value
+
+    def _instantiate_template(self, template_instantiation: ir.TemplateInstantiation):
+        assert isinstance(template_instantiation.template_expr, ir.AtomicTypeLiteral)
+        template_name = template_instantiation.template_expr.cpp_type
+        cache_key = (template_name, tuple(template_instantiation.args))
+        member_value_by_name = self.member_value_by_name_by_instantiation.get(cache_key)
+        if member_value_by_name is not None:
+            return member_value_by_name
+
+        template_defn = self.template_defn_by_name.get(template_name)
+        if template_defn is None:
+            raise _EvaluationNotPossibleException('Unknown template: %s' % template_name)
+        if self.depth >= ConfigurationKnobs.partial_evaluation_max_depth:
+            raise _EvaluationNotPossibleException('Reached the max instantiation depth')
+
+        certain_matches, possible_matches = find_matches_in_unification_of_template_instantiation_with_definition(
+            template_instantiation=template_instantiation,
+            local_var_definitions=dict(),
+            template_defn=template_defn,
+            identifier_generator=self.identifier_generator,
+            verbose=ConfigurationKnobs.verbose)
+        if possible_matches or len(certain_matches) != 1:
+            raise _EvaluationNotPossibleException('Could not determine the specialization of %s to use' % template_name)
+        [(specialization, value_by_pattern_variable, value_by_expanded_pattern_variable)] = certain_matches
+        value_by_pattern_variable, value_by_expanded_pattern_variable = get_values_by_pattern_variable_name(
+            value_by_pattern_variable, value_by_expanded_pattern_variable)
+
+        try:
+            body = replace_var_with_expr_in_template_body_elements(specialization.body,
+                                                                   value_by_pattern_variable,
+                                                                   value_by_expanded_pattern_variable)
+        except VariadicVarReplacementNotPossibleException as e:
+            raise _EvaluationNotPossibleException(*e.args)
+
+        # The C++ compiler instantiates all members (not just the one that we need), so we must evaluate all of them
+        # to know that no static_assert fails.
+        self.depth += 1
+        member_value_by_name: Dict[str, ir.Expr] = dict()
+        for elem in body:
+            if isinstance(elem, ir.StaticAssert):
+                if not self._evaluate_to_literal_value(elem.expr, member_value_by_name):
+                    raise _EvaluationNotPossibleException('static_assert failed: %s' % elem.message)
+            elif isinstance(elem, (ir.ConstantDef, ir.Typedef)) and not (isinstance(elem, ir.Typedef) and elem.template_args):
+                member_value_by_name[elem.name] = self.evaluate_expr(elem.expr, member_value_by_name)
+            else:
+                raise _EvaluationNotPossibleException('Unsupported template body element')
+        self.depth -= 1
+
+        self.member_value_by_name_by_instantiation[cache_key] = member_value_by_name
+        return member_value_by_name
+
+# Evaluates the toplevel StaticAsserts, ConstantDefs and Typedefs that don't depend on anything unknown, replacing them
+# with their value (or dropping them, for static_asserts that succeed), so that the C++ compiler doesn't need to
+# instantiate the templates that they use.
+# When an expression can't be evaluated (e.g. because a static_assert fails, it uses templates defined in C++ code or
+# the evaluation takes too many steps) it's left unchanged, and the C++ compiler will evaluate it instead.
+def evaluate_closed_toplevel_elems(header: ir.Header, context_object_file_content: ObjectFileContent) -> ir.Header:
+    template_defn_by_name = {template_defn.name: template_defn
+                             for template_defn in itertools.chain(
+                                 (template_defn
+                                  for module_info in context_object_file_content.modules_by_name.values()
+                                  for template_defn in module_info.ir0_header.template_defns),
+                                 header.template_defns,
+                                 TEMPLATE_DEFNS_DEFINED_AS_IR0)}
+    evaluator = _Evaluator(template_defn_by_name)
+
+    toplevel_content: List[ir.TemplateBodyElement] = []
+    for elem in header.toplevel_content:
+        if isinstance(elem, ir.Typedef) and elem.template_args:
+            toplevel_content.append(elem)
+            continue
+        assert isinstance(elem, (ir.StaticAssert, ir.ConstantDef, ir.Typedef))
+        try:
+            value = evaluator.evaluate_toplevel_expr(elem.expr)
+        except _EvaluationNotPossibleException as e:
+            if ConfigurationKnobs.verbose:
+                print('Could not evaluate toplevel elem: %s' % e.args)
+            toplevel_content.append(elem)
+            continue
+
+        if isinstance(elem, ir.StaticAssert):
+            if value == ir.Literal(True):
+                ConfigurationKnobs.partial_evaluation_removed_static_asserts_counter += 1
+            else:
+                toplevel_content.append(elem)
+        elif isinstance(elem, ir.ConstantDef):
+            evaluator.value_by_toplevel_name[elem.name] = value
+            toplevel_content.append(ir.ConstantDef(name=elem.name, expr=value))
+        else:
+            evaluator.value_by_toplevel_name[elem.name] = value
+            toplevel_content.append(ir.Typedef(name=elem.name, expr=value, description=elem.description))
+
+    return ir.Header(template_defns=header.template_defns,
+                     toplevel_content=toplevel_content,
+                     public_names=header.public_names,
+                     split_template_name_by_old_name_and_result_element_name=header.split_template_name_by_old_name_and_result_element_name,
+                     check_if_error_specializations=header.check_if_error_specializations)
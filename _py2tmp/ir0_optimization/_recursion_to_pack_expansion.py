@@ -0,0 +1,247 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Optional, Tuple, List
+
+from _py2tmp.ir0 import ir, GlobalLiterals
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+from _py2tmp.ir0_optimization._replace_var_with_expr import replace_var_with_expr_in_expr
+
+_LIST_LITERAL_BY_ELEM_KIND = {
+    ir.ExprKind.BOOL: GlobalLiterals.BOOL_LIST,
+    ir.ExprKind.INT64: GlobalLiterals.INT_LIST,
+    ir.ExprKind.TYPE: GlobalLiterals.LIST,
+}
+
+_LIST_CONCAT_TEMPLATE_NAME_BY_LIST_TEMPLATE_NAME = {
+    'BoolList': 'BoolListConcat',
+    'Int64List': 'Int64ListConcat',
+    'List': 'TypeListConcat',
+}
+
+def _is_list_instantiation(expr: ir.Expr):
+    return (isinstance(expr, ir.TemplateInstantiation)
+            and isinstance(expr.template_expr, ir.AtomicTypeLiteral)
+            and expr.template_expr.cpp_type in _LIST_CONCAT_TEMPLATE_NAME_BY_LIST_TEMPLATE_NAME)
+
+def _get_result_expr(specialization: ir.TemplateSpecialization, result_element_name: str) -> Optional[ir.Expr]:
+    if len(specialization.body) != 1:
+        return None
+    [elem] = specialization.body
+    if isinstance(elem, ir.ConstantDef) and elem.name == result_element_name:
+        return elem.expr
+    if isinstance(elem, ir.Typedef) and elem.name == result_element_name and not elem.template_args:
+        return elem.expr
+    return None
+
+def _with_result_expr(specialization: ir.TemplateSpecialization,
+                      result_element_name: str,
+                      args: List[ir.TemplateArgDecl],
+                      patterns: List[ir.Expr],
+                      expr: ir.Expr):
+    if expr.expr_type.kind in (ir.ExprKind.BOOL, ir.ExprKind.INT64):
+        elem = ir.ConstantDef(name=result_element_name, expr=expr)
+    else:
+        elem = ir.Typedef(name=result_element_name, expr=expr)
+    return ir.TemplateSpecialization(args=args,
+                                     patterns=patterns,
+                                     body=[elem],
+                                     is_metafunction=specialization.is_metafunction)
+
+def _is_recursive_call(expr: ir.Expr, template_defn: ir.TemplateDefn, rest_pattern: ir.Expr):
+    # Whether expr is F<L<xs...>>::<result>
+    return (isinstance(expr, ir.ClassMemberAccess)
+            and expr.member_name == template_defn.result_element_names[0]
+            and isinstance(expr.expr, ir.TemplateInstantiation)
+            and isinstance(expr.expr.template_expr, ir.AtomicTypeLiteral)
+            and expr.expr.template_expr.cpp_type == template_defn.name
+            and len(expr.expr.args) == 1
+            and expr.expr.args[0] == rest_pattern)
+
+def _expand(elem_expr: ir.Expr, first_var: ir.AtomicTypeLiteral, rest_var: ir.AtomicTypeLiteral):
+    # E(x) => E(xs)...
+    return ir.VariadicTypeExpansion(replace_var_with_expr_in_expr(elem_expr, {first_var.cpp_type: rest_var}, dict()))
+
+def _list_of(elem_kind: ir.ExprKind, *args: ir.Expr):
+    return ir.TemplateInstantiation(template_expr=_LIST_LITERAL_BY_ELEM_KIND[elem_kind],
+                                    args=args,
+                                    instantiation_might_trigger_static_asserts=False)
+
+def _all_true(elem_exprs: ir.Expr, value: bool):
+    # std::is_same<BoolList<bs..., value>, BoolList<value, bs...>>::value
+    # This is true iff all bs are equal to value, without any recursion.
+    return ir.ClassMemberAccess(class_type_expr=ir.TemplateInstantiation(template_expr=GlobalLiterals.STD_IS_SAME,
+                                                                         args=[_list_of(ir.ExprKind.BOOL, elem_exprs, ir.Literal(value)),
+                                                                               _list_of(ir.ExprKind.BOOL, ir.Literal(value), elem_exprs)],
+                                                                         instantiation_might_trigger_static_asserts=False),
+                                member_name='value',
+                                member_type=ir.BoolType())
+
+def _fold_to_pack_expansion(step_expr: ir.Expr,
+                            base_expr: ir.Expr,
+                            template_defn: ir.TemplateDefn,
+                            first_var: ir.AtomicTypeLiteral,
+                            rest_var: ir.AtomicTypeLiteral,
+                            rest_pattern: ir.Expr) -> Optional[ir.Expr]:
+    if isinstance(step_expr, (ir.BoolBinaryOpExpr, ir.Int64BinaryOpExpr)):
+        if _is_recursive_call(step_expr.rhs, template_defn, rest_pattern):
+            elem_expr = step_expr.lhs
+        elif _is_recursive_call(step_expr.lhs, template_defn, rest_pattern) and step_expr.op in ('&&', '||'):
+            # For the boolean operators we don't care about the evaluation order.
+            elem_expr = step_expr.rhs
+        else:
+            return None
+        if elem_expr.references_any_of({template_defn.name, rest_var.cpp_type}):
+            return None
+        elem_exprs = _expand(elem_expr, first_var, rest_var)
+
+        if step_expr.op == '&&':
+            # all(E(xs)...) && base
+            result = _all_true(elem_exprs, True)
+            if base_expr != ir.Literal(True):
+                result = ir.BoolBinaryOpExpr(lhs=result, rhs=base_expr, op='&&')
+            return result
+        if step_expr.op == '||':
+            # any(E(xs)...) || base
+            result = ir.NotExpr(_all_true(elem_exprs, False))
+            if base_expr != ir.Literal(False):
+                result = ir.BoolBinaryOpExpr(lhs=result, rhs=base_expr, op='||')
+            return result
+        if step_expr.op == '+' and template_defn.name != GlobalLiterals.INT64_LIST_SUM.cpp_type:
+            # Int64ListSum<Int64List<E(xs)..., base>>::value
+            # This keeps the same evaluation order (and therefore the same overflows) as the original recursion.
+            return ir.ClassMemberAccess(class_type_expr=ir.TemplateInstantiation(template_expr=GlobalLiterals.INT64_LIST_SUM,
+                                                                                 args=[_list_of(ir.ExprKind.INT64, elem_exprs, base_expr)],
+                                                                                 instantiation_might_trigger_static_asserts=False),
+                                        member_name='value',
+                                        member_type=ir.Int64Type())
+        return None
+
+    # Maps: XListConcat<XList<E(x)>, F<L<xs...>>::type>::type with base XList<> => XList<E(xs)...>
+    if (isinstance(step_expr, ir.ClassMemberAccess)
+            and step_expr.member_name == 'type'
+            and isinstance(step_expr.expr, ir.TemplateInstantiation)
+            and isinstance(step_expr.expr.template_expr, ir.AtomicTypeLiteral)
+            and len(step_expr.expr.args) == 2
+            and _is_list_instantiation(base_expr)
+            and not base_expr.args
+            and step_expr.expr.template_expr.cpp_type == _LIST_CONCAT_TEMPLATE_NAME_BY_LIST_TEMPLATE_NAME[base_expr.template_expr.cpp_type]):
+        first_list, rest_list = step_expr.expr.args
+        if (_is_list_instantiation(first_list)
+                and first_list.template_expr.cpp_type == base_expr.template_expr.cpp_type
+                and len(first_list.args) == 1
+                and not isinstance(first_list.args[0], ir.VariadicTypeExpansion)
+                and not first_list.args[0].references_any_of({template_defn.name, rest_var.cpp_type})
+                and _is_recursive_call(rest_list, template_defn, rest_pattern)):
+            return ir.TemplateInstantiation(template_expr=base_expr.template_expr,
+                                            args=[_expand(first_list.args[0], first_var, rest_var)],
+                                            instantiation_might_trigger_static_asserts=False)
+    return None
+
+def _rewrite_recursion_in_template_defn(template_defn: ir.TemplateDefn) -> Optional[ir.TemplateDefn]:
+    if (len(template_defn.args) != 1
+            or template_defn.args[0].is_variadic
+            or template_defn.args[0].expr_type.kind != ir.ExprKind.TYPE
+            or len(template_defn.result_element_names) != 1):
+        return None
+    [result_element_name] = template_defn.result_element_names
+
+    # We're looking for:
+    #
+    # template <typename L> struct F { <result> = <base>; };            (or a specialization for L<>)
+    # template <x, xs...> struct F<L<x, xs...>> { <result> = <step>; };
+    step_specialization = None
+    base_expr = None
+    for specialization in template_defn.specializations:
+        if len(specialization.patterns) != 1 or not _is_list_instantiation(specialization.patterns[0]):
+            return None
+        [pattern] = specialization.patterns
+        result_expr = _get_result_expr(specialization, result_element_name)
+        if result_expr is None:
+            return None
+        if not pattern.args and not specialization.args:
+            base_expr = result_expr
+        elif (len(pattern.args) == 2
+              and len(specialization.args) == 2
+              and isinstance(pattern.args[0], ir.AtomicTypeLiteral)
+              and pattern.args[0].is_local
+              and not pattern.args[0].is_variadic
+              and isinstance(pattern.args[1], ir.VariadicTypeExpansion)
+              and isinstance(pattern.args[1].expr, ir.AtomicTypeLiteral)
+              and pattern.args[1].expr.is_local
+              and pattern.args[1].expr.is_variadic
+              and step_specialization is None):
+            step_specialization = specialization
+        else:
+            return None
+
+    if step_specialization is None:
+        return None
+    if base_expr is None and template_defn.main_definition:
+        base_expr = _get_result_expr(template_defn.main_definition, result_element_name)
+    if base_expr is None or any(True for _ in base_expr.get_free_vars()):
+        return None
+
+    [pattern] = step_specialization.patterns
+    first_var, rest_expansion = pattern.args
+    rest_var = rest_expansion.expr
+    rest_pattern = ir.TemplateInstantiation(template_expr=pattern.template_expr,
+                                            args=[rest_expansion],
+                                            instantiation_might_trigger_static_asserts=pattern.instantiation_might_trigger_static_asserts)
+    new_expr = _fold_to_pack_expansion(_get_result_expr(step_specialization, result_element_name),
+                                       base_expr,
+                                       template_defn,
+                                       first_var,
+                                       rest_var,
+                                       rest_pattern)
+    if new_expr is None:
+        return None
+
+    new_specialization = _with_result_expr(step_specialization,
+                                           result_element_name,
+                                           args=[arg
+                                                 for arg in step_specialization.args
+                                                 if arg.name == rest_var.cpp_type],
+                                           patterns=[rest_pattern],
+                                           expr=new_expr)
+    return ir.TemplateDefn(main_definition=template_defn.main_definition,
+                           specializations=[new_specialization if specialization is step_specialization else specialization
+                                            for specialization in template_defn.specializations],
+                           name=template_defn.name,
+                           description=template_defn.description,
+                           result_element_names=template_defn.result_element_names,
+                           args=template_defn.args)
+
+# Rewrites templates that recurse over a list one element at a time (folds with &&, || or + and maps) so that all
+# elements are processed in a single pack expansion, e.g.:
+#
+# template <typename L> struct F { static constexpr bool value = true; };
+# template <typename T, typename... Ts> struct F<List<T, Ts...>> {
+#   static constexpr bool value = G<T>::value && F<List<Ts...>>::value;
+# };
+#
+# Becomes:
+#
+# template <typename L> struct F { static constexpr bool value = true; };
+# template <typename... Ts> struct F<List<Ts...>> {
+#   static constexpr bool value = std::is_same<BoolList<G<Ts>::value..., true>, BoolList<true, G<Ts>::value...>>::value;
+# };
+#
+# This avoids O(n) template instantiations (and O(n) instantiation depth) for a list of length n.
+def rewrite_list_recursion_as_pack_expansion(template_defn: ir.TemplateDefn) -> Tuple[ir.TemplateDefn, bool]:
+    new_template_defn = _rewrite_recursion_in_template_defn(template_defn)
+    if new_template_defn is None:
+        return template_defn, False
+    ConfigurationKnobs.recursion_to_pack_expansion_counter += 1
+    return new_template_defn, False
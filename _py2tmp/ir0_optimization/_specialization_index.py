@@ -0,0 +1,151 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import weakref
+from typing import Dict, List, Optional, Tuple, Hashable, Sequence, Set, Iterator
+
+from _py2tmp.ir0 import ir
+
+# None is used for wildcards, otherwise this is (head, num_subexpressions).
+_Symbol = Optional[Tuple[Hashable, int]]
+
+def _is_syntactic(expr: ir.Expr):
+    # This must be consistent with _ExprUnificationStrategy.equality_requires_syntactical_equality (in _unify.py): two
+    # exprs where this is True can only unify if they have the same head.
+    if isinstance(expr, ir.AtomicTypeLiteral):
+        return not expr.is_local and not expr.may_be_alias
+    return isinstance(expr, (ir.Literal,
+                             ir.PointerTypeExpr,
+                             ir.ConstTypeExpr,
+                             ir.ArrayTypeExpr,
+                             ir.FunctionTypeExpr,
+                             ir.TemplateInstantiation))
+
+def _get_head(expr: ir.Expr) -> Hashable:
+    # Two syntactic exprs have the same head iff is_same_expr_excluding_subexpressions() returns True.
+    if isinstance(expr, ir.Literal):
+        return 'Literal', expr.value
+    elif isinstance(expr, ir.AtomicTypeLiteral):
+        return 'AtomicTypeLiteral', expr.cpp_type
+    else:
+        return expr.__class__.__name__
+
+def _contains_variadic_type_expansion(exprs: Sequence[ir.Expr]):
+    return any(isinstance(subexpr, ir.VariadicTypeExpansion)
+               for expr in exprs
+               for subexpr in expr.get_transitive_subexpressions())
+
+def _flatten(exprs: Sequence[ir.Expr], result: List[Tuple[_Symbol, int]]):
+    # Appends (symbol, end_index) to `result` for each expr in pre-order, where end_index is the index in `result` right
+    # after the entries of this expr's subexpressions. Wildcards have no entries for their subexpressions.
+    for expr in exprs:
+        index = len(result)
+        if _is_syntactic(expr):
+            subexpressions = list(expr.get_direct_subexpressions())
+            result.append(((_get_head(expr), len(subexpressions)), -1))
+            _flatten(subexpressions, result)
+            result[index] = (result[index][0], len(result))
+        else:
+            result.append((None, index + 1))
+
+def _flatten_args(exprs: Sequence[ir.Expr]) -> List[Tuple[_Symbol, int]]:
+    # The first symbol stands for the argument list, so that argument lists of different length never match.
+    result = [(('args', len(exprs)), -1)]
+    _flatten(exprs, result)
+    result[0] = (result[0][0], len(result))
+    return result
+
+class _DiscriminationTreeNode:
+    def __init__(self):
+        self.children: Dict[_Symbol, _DiscriminationTreeNode] = dict()
+        self.specialization_indexes: List[int] = []
+
+# A discrimination tree over the patterns of a template's specializations.
+# This is used to cheaply discard specializations that can't possibly match an instantiation, before doing the (much
+# more expensive) full unification.
+class SpecializationIndex:
+    def __init__(self, template_defn: ir.TemplateDefn):
+        self.specializations = template_defn.specializations
+        self.root = _DiscriminationTreeNode()
+        # These are not indexed and always returned as candidates, since variadic type expansions can match any number of
+        # args.
+        self.unindexed_specialization_indexes: List[int] = []
+        for specialization_index, specialization in enumerate(template_defn.specializations):
+            if _contains_variadic_type_expansion(specialization.patterns):
+                self.unindexed_specialization_indexes.append(specialization_index)
+                continue
+            node = self.root
+            for symbol, _ in _flatten_args(specialization.patterns):
+                child = node.children.get(symbol)
+                if child is None:
+                    child = _DiscriminationTreeNode()
+                    node.children[symbol] = child
+                node = child
+            node.specialization_indexes.append(specialization_index)
+
+    # Returns the specializations that might unify with the given template args, in the original order.
+    def get_candidate_specializations(self, args: Sequence[ir.Expr]) -> List[ir.TemplateSpecialization]:
+        if _contains_variadic_type_expansion(args):
+            return list(self.specializations)
+
+        specialization_indexes: Set[int] = set(self.unindexed_specialization_indexes)
+        self._collect_matches(self.root, _flatten_args(args), 0, specialization_indexes)
+        return [specialization
+                for specialization_index, specialization in enumerate(self.specializations)
+                if specialization_index in specialization_indexes]
+
+    def _collect_matches(self,
+                         node: _DiscriminationTreeNode,
+                         symbols: List[Tuple[_Symbol, int]],
+                         position: int,
+                         result: Set[int]):
+        if position == len(symbols):
+            result.update(node.specialization_indexes)
+            return
+
+        symbol, end_position = symbols[position]
+        if symbol is None:
+            # A wildcard in the args matches any pattern subexpression.
+            for next_node in _skip_subexpression(node):
+                self._collect_matches(next_node, symbols, end_position, result)
+        else:
+            wildcard_child = node.children.get(None)
+            if wildcard_child is not None:
+                # A wildcard in the patterns matches the whole arg subexpression.
+                self._collect_matches(wildcard_child, symbols, end_position, result)
+            child = node.children.get(symbol)
+            if child is not None:
+                self._collect_matches(child, symbols, position + 1, result)
+
+def _skip_subexpression(node: _DiscriminationTreeNode, num_subexpressions: int = 1) -> Iterator[_DiscriminationTreeNode]:
+    if num_subexpressions == 0:
+        yield node
+        return
+    for symbol, child in node.children.items():
+        if symbol is None:
+            yield from _skip_subexpression(child, num_subexpressions - 1)
+        else:
+            _, num_child_subexpressions = symbol
+            yield from _skip_subexpression(child, num_child_subexpressions + num_subexpressions - 1)
+
+# id(template_defn) -> SpecializationIndex. Entries are removed when the TemplateDefn is garbage-collected.
+_specialization_index_by_template_defn_id: Dict[int, SpecializationIndex] = dict()
+
+def get_specialization_index(template_defn: ir.TemplateDefn) -> SpecializationIndex:
+    index = _specialization_index_by_template_defn_id.get(id(template_defn))
+    if index is None:
+        index = SpecializationIndex(template_defn)
+        _specialization_index_by_template_defn_id[id(template_defn)] = index
+        weakref.finalize(template_defn, _specialization_index_by_template_defn_id.pop, id(template_defn), None)
+    return index
@@ -0,0 +1,148 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+from typing import Dict, Set, List
+
+from _py2tmp.ir0 import ir, Visitor, NameReplacementTransformation, ToplevelWriter
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
+
+
+class _DetermineTemplatesThatCanBeMerged(Visitor):
+    def __init__(self):
+        # Templates that are used in some way other than accessing members of their instantiations. Merging two of those
+        # would be observable, e.g. std::is_same<F<int>, G<int>> would become true.
+        self.template_names_that_cant_be_merged: Set[str] = set()
+        self.accessed_member_names_by_template_name: Dict[str, Set[str]] = defaultdict(set)
+
+    def visit_header(self, header: ir.Header):
+        super().visit_header(header)
+        for template_name in header.public_names:
+            self.template_names_that_cant_be_merged.add(template_name)
+
+    def visit_template_defn(self, template_defn: ir.TemplateDefn):
+        super().visit_template_defn(template_defn)
+        if not all(specialization.is_metafunction
+                   for specialization in template_defn.get_all_definitions()):
+            self.template_names_that_cant_be_merged.add(template_defn.name)
+
+    def visit_class_member_access(self, class_member_access: ir.ClassMemberAccess):
+        if (isinstance(class_member_access.expr, ir.TemplateInstantiation)
+                and isinstance(class_member_access.expr.template_expr, ir.AtomicTypeLiteral)
+                and not class_member_access.expr.template_expr.is_local):
+            self.accessed_member_names_by_template_name[class_member_access.expr.template_expr.cpp_type].add(class_member_access.member_name)
+            # We don't visit the AtomicTypeLiteral, this use doesn't prevent merging.
+            self.visit_exprs(class_member_access.expr.args)
+        else:
+            super().visit_class_member_access(class_member_access)
+
+    def visit_type_literal(self, type_literal: ir.AtomicTypeLiteral):
+        if isinstance(type_literal.expr_type, ir.TemplateType) and not type_literal.is_local:
+            self.template_names_that_cant_be_merged.add(type_literal.cpp_type)
+
+class _NameReplacementTransformationIncludingTypedefArgs(NameReplacementTransformation):
+    def transform_typedef(self, typedef: ir.Typedef):
+        self.writer.write(ir.Typedef(name=self._transform_name(typedef.name),
+                                     expr=self.transform_expr(typedef.expr),
+                                     description=typedef.description,
+                                     template_args=[self.transform_template_arg_decl(arg_decl)
+                                                    for arg_decl in typedef.template_args]))
+
+def _compute_alpha_normalized_key(template_defn: ir.TemplateDefn,
+                                  accessed_member_names: Set[str],
+                                  class_name_by_template_name: Dict[str, str]):
+    # Returns a string that's the same for two templates iff they're equal up to renaming of their template args and
+    # of the (non-accessed) local vars in their body, assuming that templates in the same class are equal.
+    local_names: List[str] = [arg.name for arg in template_defn.args]
+    for specialization in template_defn.get_all_definitions():
+        local_names += [arg.name for arg in specialization.args]
+        for elem in specialization.body:
+            if isinstance(elem, (ir.ConstantDef, ir.Typedef)):
+                if elem.name not in template_defn.result_element_names and elem.name not in accessed_member_names:
+                    local_names.append(elem.name)
+                if isinstance(elem, ir.Typedef):
+                    local_names += [arg.name for arg in elem.template_args]
+
+    replacements = class_name_by_template_name.copy()
+    for name in local_names:
+        if name not in replacements:
+            replacements[name] = 'TmppyDedup_Local%s' % len(replacements)
+
+    writer = ToplevelWriter(allow_toplevel_elems=False)
+    transformation = _NameReplacementTransformationIncludingTypedefArgs(replacements)
+    with transformation.set_writer(writer):
+        transformation.transform_template_defn(template_defn)
+    [normalized_template_defn] = writer.template_defns
+    return str(ir.TemplateDefn(args=normalized_template_defn.args,
+                               main_definition=normalized_template_defn.main_definition,
+                               specializations=normalized_template_defn.specializations,
+                               name=normalized_template_defn.name,
+                               description='',
+                               result_element_names=normalized_template_defn.result_element_names))
+
+# Merges templates that are equal up to renaming, and rewrites all references to use the remaining one.
+# This is mostly useful when linking, since separately-compiled modules often contain equivalent helper templates.
+def merge_equivalent_template_defns(header: ir.Header) -> ir.Header:
+    visitor = _DetermineTemplatesThatCanBeMerged()
+    visitor.visit_header(header)
+    template_defns = [template_defn
+                      for template_defn in header.template_defns
+                      if template_defn.name not in visitor.template_names_that_cant_be_merged]
+
+    # This is a partition refinement (as in DFA minimization): we start assuming that all templates are equivalent, and
+    # then we split the classes of templates that differ (possibly only in the classes of the templates that they
+    # reference) until there's nothing left to split. Unlike merging templates that are already equal, this can also
+    # merge (mutually) recursive templates.
+    class_name_by_template_name = {template_defn.name: 'TmppyDedup_Class0'
+                                   for template_defn in template_defns}
+    num_classes = 1
+    while True:
+        class_index_by_key: Dict[str, int] = dict()
+        new_class_name_by_template_name = dict()
+        for template_defn in template_defns:
+            key = _compute_alpha_normalized_key(template_defn,
+                                                visitor.accessed_member_names_by_template_name[template_defn.name],
+                                                class_name_by_template_name)
+            class_index = class_index_by_key.setdefault(key, len(class_index_by_key))
+            new_class_name_by_template_name[template_defn.name] = 'TmppyDedup_Class%s' % class_index
+        class_name_by_template_name = new_class_name_by_template_name
+        # The old class is part of the key (it's the template's name after the replacement), so classes can only be
+        # split, not merged. Therefore if the number of classes didn't change, the partition is stable.
+        if len(class_index_by_key) == num_classes:
+            break
+        num_classes = len(class_index_by_key)
+
+    # We keep the first template of each class.
+    template_name_by_class_name: Dict[str, str] = dict()
+    replacements: Dict[str, str] = dict()
+    for template_defn in template_defns:
+        class_name = class_name_by_template_name[template_defn.name]
+        if class_name in template_name_by_class_name:
+            replacements[template_defn.name] = template_name_by_class_name[class_name]
+        else:
+            template_name_by_class_name[class_name] = template_defn.name
+
+    if not replacements:
+        return header
+    ConfigurationKnobs.merged_template_defns_counter += len(replacements)
+
+    return NameReplacementTransformation(replacements).transform_header(
+        ir.Header(template_defns=[template_defn
+                                  for template_defn in header.template_defns
+                                  if template_defn.name not in replacements],
+                  toplevel_content=header.toplevel_content,
+                  public_names=header.public_names,
+                  split_template_name_by_old_name_and_result_element_name={key: replacements.get(value, value)
+                                                                           for key, value in header.split_template_name_by_old_name_and_result_element_name.items()},
+                  check_if_error_specializations=header.check_if_error_specializations))
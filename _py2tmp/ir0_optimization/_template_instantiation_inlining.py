@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import itertools
-from typing import Dict, Iterator, Set, List, Union
+from typing import Dict, Iterator, Set, List, Union, Tuple, Mapping
 
 from _py2tmp.compiler.stages import expr_to_cpp_simple, template_defn_to_cpp_simple
 from _py2tmp.compiler.output_files import ObjectFileContent
@@ -163,14 +163,32 @@ def _with_global_inlineable_templates(context_object_file_content: ObjectFileCon
         result[template_defn.name] = template_defn
     return result
 
+def _compute_size(elem: Union[ir.Expr, ir.TemplateBodyElement]):
+    return sum(1 for _ in elem.get_transitive_subexpressions())
+
+def _estimate_inlining_compile_cost_delta(class_member_access: ir.ClassMemberAccess,
+                                          inlined_body: List[ir.TemplateBodyElement],
+                                          inlined_result_expr: ir.Expr,
+                                          num_references: int):
+    # Inlining adds the body of the specialization to the caller, but saves an instantiation of the template. When the
+    # template is referenced in multiple places the C++ compiler might be able to reuse the same instantiation for
+    # several of them, so we only count a fraction of its cost as saved.
+    size_delta = (sum(_compute_size(elem) for elem in inlined_body)
+                  + _compute_size(inlined_result_expr)
+                  - _compute_size(class_member_access))
+    return (size_delta * ConfigurationKnobs.inlining_cost_per_node
+            - ConfigurationKnobs.inlining_cost_per_template_instantiation / max(num_references, 1))
+
 class _TemplateInstantiationInliningTransformation(Transformation):
     def __init__(self,
                  local_inlineable_templates: List[ir.TemplateDefn],
                  context_object_file_content: ObjectFileContent,
-                 identifier_generator: Iterator[str]):
+                 identifier_generator: Iterator[str],
+                 num_references_by_template_name: Mapping[str, int]):
         super().__init__(identifier_generator=identifier_generator)
         self.needs_another_loop = False
         self.inlineable_templates_by_name = _with_global_inlineable_templates(context_object_file_content, local_inlineable_templates)
+        self.num_references_by_template_name = num_references_by_template_name
         self.parent_template_specialization_definitions = dict()
         self.root_template_defn_name = None
 
@@ -235,31 +253,8 @@ class _TemplateInstantiationInliningTransformation(Transformation):
 
         specialization, value_by_pattern_variable, value_by_expanded_pattern_variable = unification
         assert len(value_by_pattern_variable) + len(value_by_expanded_pattern_variable) == len(specialization.args)
-
-        new_value_by_pattern_variable: Dict[str, ir.Expr] = dict()
-        for var, exprs in value_by_pattern_variable:
-            assert isinstance(var, ir.AtomicTypeLiteral)
-            if isinstance(exprs, list):
-                [exprs] = exprs
-            assert not isinstance(exprs, list)
-            assert not isinstance(exprs, ir.VariadicTypeExpansion)
-            new_value_by_pattern_variable[var.cpp_type] = exprs
-        value_by_pattern_variable = new_value_by_pattern_variable
-
-        new_value_by_expanded_pattern_variable: Dict[str, List[ir.Expr]] = dict()
-        for var, exprs in value_by_expanded_pattern_variable:
-            if isinstance(var, ir.AtomicTypeLiteral):
-                if not isinstance(exprs, list):
-                    exprs = [exprs]
-                for expr in exprs:
-                    assert not isinstance(expr, list)
-                new_value_by_expanded_pattern_variable[var.cpp_type] = exprs
-            else:
-                assert isinstance(var, ir.VariadicTypeExpansion) and isinstance(var.expr, ir.AtomicTypeLiteral)
-                assert isinstance(exprs, list)
-
-                new_value_by_expanded_pattern_variable[var.expr.cpp_type] = exprs
-        value_by_expanded_pattern_variable = new_value_by_expanded_pattern_variable
+        value_by_pattern_variable, value_by_expanded_pattern_variable = get_values_by_pattern_variable_name(
+            value_by_pattern_variable, value_by_expanded_pattern_variable)
 
         body = []
         result_expr = None
@@ -315,9 +310,23 @@ class _TemplateInstantiationInliningTransformation(Transformation):
                      or class_member_access.expr.template_expr.cpp_type.startswith('Always'))):
             return class_member_access
 
+        # Templates from other modules are not in num_references_by_template_name, for those we assume a single
+        # reference.
+        num_references = self.num_references_by_template_name.get(template_defn_to_inline.name, 1)
+        estimated_compile_cost_delta = _estimate_inlining_compile_cost_delta(class_member_access, body, result_expr, num_references)
+        if estimated_compile_cost_delta > ConfigurationKnobs.inlining_max_compile_cost_increase:
+            ConfigurationKnobs.template_instantiations_not_inlined_due_to_cost_counter += 1
+            if ConfigurationKnobs.verbose:
+                print('Not inlining template defn: %s into %s (%s references, estimated compile cost delta: %+.1f)' % (
+                    template_defn_to_inline.name, self.root_template_defn_name or expr_to_cpp_simple(class_member_access), num_references, estimated_compile_cost_delta))
+            return class_member_access
+
         self.needs_another_loop = True
+        ConfigurationKnobs.inlined_template_instantiations_counter += 1
+        ConfigurationKnobs.inlining_estimated_compile_cost_delta_counter += estimated_compile_cost_delta
         if ConfigurationKnobs.verbose:
-            print('Inlining template defn: %s into %s' % (template_defn_to_inline.name, self.root_template_defn_name or expr_to_cpp_simple(class_member_access)))
+            print('Inlining template defn: %s into %s (%s references, estimated compile cost delta: %+.1f)' % (
+                template_defn_to_inline.name, self.root_template_defn_name or expr_to_cpp_simple(class_member_access), num_references, estimated_compile_cost_delta))
 
         for elem in body:
             with transformation.set_writer(self.writer):
@@ -325,6 +334,35 @@ class _TemplateInstantiationInliningTransformation(Transformation):
 
         return result_expr
 
+def get_values_by_pattern_variable_name(value_by_pattern_variable, value_by_expanded_pattern_variable) \
+        -> Tuple[Dict[str, ir.Expr], Dict[str, List[ir.Expr]]]:
+    # Converts the pattern variable values returned by the unification to the format expected by
+    # replace_var_with_expr_in_template_body_elements().
+    new_value_by_pattern_variable: Dict[str, ir.Expr] = dict()
+    for var, exprs in value_by_pattern_variable:
+        assert isinstance(var, ir.AtomicTypeLiteral)
+        if isinstance(exprs, list):
+            [exprs] = exprs
+        assert not isinstance(exprs, list)
+        assert not isinstance(exprs, ir.VariadicTypeExpansion)
+        new_value_by_pattern_variable[var.cpp_type] = exprs
+
+    new_value_by_expanded_pattern_variable: Dict[str, List[ir.Expr]] = dict()
+    for var, exprs in value_by_expanded_pattern_variable:
+        if isinstance(var, ir.AtomicTypeLiteral):
+            if not isinstance(exprs, list):
+                exprs = [exprs]
+            for expr in exprs:
+                assert not isinstance(expr, list)
+            new_value_by_expanded_pattern_variable[var.cpp_type] = exprs
+        else:
+            assert isinstance(var, ir.VariadicTypeExpansion) and isinstance(var.expr, ir.AtomicTypeLiteral)
+            assert isinstance(exprs, list)
+
+            new_value_by_expanded_pattern_variable[var.expr.cpp_type] = exprs
+
+    return new_value_by_pattern_variable, new_value_by_expanded_pattern_variable
+
 def _ensure_remains_variadic_if_it_was(original_expr: ir.Expr, transformed_expr: ir.Expr):
     non_expanded_vars_in_original = compute_non_expanded_variadic_vars(original_expr)
     if not non_expanded_vars_in_original:
@@ -347,7 +385,8 @@ def perform_template_inlining(template_defn: ir.TemplateDefn,
                               inlineable_refs: Set[str],
                               template_defn_by_name: Dict[str, ir.TemplateDefn],
                               identifier_generator: Iterator[str],
-                              context_object_file_content: ObjectFileContent):
+                              context_object_file_content: ObjectFileContent,
+                              num_references_by_template_name: Mapping[str, int]):
     template_defn, needs_another_loop1 = perform_local_optimizations_on_template_defn(template_defn,
                                                                                       identifier_generator,
                                                                                       inline_template_instantiations_with_multiple_references=True)
@@ -358,7 +397,8 @@ def perform_template_inlining(template_defn: ir.TemplateDefn,
         transformation = _TemplateInstantiationInliningTransformation([template_defn_by_name[template_name]
                                                                        for template_name in inlineable_refs],
                                                                       context_object_file_content,
-                                                                      identifier_generator)
+                                                                      identifier_generator,
+                                                                      num_references_by_template_name)
         writer = ToplevelWriter(allow_toplevel_elems=False)
         with transformation.set_writer(writer):
             transformation.transform_template_defn(template_defn)
@@ -378,7 +418,8 @@ def perform_template_inlining_on_toplevel_elems(toplevel_elems: List[Union[
                                                 inlineable_refs: Set[str],
                                                 template_defn_by_name: Dict[str, ir.TemplateDefn],
                                                 identifier_generator: Iterator[str],
-                                                context_object_file_content: ObjectFileContent):
+                                                context_object_file_content: ObjectFileContent,
+                                                num_references_by_template_name: Mapping[str, int]):
     toplevel_elems, needs_another_loop1 = perform_local_optimizations_on_toplevel_elems(toplevel_elems,
                                                                                         identifier_generator,
                                                                                         inline_template_instantiations_with_multiple_references=True)
@@ -389,7 +430,8 @@ def perform_template_inlining_on_toplevel_elems(toplevel_elems: List[Union[
         transformation = _TemplateInstantiationInliningTransformation([template_defn_by_name[template_name]
                                                                        for template_name in inlineable_refs],
                                                                       context_object_file_content,
-                                                                      identifier_generator)
+                                                                      identifier_generator,
+                                                                      num_references_by_template_name)
 
         elems = transformation.transform_template_body_elems(toplevel_elems)
         return elems, transformation.needs_another_loop
@@ -13,6 +13,8 @@
 # limitations under the License.
 import itertools
 import traceback
+import weakref
+from collections import OrderedDict
 from enum import Enum
 from typing import List, Tuple, Set, Optional, Iterable, Union, MutableMapping, Mapping, Dict
 
@@ -20,7 +22,9 @@ from bidict import bidict
 
 from _py2tmp.compiler.stages import expr_to_cpp_simple
 from _py2tmp.ir0 import NameReplacementTransformation, ir
+from _py2tmp.ir0_optimization._configuration_knobs import ConfigurationKnobs
 from _py2tmp.ir0_optimization._replace_var_with_expr import replace_var_with_expr_in_expr
+from _py2tmp.ir0_optimization._specialization_index import get_specialization_index
 from _py2tmp.unification import ListExpansion, UnificationStrategyForCanonicalization, UnificationStrategy, \
     UnificationFailedException, unify, UnificationAmbiguousException, CanonicalizationFailedException, canonicalize
 from _py2tmp.utils import ir_to_string
@@ -175,6 +179,67 @@ class UnificationResult:
         self.value_by_pattern_variable = pattern_var_expr_equations
         self.value_by_expanded_pattern_variable = value_by_expanded_pattern_variable
 
+def _unification_identifier_generator(prefix: str):
+    for i in itertools.count():
+        yield '%s_%s' % (prefix, i)
+
+def _get_relevant_local_var_definitions(template_instantiation: ir.TemplateInstantiation,
+                                        local_var_definitions: Mapping[str, ir.Expr]):
+    # Returns the local var definitions (transitively) referenced by the template instantiation, the others can't
+    # affect the unification.
+    result: Dict[str, ir.Expr] = dict()
+    vars_to_visit = [var.cpp_type for var in template_instantiation.get_free_vars()]
+    while vars_to_visit:
+        var = vars_to_visit.pop()
+        if var in result or var not in local_var_definitions:
+            continue
+        result[var] = local_var_definitions[var]
+        vars_to_visit.extend(free_var.cpp_type for free_var in result[var].get_free_vars())
+    return result
+
+class _TemplateDefnPatterns:
+    # The parts of a TemplateDefn that can affect the result of
+    # find_matches_in_unification_of_template_instantiation_with_definition(). This is used as a cheap "version" of
+    # the TemplateDefn in the cache key: it doesn't include the specializations' bodies, and the hash is precomputed.
+    def __init__(self, template_defn: ir.TemplateDefn):
+        self.key = (template_defn.name,
+                    template_defn.main_definition.args if template_defn.main_definition and template_defn.main_definition.body else None,
+                    tuple((specialization.args, specialization.patterns)
+                          for specialization in template_defn.specializations))
+        self.hash = hash(self.key)
+
+    def __eq__(self, other):
+        return self is other or (self.hash == other.hash and self.key == other.key)
+
+    def __hash__(self):
+        return self.hash
+
+# id(template_defn) -> _TemplateDefnPatterns. Entries are removed when the TemplateDefn is garbage-collected.
+_template_defn_patterns_by_template_defn_id: Dict[int, _TemplateDefnPatterns] = dict()
+
+def _get_template_defn_patterns(template_defn: ir.TemplateDefn):
+    template_defn_patterns = _template_defn_patterns_by_template_defn_id.get(id(template_defn))
+    if template_defn_patterns is None:
+        template_defn_patterns = _TemplateDefnPatterns(template_defn)
+        _template_defn_patterns_by_template_defn_id[id(template_defn)] = template_defn_patterns
+        weakref.finalize(template_defn, _template_defn_patterns_by_template_defn_id.pop, id(template_defn), None)
+    return template_defn_patterns
+
+# (template instantiation, relevant local var definitions, template defn patterns) -> (certain matches, possible matches)
+# In the cached result, specializations are stored as their index in template_defn.specializations (or None for the
+# main definition), since the bodies might be different in the TemplateDefn that we'll use on a cache hit.
+_find_matches_cache: 'OrderedDict[Tuple[ir.TemplateInstantiation, frozenset, _TemplateDefnPatterns], Tuple[Tuple, Tuple]]' = OrderedDict()
+
+def clear_unification_cache():
+    _find_matches_cache.clear()
+    ConfigurationKnobs.unification_cache_hit_counter = 0
+    ConfigurationKnobs.unification_cache_miss_counter = 0
+
+def _get_specialization_by_index(template_defn: ir.TemplateDefn, specialization_index: Optional[int]):
+    if specialization_index is None:
+        return template_defn.main_definition
+    return template_defn.specializations[specialization_index]
+
 def find_matches_in_unification_of_template_instantiation_with_definition(template_instantiation: ir.TemplateInstantiation,
                                                                           local_var_definitions: Mapping[str, ir.Expr],
                                                                           template_defn: ir.TemplateDefn,
@@ -188,6 +253,50 @@ def find_matches_in_unification_of_template_instantiation_with_definition(templa
                                                                                                                      ir.Expr]]]]],
                                                                                                   List[
                                                                                                       ir.TemplateSpecialization]]:
+    # The identifiers used by the unification are only used for temporary renames, they don't appear in the result.
+    # We always take exactly one identifier from identifier_generator (and use it as a prefix) so that the generated
+    # code doesn't depend on the state of the cache.
+    unification_identifier_generator = _unification_identifier_generator(next(identifier_generator))
+
+    local_var_definitions = _get_relevant_local_var_definitions(template_instantiation, local_var_definitions)
+
+    cache_key = (template_instantiation, frozenset(local_var_definitions.items()), _get_template_defn_patterns(template_defn))
+    cache_entry = _find_matches_cache.get(cache_key)
+    if cache_entry is not None:
+        _find_matches_cache.move_to_end(cache_key)
+        ConfigurationKnobs.unification_cache_hit_counter += 1
+        if verbose:
+            print('Using cached unification result for %s with template %s' % (
+                expr_to_cpp_simple(template_instantiation), template_defn.name))
+        cached_certain_matches, cached_possible_matches = cache_entry
+        return ([(_get_specialization_by_index(template_defn, specialization_index), value_by_pattern_variable, value_by_expanded_pattern_variable)
+                 for specialization_index, value_by_pattern_variable, value_by_expanded_pattern_variable in cached_certain_matches],
+                [_get_specialization_by_index(template_defn, specialization_index)
+                 for specialization_index in cached_possible_matches])
+
+    ConfigurationKnobs.unification_cache_miss_counter += 1
+    certain_matches, possible_matches = _find_matches_in_unification_of_template_instantiation_with_definition(template_instantiation,
+                                                                                                               local_var_definitions,
+                                                                                                               template_defn,
+                                                                                                               unification_identifier_generator,
+                                                                                                               verbose)
+
+    specialization_index_by_id = {id(specialization): specialization_index
+                                  for specialization_index, specialization in enumerate(template_defn.specializations)}
+    _find_matches_cache[cache_key] = (tuple((specialization_index_by_id.get(id(specialization)), value_by_pattern_variable, value_by_expanded_pattern_variable)
+                                            for specialization, value_by_pattern_variable, value_by_expanded_pattern_variable in certain_matches),
+                                      tuple(specialization_index_by_id.get(id(specialization))
+                                            for specialization in possible_matches))
+    while len(_find_matches_cache) > ConfigurationKnobs.unification_cache_max_size:
+        _find_matches_cache.popitem(last=False)
+
+    return certain_matches, possible_matches
+
+def _find_matches_in_unification_of_template_instantiation_with_definition(template_instantiation: ir.TemplateInstantiation,
+                                                                           local_var_definitions: Mapping[str, ir.Expr],
+                                                                           template_defn: ir.TemplateDefn,
+                                                                           identifier_generator: Iterable[str],
+                                                                           verbose: bool):
     instantiation_vars = {var.cpp_type
                           for var in template_instantiation.get_free_vars()}
 
@@ -196,7 +305,8 @@ def find_matches_in_unification_of_template_instantiation_with_definition(templa
                                            List[ir.Expr]]]]] = \
         []
     possible_matches: List[ir.TemplateSpecialization] = []
-    for specialization in template_defn.specializations:
+    # Specializations that are not candidates can't possibly match, so we don't need to try unifying them.
+    for specialization in get_specialization_index(template_defn).get_candidate_specializations(template_instantiation.args):
         result = _unify(template_instantiation.args,
                         local_var_definitions,
                         specialization.patterns,
@@ -0,0 +1,124 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import List
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._alias_template_conversion import convert_templates_to_alias_templates
+
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def local_type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=False)
+
+def template_literal(template_name: str, may_be_alias: bool = False):
+    return ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                       args=[ir0.TemplateArgType(expr_type=ir0.TypeType(),
+                                                                                 is_variadic=False)],
+                                                       is_metafunction_that_may_return_error=False,
+                                                       may_be_alias=may_be_alias)
+
+def instantiation(template_name: str, arg: ir0.Expr, may_be_alias: bool = False):
+    return ir0.TemplateInstantiation(template_expr=template_literal(template_name, may_be_alias),
+                                     args=[arg],
+                                     instantiation_might_trigger_static_asserts=True)
+
+def type_of(template_name: str, arg: ir0.Expr):
+    return ir0.ClassMemberAccess(class_type_expr=instantiation(template_name, arg),
+                                 member_name='type',
+                                 member_type=ir0.TypeType())
+
+def args():
+    return [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T', is_variadic=False)]
+
+def template_defn(name: str, body: List[ir0.TemplateBodyElement]):
+    # template <typename T> struct <name> { <body> };
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args(),
+                                                                       patterns=None,
+                                                                       body=body,
+                                                                       is_metafunction=True),
+                            specializations=[],
+                            name=name,
+                            description='',
+                            result_element_names=['type'],
+                            args=args())
+
+def header(template_defns: List[ir0.TemplateDefn], toplevel_content=(), public_names=()):
+    return ir0.Header(template_defns=template_defns,
+                      toplevel_content=toplevel_content,
+                      public_names=set(public_names),
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def test_convert_templates_to_alias_templates():
+    result = convert_templates_to_alias_templates(header([
+        template_defn('F', [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T')))]),
+        template_defn('G', [ir0.Typedef('type', ir0.FunctionTypeExpr(type_of('F', local_type_literal('T')),
+                                                                     [type_of('F', ir0.ConstTypeExpr(local_type_literal('T')))]))]),
+        template_defn('H', [ir0.Typedef('type', type_of('G', local_type_literal('T')))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('G', type_literal('int'))),
+    ], public_names=['H']))
+
+    assert result == header([
+        template_defn('H', [ir0.Typedef('type', instantiation('G', local_type_literal('T'), may_be_alias=True))]),
+    ], toplevel_content=[
+        ir0.Typedef('F', ir0.PointerTypeExpr(local_type_literal('T')), template_args=args()),
+        ir0.Typedef('G', ir0.FunctionTypeExpr(instantiation('F', local_type_literal('T'), may_be_alias=True),
+                                              [instantiation('F', ir0.ConstTypeExpr(local_type_literal('T')), may_be_alias=True)]),
+                    template_args=args()),
+        ir0.Typedef('X', instantiation('G', type_literal('int'), may_be_alias=True)),
+    ], public_names=['H'])
+
+def test_convert_templates_to_alias_templates_recursive_template_not_converted():
+    input_header = header([
+        template_defn('F', [ir0.Typedef('type', ir0.PointerTypeExpr(type_of('F', local_type_literal('T'))))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', type_literal('int'))),
+    ])
+    assert convert_templates_to_alias_templates(input_header) == input_header
+
+def test_convert_templates_to_alias_templates_unused_arg_not_converted():
+    # F<T> would no longer depend on T, so e.g. F<Ts>... would no longer be a valid pack expansion.
+    input_header = header([
+        template_defn('F', [ir0.Typedef('type', type_literal('int'))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', type_literal('int'))),
+    ])
+    assert convert_templates_to_alias_templates(input_header) == input_header
+
+def test_convert_templates_to_alias_templates_template_used_as_type_not_converted():
+    # std::is_same<F<int>, int*> would become true.
+    input_header = header([
+        template_defn('F', [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T')))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', instantiation('F', type_literal('int'))),
+    ])
+    assert convert_templates_to_alias_templates(input_header) == input_header
+
+def test_convert_templates_to_alias_templates_template_with_static_assert_not_converted():
+    input_header = header([
+        template_defn('F', [
+            ir0.StaticAssert(ir0.Literal(True), message='error'),
+            ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T'))),
+        ]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', type_literal('int'))),
+    ])
+    assert convert_templates_to_alias_templates(input_header) == input_header
+
+if __name__== '__main__':
+    main(__file__)
@@ -0,0 +1,135 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+from typing import List
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization import ConfigurationKnobs
+from _py2tmp.ir0_optimization._call_site_specialization import specialize_templates_for_constant_args
+
+
+def local_literal(cpp_type: str, expr_type: ir0.ExprType):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=expr_type, is_variadic=False)
+
+def value_of(template_name: str, args: List[ir0.Expr]):
+    template_expr = ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                                args=[ir0.TemplateArgType(expr_type=arg.expr_type,
+                                                                                          is_variadic=False)
+                                                                      for arg in args],
+                                                                is_metafunction_that_may_return_error=False,
+                                                                may_be_alias=False)
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=template_expr,
+                                                                           args=args,
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_name='value',
+                                 member_type=ir0.Int64Type())
+
+def select_template_defn():
+    # template <int64_t n, bool b> struct Select { static constexpr int64_t value = n + 1; };
+    # template <int64_t m> struct Select<m, true> { static constexpr int64_t value = m; };
+    args = [ir0.TemplateArgDecl(expr_type=ir0.Int64Type(), name='n', is_variadic=False),
+            ir0.TemplateArgDecl(expr_type=ir0.BoolType(), name='b', is_variadic=False)]
+    n = local_literal('n', ir0.Int64Type())
+    m = local_literal('m', ir0.Int64Type())
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                       patterns=None,
+                                                                       body=[ir0.ConstantDef('value', ir0.Int64BinaryOpExpr(n, ir0.Literal(1), '+'))],
+                                                                       is_metafunction=True),
+                            specializations=[ir0.TemplateSpecialization(args=[ir0.TemplateArgDecl(expr_type=ir0.Int64Type(), name='m', is_variadic=False)],
+                                                                        patterns=[m, ir0.Literal(True)],
+                                                                        body=[ir0.ConstantDef('value', m)],
+                                                                        is_metafunction=True)],
+                            name='Select',
+                            description='',
+                            result_element_names=['value'],
+                            args=args)
+
+def caller_template_defn(name: str, body_exprs: List[ir0.Expr]):
+    # template <int64_t k> struct <name> { static constexpr int64_t value = <body_exprs[0]> + <body_exprs[1]> + ...; };
+    args = [ir0.TemplateArgDecl(expr_type=ir0.Int64Type(), name='k', is_variadic=False)]
+    value = body_exprs[0]
+    for expr in body_exprs[1:]:
+        value = ir0.Int64BinaryOpExpr(value, expr, '+')
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                       patterns=None,
+                                                                       body=[ir0.ConstantDef('value', value)],
+                                                                       is_metafunction=True),
+                            specializations=[],
+                            name=name,
+                            description='',
+                            result_element_names=['value'],
+                            args=args)
+
+def header(template_defns: List[ir0.TemplateDefn]):
+    return ir0.Header(template_defns=template_defns,
+                      toplevel_content=[],
+                      public_names=set(),
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def specialize(template_defns: List[ir0.TemplateDefn]):
+    identifier_generator = ('X%s' % i for i in itertools.count())
+    return {template_defn.name: template_defn
+            for template_defn in specialize_templates_for_constant_args(header(template_defns), identifier_generator).template_defns}
+
+k = local_literal('k', ir0.Int64Type())
+
+def test_specialize_templates_for_constant_args_matching_specialization_becomes_main_definition():
+    result = specialize([
+        select_template_defn(),
+        caller_template_defn('F', [value_of('Select', [k, ir0.Literal(True)])]),
+        caller_template_defn('G', [value_of('Select', [k, ir0.Literal(True)])]),
+    ])
+    assert set(result.keys()) == {'Select', 'F', 'G', 'X0'}
+    assert list(result['X0'].specializations) == []
+    assert list(result['X0'].main_definition.body) == [ir0.ConstantDef('value', local_literal('n', ir0.Int64Type()))]
+    assert result['F'] == caller_template_defn('F', [value_of('X0', [k])])
+    assert result['G'] == caller_template_defn('G', [value_of('X0', [k])])
+
+def test_specialize_templates_for_constant_args_non_matching_specialization_removed():
+    result = specialize([
+        select_template_defn(),
+        caller_template_defn('F', [value_of('Select', [k, ir0.Literal(False)]),
+                                   value_of('Select', [k, ir0.Literal(False)])]),
+    ])
+    assert set(result.keys()) == {'Select', 'F', 'X0'}
+    assert list(result['X0'].specializations) == []
+    assert list(result['X0'].main_definition.body) == [
+        ir0.ConstantDef('value', ir0.Int64BinaryOpExpr(local_literal('n', ir0.Int64Type()), ir0.Literal(1), '+'))]
+    assert result['F'] == caller_template_defn('F', [value_of('X0', [k]), value_of('X0', [k])])
+
+def test_specialize_templates_for_constant_args_single_call_site_not_specialized():
+    template_defns = [
+        select_template_defn(),
+        caller_template_defn('F', [value_of('Select', [k, ir0.Literal(True)]),
+                                   value_of('Select', [k, ir0.Literal(False)])]),
+    ]
+    assert list(specialize(template_defns).values()) == template_defns
+
+def test_specialize_templates_for_constant_args_size_budget_exceeded_not_specialized():
+    template_defns = [
+        select_template_defn(),
+        caller_template_defn('F', [value_of('Select', [k, ir0.Literal(True)]),
+                                   value_of('Select', [k, ir0.Literal(True)])]),
+    ]
+    old_max_size_increase_ratio = ConfigurationKnobs.call_site_specialization_max_size_increase_ratio
+    ConfigurationKnobs.call_site_specialization_max_size_increase_ratio = 0.0
+    try:
+        assert list(specialize(template_defns).values()) == template_defns
+    finally:
+        ConfigurationKnobs.call_site_specialization_max_size_increase_ratio = old_max_size_increase_ratio
+
+if __name__== '__main__':
+    main(__file__)
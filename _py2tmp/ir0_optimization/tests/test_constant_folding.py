@@ -0,0 +1,104 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+
+import pytest
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._constant_folding import ConstantFoldingTransformation
+
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def local_type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=False)
+
+def template_instantiation(template_name: str, arg: ir0.Expr, instantiation_might_trigger_static_asserts: bool):
+    template_expr = ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                                args=[ir0.TemplateArgType(expr_type=ir0.TypeType(),
+                                                                                          is_variadic=False)],
+                                                                is_metafunction_that_may_return_error=False,
+                                                                may_be_alias=False)
+    return ir0.TemplateInstantiation(template_expr=template_expr,
+                                     args=[arg],
+                                     instantiation_might_trigger_static_asserts=instantiation_might_trigger_static_asserts)
+
+def _fold(stmts, result_element_names):
+    return ConstantFoldingTransformation(inline_template_instantiations_with_multiple_references=False) \
+        .transform_template_body_elems(stmts, result_element_names)
+
+def test_constant_folding_inlines_across_stmts_that_cannot_trigger_static_asserts():
+    x_expr = template_instantiation('F', type_literal('int'), instantiation_might_trigger_static_asserts=True)
+    stmts = [
+        ir0.Typedef('X', x_expr),
+        ir0.Typedef('Y', ir0.PointerTypeExpr(type_literal('float'))),
+        ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('X'))),
+    ]
+    assert _fold(stmts, ['Y', 'type']) == [
+        ir0.Typedef('Y', ir0.PointerTypeExpr(type_literal('float'))),
+        ir0.Typedef('type', ir0.PointerTypeExpr(x_expr)),
+    ]
+
+def test_constant_folding_does_not_inline_across_stmts_that_can_trigger_static_asserts():
+    stmts = [
+        ir0.Typedef('X', template_instantiation('F', type_literal('int'), instantiation_might_trigger_static_asserts=True)),
+        ir0.Typedef('Y', template_instantiation('G', type_literal('int'), instantiation_might_trigger_static_asserts=True)),
+        ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('X'))),
+    ]
+    assert _fold(stmts, ['Y', 'type']) == stmts
+
+def test_constant_folding_inlines_across_stmts_eliminated_after_inlining():
+    # After inlining Y into Z, the definition of Y won't be emitted, so X can be inlined across it.
+    x_expr = template_instantiation('F', type_literal('int'), instantiation_might_trigger_static_asserts=True)
+    y_expr = template_instantiation('G', type_literal('int'), instantiation_might_trigger_static_asserts=True)
+    stmts = [
+        ir0.Typedef('X', x_expr),
+        ir0.Typedef('Y', y_expr),
+        ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('X'))),
+        ir0.Typedef('Z', ir0.PointerTypeExpr(local_type_literal('Y'))),
+    ]
+    assert _fold(stmts, ['type', 'Z']) == [
+        ir0.Typedef('type', ir0.PointerTypeExpr(x_expr)),
+        ir0.Typedef('Z', ir0.PointerTypeExpr(y_expr)),
+    ]
+
+def test_constant_folding_long_chain_of_unused_stmts():
+    stmts = [ir0.Typedef('X0', type_literal('int'))]
+    for i in range(1, 5000):
+        stmts.append(ir0.Typedef('X%s' % i, ir0.PointerTypeExpr(local_type_literal('X%s' % (i - 1)))))
+    assert _fold(stmts, []) == []
+
+@pytest.mark.parametrize('num_stmts', [100, 1000, 10000])
+def test_constant_folding_benchmark(num_stmts):
+    # Each X<i> is inlined into Y<i>, crossing all the stmts in between.
+    num_vars = num_stmts // 2
+    x_exprs = [template_instantiation('F%s' % i, type_literal('int'), instantiation_might_trigger_static_asserts=True)
+               for i in range(num_vars)]
+    stmts = [ir0.Typedef('X%s' % i, x_exprs[i])
+             for i in range(num_vars)]
+    stmts += [ir0.Typedef('Y%s' % i, ir0.PointerTypeExpr(local_type_literal('X%s' % i)))
+              for i in range(num_vars)]
+
+    start_time = time.perf_counter()
+    result = _fold(stmts, ['Y%s' % i for i in range(num_vars)])
+    elapsed_seconds = time.perf_counter() - start_time
+    print('Constant folding of a body with %s stmts took %.3fs' % (num_stmts, elapsed_seconds))
+
+    assert result == [ir0.Typedef('Y%s' % i, ir0.PointerTypeExpr(x_exprs[i]))
+                      for i in range(num_vars)]
+
+if __name__== '__main__':
+    main(__file__)
@@ -0,0 +1,127 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import List
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._dead_specialization_elimination import remove_unreachable_specializations
+
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def local_type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=False)
+
+def template_literal(template_name: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                       args=[ir0.TemplateArgType(expr_type=ir0.TypeType(),
+                                                                                 is_variadic=False)],
+                                                       is_metafunction_that_may_return_error=False,
+                                                       may_be_alias=False)
+
+def type_of(template_name: str, arg: ir0.Expr):
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=template_literal(template_name),
+                                                                           args=[arg],
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_name='type',
+                                 member_type=ir0.TypeType())
+
+def specialization(cpp_type: str, body: List[ir0.TemplateBodyElement]):
+    # template <> struct <name><cpp_type> { <body> };
+    return ir0.TemplateSpecialization(args=[],
+                                      patterns=[type_literal(cpp_type)],
+                                      body=body,
+                                      is_metafunction=True)
+
+def template_defn(name: str, specializations: List[ir0.TemplateSpecialization], main_body: List[ir0.TemplateBodyElement] = None):
+    # template <typename T> struct <name> { <main_body> };
+    # (by default: using type = T;)
+    if main_body is None:
+        main_body = [ir0.Typedef('type', local_type_literal('T'))]
+    args = [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T', is_variadic=False)]
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                       patterns=None,
+                                                                       body=main_body,
+                                                                       is_metafunction=True),
+                            specializations=specializations,
+                            name=name,
+                            description='',
+                            result_element_names=['type'],
+                            args=args)
+
+def header(template_defns: List[ir0.TemplateDefn], toplevel_content=(), public_names=()):
+    return ir0.Header(template_defns=template_defns,
+                      toplevel_content=toplevel_content,
+                      public_names=set(public_names),
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def test_remove_unreachable_specializations():
+    int_specialization = specialization('int', [ir0.Typedef('type', type_literal('float'))])
+    double_specialization = specialization('double', [ir0.Typedef('type', type_literal('float'))])
+    toplevel_content = [ir0.Typedef('X', type_of('F', type_literal('int')))]
+
+    result = remove_unreachable_specializations(header([
+        template_defn('F', [int_specialization, double_specialization]),
+    ], toplevel_content=toplevel_content))
+
+    assert result == header([
+        template_defn('F', [int_specialization]),
+    ], toplevel_content=toplevel_content)
+
+def test_remove_unreachable_specializations_instantiation_with_local_var_keeps_specializations():
+    int_specialization = specialization('int', [ir0.Typedef('type', type_literal('float'))])
+    double_specialization = specialization('double', [ir0.Typedef('type', type_literal('float'))])
+    input_header = header([
+        template_defn('F', [int_specialization, double_specialization]),
+        template_defn('G', [], main_body=[ir0.Typedef('type', type_of('F', local_type_literal('T')))]),
+    ], toplevel_content=[ir0.Typedef('X', type_of('G', type_literal('int')))])
+
+    # F<T> might be instantiated with any type.
+    assert remove_unreachable_specializations(input_header) == input_header
+
+def test_remove_unreachable_specializations_escaping_template_not_changed():
+    double_specialization = specialization('double', [ir0.Typedef('type', type_literal('float'))])
+    input_header = header([
+        template_defn('F', [double_specialization]),
+    ], toplevel_content=[ir0.Typedef('X', template_literal('F'))])
+
+    assert remove_unreachable_specializations(input_header) == input_header
+
+def test_remove_unreachable_specializations_public_template_not_changed():
+    double_specialization = specialization('double', [ir0.Typedef('type', type_literal('float'))])
+    input_header = header([
+        template_defn('F', [double_specialization]),
+    ], public_names=['F'])
+
+    assert remove_unreachable_specializations(input_header) == input_header
+
+def test_remove_unreachable_specializations_only_instantiated_in_unreachable_specialization():
+    int_specialization = specialization('int', [ir0.Typedef('type', type_literal('float'))])
+    toplevel_content = [ir0.Typedef('X', type_of('F', type_literal('int')))]
+
+    result = remove_unreachable_specializations(header([
+        template_defn('F', [int_specialization,
+                            specialization('double', [ir0.Typedef('type', type_of('G', type_literal('double')))])]),
+        template_defn('G', [specialization('double', [ir0.Typedef('type', type_literal('float'))])]),
+    ], toplevel_content=toplevel_content))
+
+    assert result == header([
+        template_defn('F', [int_specialization]),
+        template_defn('G', []),
+    ], toplevel_content=toplevel_content)
+
+if __name__== '__main__':
+    main(__file__)
@@ -0,0 +1,149 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import List
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._dead_template_arg_elimination import remove_dead_template_args
+
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def local_type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=False)
+
+def template_literal(template_name: str, num_args: int):
+    return ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                       args=[ir0.TemplateArgType(expr_type=ir0.TypeType(),
+                                                                                 is_variadic=False)] * num_args,
+                                                       is_metafunction_that_may_return_error=False,
+                                                       may_be_alias=False)
+
+def type_of(template_name: str, args: List[ir0.Expr]):
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=template_literal(template_name, len(args)),
+                                                                           args=args,
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_name='type',
+                                 member_type=ir0.TypeType())
+
+def arg_decls(arg_names: List[str]):
+    return [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name=arg_name, is_variadic=False)
+            for arg_name in arg_names]
+
+def template_defn(name: str,
+                  arg_names: List[str],
+                  body: List[ir0.TemplateBodyElement],
+                  specializations: List[ir0.TemplateSpecialization] = ()):
+    # template <typename <arg_names>...> struct <name> { <body> };
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=arg_decls(arg_names),
+                                                                       patterns=None,
+                                                                       body=body,
+                                                                       is_metafunction=True),
+                            specializations=specializations,
+                            name=name,
+                            description='',
+                            result_element_names=['type'],
+                            args=arg_decls(arg_names))
+
+def header(template_defns: List[ir0.TemplateDefn], toplevel_content=(), public_names=()):
+    return ir0.Header(template_defns=template_defns,
+                      toplevel_content=toplevel_content,
+                      public_names=set(public_names),
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def test_remove_dead_template_args():
+    result = remove_dead_template_args(header([
+        template_defn('F', ['T', 'U'], [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T')))]),
+        template_defn('G', ['T'], [ir0.Typedef('type', type_of('F', [local_type_literal('T'), local_type_literal('T')]))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', [type_literal('int'), type_literal('float')])),
+    ], public_names=['G']))
+
+    assert result == header([
+        template_defn('F', ['T'], [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T')))]),
+        template_defn('G', ['T'], [ir0.Typedef('type', type_of('F', [local_type_literal('T')]))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', [type_literal('int')])),
+    ], public_names=['G'])
+
+def test_remove_dead_template_args_used_in_specialization_pattern_not_removed():
+    # template <typename T> struct F<T, int> { using type = T; };
+    specialization = ir0.TemplateSpecialization(args=arg_decls(['T']),
+                                                patterns=[local_type_literal('T'), type_literal('int')],
+                                                body=[ir0.Typedef('type', local_type_literal('T'))],
+                                                is_metafunction=True)
+    input_header = header([
+        template_defn('F', ['T', 'U'], [ir0.Typedef('type', local_type_literal('T'))], specializations=[specialization]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', [type_literal('int'), type_literal('float')])),
+    ])
+    assert remove_dead_template_args(input_header) == input_header
+
+def test_remove_dead_template_args_unused_pattern_var_removed_from_specialization():
+    # template <typename T, typename V> struct F<T*, V> { using type = T; };
+    specialization = ir0.TemplateSpecialization(args=arg_decls(['T', 'V']),
+                                                patterns=[ir0.PointerTypeExpr(local_type_literal('T')), local_type_literal('V')],
+                                                body=[ir0.Typedef('type', local_type_literal('T'))],
+                                                is_metafunction=True)
+    result = remove_dead_template_args(header([
+        template_defn('F', ['T', 'U'], [ir0.Typedef('type', local_type_literal('T'))], specializations=[specialization]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', [type_literal('int'), type_literal('float')])),
+    ]))
+
+    assert result == header([
+        template_defn('F', ['T'], [ir0.Typedef('type', local_type_literal('T'))], specializations=[
+            ir0.TemplateSpecialization(args=arg_decls(['T']),
+                                       patterns=[ir0.PointerTypeExpr(local_type_literal('T'))],
+                                       body=[ir0.Typedef('type', local_type_literal('T'))],
+                                       is_metafunction=True),
+        ]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('F', [type_literal('int')])),
+    ])
+
+def test_remove_dead_template_args_arg_needed_for_dependency_not_removed():
+    # In G, F<T, int> must not become F<int>, that would be instantiated even if G is never instantiated.
+    input_header = header([
+        template_defn('F', ['T', 'U'], [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('U')))]),
+        template_defn('G', ['T'], [ir0.Typedef('type', type_of('F', [local_type_literal('T'), type_literal('int')]))]),
+    ], public_names=['G'])
+    assert remove_dead_template_args(input_header) == input_header
+
+def test_remove_dead_template_args_transitively_unused_arg_removed():
+    # After removing U from F, U is also unused in G.
+    result = remove_dead_template_args(header([
+        template_defn('F', ['T', 'U'], [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T')))]),
+        template_defn('G', ['T', 'U'], [ir0.Typedef('type', type_of('F', [local_type_literal('T'), local_type_literal('U')]))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('G', [type_literal('int'), type_literal('float')])),
+    ]))
+
+    assert result == header([
+        template_defn('F', ['T'], [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T')))]),
+        template_defn('G', ['T'], [ir0.Typedef('type', type_of('F', [local_type_literal('T')]))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', type_of('G', [type_literal('int')])),
+    ])
+
+def test_remove_dead_template_args_public_template_not_changed():
+    input_header = header([
+        template_defn('F', ['T', 'U'], [ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal('T')))]),
+    ], public_names=['F'])
+    assert remove_dead_template_args(input_header) == input_header
+
+if __name__== '__main__':
+    main(__file__)
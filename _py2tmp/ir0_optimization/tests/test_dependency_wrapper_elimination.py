@@ -0,0 +1,124 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import List
+
+from _py2tmp.ir0 import ir0, select1st_literal, GlobalLiterals
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._dependency_wrapper_elimination import eliminate_redundant_dependency_wrappers
+
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def local_type_literal(cpp_type: str, is_variadic: bool = False):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=is_variadic)
+
+def pointer_to(expr: ir0.Expr):
+    return ir0.PointerTypeExpr(expr)
+
+def select1st(lhs: ir0.Expr, rhs: ir0.Expr):
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=select1st_literal(lhs.expr_type, rhs.expr_type),
+                                                                           args=[lhs, rhs],
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_type=lhs.expr_type,
+                                 member_name='value')
+
+def always_true_from_type(expr: ir0.Expr):
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=GlobalLiterals.ALWAYS_TRUE_FROM_TYPE,
+                                                                           args=[expr],
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_type=ir0.BoolType(),
+                                 member_name='value')
+
+def is_same(lhs: ir0.Expr, rhs: ir0.Expr):
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=GlobalLiterals.STD_IS_SAME,
+                                                                           args=[lhs, rhs],
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_type=ir0.BoolType(),
+                                 member_name='value')
+
+def list_of(expr: ir0.Expr):
+    # List<expr...>
+    return ir0.TemplateInstantiation(template_expr=GlobalLiterals.LIST,
+                                     args=[ir0.VariadicTypeExpansion(expr)],
+                                     instantiation_might_trigger_static_asserts=False)
+
+def header_with_template(body: List[ir0.TemplateBodyElement]):
+    # template <typename T, typename... Ts> struct F { <body> };
+    args = [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T', is_variadic=False),
+            ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='Ts', is_variadic=True)]
+    template_defn = ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                                patterns=None,
+                                                                                body=body,
+                                                                                is_metafunction=True),
+                                     specializations=[],
+                                     name='F',
+                                     description='',
+                                     result_element_names=['type'],
+                                     args=args)
+    return ir0.Header(template_defns=[template_defn],
+                      toplevel_content=[],
+                      public_names={'F'},
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def test_eliminate_redundant_dependency_wrappers_select1st_removed():
+    result = eliminate_redundant_dependency_wrappers(header_with_template([
+        ir0.Typedef('type', list_of(select1st(pointer_to(local_type_literal('Ts', is_variadic=True)),
+                                              local_type_literal('Ts', is_variadic=True)))),
+    ]))
+    assert result == header_with_template([
+        ir0.Typedef('type', list_of(pointer_to(local_type_literal('Ts', is_variadic=True)))),
+    ])
+
+def test_eliminate_redundant_dependency_wrappers_select1st_needed_for_pack_expansion_not_removed():
+    # List<Select1stTypeType<T*, Ts>::value...> can't become List<T*...>.
+    input_header = header_with_template([
+        ir0.Typedef('type', list_of(select1st(pointer_to(local_type_literal('T')),
+                                              local_type_literal('Ts', is_variadic=True)))),
+    ])
+    assert eliminate_redundant_dependency_wrappers(input_header) == input_header
+
+def test_eliminate_redundant_dependency_wrappers_select1st_needed_for_dependency_not_removed():
+    # static_assert(Select1stBoolType<false, T>::value) can't become static_assert(false), that would always fail.
+    input_header = header_with_template([
+        ir0.StaticAssert(select1st(ir0.Literal(False), local_type_literal('T')), message='error'),
+        ir0.Typedef('type', local_type_literal('T')),
+    ])
+    assert eliminate_redundant_dependency_wrappers(input_header) == input_header
+
+def test_eliminate_redundant_dependency_wrappers_nested_select1st_merged():
+    result = eliminate_redundant_dependency_wrappers(header_with_template([
+        ir0.Typedef('type', select1st(select1st(type_literal('int'), local_type_literal('T')),
+                                      pointer_to(local_type_literal('T')))),
+    ]))
+    assert result == header_with_template([
+        ir0.Typedef('type', select1st(type_literal('int'), pointer_to(local_type_literal('T')))),
+    ])
+
+def test_eliminate_redundant_dependency_wrappers_always_true_removed():
+    result = eliminate_redundant_dependency_wrappers(header_with_template([
+        ir0.StaticAssert(ir0.BoolBinaryOpExpr(lhs=always_true_from_type(local_type_literal('T')),
+                                              rhs=is_same(local_type_literal('T'), type_literal('int')),
+                                              op='&&'),
+                         message='error'),
+        ir0.Typedef('type', local_type_literal('T')),
+    ]))
+    assert result == header_with_template([
+        ir0.StaticAssert(is_same(local_type_literal('T'), type_literal('int')), message='error'),
+        ir0.Typedef('type', local_type_literal('T')),
+    ])
+
+if __name__== '__main__':
+    main(__file__)
@@ -0,0 +1,105 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+from typing import List
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._global_common_subexpression_elimination import hoist_common_subexpressions
+
+
+def identifier_generator_fun():
+    for i in itertools.count():
+        yield 'X_%s' % i
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def alias_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=True)
+
+def local_type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=False)
+
+def template_instantiation(template_name: str, args: List[ir0.Expr]):
+    template_expr = ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                                args=[ir0.TemplateArgType(expr_type=ir0.TypeType(),
+                                                                                          is_variadic=False)
+                                                                      for _ in args],
+                                                                is_metafunction_that_may_return_error=False,
+                                                                may_be_alias=False)
+    return ir0.TemplateInstantiation(template_expr=template_expr,
+                                     args=args,
+                                     instantiation_might_trigger_static_asserts=False)
+
+def template_defn(name: str, body: List[ir0.TemplateBodyElement]):
+    args = [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T', is_variadic=False)]
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                       patterns=None,
+                                                                       body=body,
+                                                                       is_metafunction=True),
+                            specializations=[],
+                            name=name,
+                            description='',
+                            result_element_names=['type'],
+                            args=args)
+
+def header(template_defns: List[ir0.TemplateDefn], toplevel_content=()):
+    return ir0.Header(template_defns=template_defns,
+                      toplevel_content=toplevel_content,
+                      public_names={template_defn.name for template_defn in template_defns},
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def test_hoist_common_subexpressions_nested():
+    inner_expr = template_instantiation('std::common_type', [type_literal('int'), type_literal('float')])
+    outer_expr = template_instantiation('std::common_type', [inner_expr, type_literal('double')])
+    template_defns = [template_defn('F%s' % i,
+                                    [ir0.Typedef('type', template_instantiation('std::pair', [local_type_literal('T'),
+                                                                                              outer_expr])),
+                                     ir0.Typedef('type2', template_instantiation('std::pair', [local_type_literal('T'),
+                                                                                               inner_expr]))])
+                      for i in range(3)]
+
+    result = hoist_common_subexpressions(header(template_defns), identifier_generator_fun())
+
+    assert list(result.toplevel_content) == [
+        ir0.Typedef('X_1', inner_expr),
+        ir0.Typedef('X_0', template_instantiation('std::common_type', [alias_literal('X_1'), type_literal('double')])),
+    ]
+    assert list(result.template_defns) == [template_defn('F%s' % i,
+                                                         [ir0.Typedef('type', template_instantiation('std::pair', [local_type_literal('T'),
+                                                                                                                   alias_literal('X_0')])),
+                                                          ir0.Typedef('type2', template_instantiation('std::pair', [local_type_literal('T'),
+                                                                                                                    alias_literal('X_1')]))])
+                                           for i in range(3)]
+
+def test_hoist_common_subexpressions_instantiation_of_same_template_not_hoisted():
+    # "F<std::common_type<int, float>>" can't be hoisted out of F: the alias would have to be defined both before F
+    # (since F uses it) and after F (since it instantiates F). Its argument can be hoisted instead.
+    self_instantiation = template_instantiation('F', [template_instantiation('std::common_type', [type_literal('int'), type_literal('float')])])
+    template_defns = [template_defn('F',
+                                    [ir0.Typedef(name, self_instantiation)
+                                     for name in ('x', 'y', 'type')])]
+
+    assert hoist_common_subexpressions(header(template_defns), identifier_generator_fun()) == header([
+        template_defn('F',
+                      [ir0.Typedef(name, template_instantiation('F', [alias_literal('X_0')]))
+                       for name in ('x', 'y', 'type')]),
+    ], toplevel_content=[
+        ir0.Typedef('X_0', template_instantiation('std::common_type', [type_literal('int'), type_literal('float')])),
+    ])
+
+if __name__== '__main__':
+    main(__file__)
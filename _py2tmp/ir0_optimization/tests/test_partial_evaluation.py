@@ -0,0 +1,128 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import List
+
+from _py2tmp.compiler.output_files import ObjectFileContent
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization import ConfigurationKnobs
+from _py2tmp.ir0_optimization._partial_evaluation import evaluate_closed_toplevel_elems
+
+
+def local_int64_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.Int64Type(), is_variadic=False)
+
+def value_of(template_name: str, arg: ir0.Expr):
+    template_expr = ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                                args=[ir0.TemplateArgType(expr_type=ir0.Int64Type(),
+                                                                                          is_variadic=False)],
+                                                                is_metafunction_that_may_return_error=False,
+                                                                may_be_alias=False)
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=template_expr,
+                                                                           args=[arg],
+                                                                           instantiation_might_trigger_static_asserts=True),
+                                 member_name='value',
+                                 member_type=ir0.Int64Type())
+
+def int64_template_defn(name: str, main_body: List[ir0.TemplateBodyElement], zero_body: List[ir0.TemplateBodyElement]):
+    # template <int64_t n> struct <name> { <main_body> };
+    # template <> struct <name><0> { <zero_body> };
+    args = [ir0.TemplateArgDecl(expr_type=ir0.Int64Type(), name='n', is_variadic=False)]
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                       patterns=None,
+                                                                       body=main_body,
+                                                                       is_metafunction=True),
+                            specializations=[ir0.TemplateSpecialization(args=[],
+                                                                        patterns=[ir0.Literal(0)],
+                                                                        body=zero_body,
+                                                                        is_metafunction=True)],
+                            name=name,
+                            description='',
+                            result_element_names=['value'],
+                            args=args)
+
+def factorial_template_defn(main_body_static_asserts: List[ir0.StaticAssert] = ()):
+    n = local_int64_literal('n')
+    return int64_template_defn('Factorial',
+                               main_body=list(main_body_static_asserts) + [
+                                   ir0.ConstantDef('value', ir0.Int64BinaryOpExpr(n,
+                                                                                  value_of('Factorial', ir0.Int64BinaryOpExpr(n, ir0.Literal(1), '-')),
+                                                                                  '*'))],
+                               zero_body=[ir0.ConstantDef('value', ir0.Literal(1))])
+
+def header(template_defns: List[ir0.TemplateDefn], toplevel_content: List[ir0.TemplateBodyElement]):
+    return ir0.Header(template_defns=template_defns,
+                      toplevel_content=toplevel_content,
+                      public_names=set(),
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def evaluate(template_defns: List[ir0.TemplateDefn], toplevel_content: List[ir0.TemplateBodyElement]):
+    result = evaluate_closed_toplevel_elems(header(template_defns, toplevel_content), ObjectFileContent(dict()))
+    assert list(result.template_defns) == template_defns
+    return list(result.toplevel_content)
+
+def test_evaluate_closed_toplevel_elems_recursive_template():
+    assert evaluate([factorial_template_defn()], [
+        ir0.ConstantDef('x', value_of('Factorial', ir0.Literal(10))),
+        ir0.StaticAssert(ir0.ComparisonExpr(value_of('Factorial', ir0.Literal(10)), ir0.Literal(3628800), '=='),
+                         message='assertion failed'),
+    ]) == [
+        ir0.ConstantDef('x', ir0.Literal(3628800)),
+    ]
+
+def test_evaluate_closed_toplevel_elems_uses_cpp_division_semantics():
+    assert evaluate([], [
+        ir0.ConstantDef('x', ir0.Int64BinaryOpExpr(ir0.Literal(-7), ir0.Literal(2), '/')),
+        ir0.ConstantDef('y', ir0.Int64BinaryOpExpr(ir0.Literal(-7), ir0.Literal(2), '%')),
+    ]) == [
+        ir0.ConstantDef('x', ir0.Literal(-3)),
+        ir0.ConstantDef('y', ir0.Literal(-1)),
+    ]
+
+def test_evaluate_closed_toplevel_elems_static_assert_failing_in_template_not_evaluated():
+    # The static_assert in the template must still be reported by the C++ compiler.
+    template_defn = factorial_template_defn(main_body_static_asserts=[
+        ir0.StaticAssert(ir0.ComparisonExpr(local_int64_literal('n'), ir0.Literal(5), '<'), message='n too big')])
+    toplevel_content = [
+        ir0.ConstantDef('x', value_of('Factorial', ir0.Literal(10))),
+        ir0.StaticAssert(ir0.ComparisonExpr(value_of('Factorial', ir0.Literal(10)), ir0.Literal(3628800), '=='),
+                         message='assertion failed'),
+    ]
+    assert evaluate([template_defn], toplevel_content) == toplevel_content
+
+def test_evaluate_closed_toplevel_elems_failing_static_assert_kept():
+    toplevel_content = [
+        ir0.StaticAssert(ir0.ComparisonExpr(value_of('Factorial', ir0.Literal(3)), ir0.Literal(7), '=='),
+                         message='assertion failed'),
+    ]
+    assert evaluate([factorial_template_defn()], toplevel_content) == toplevel_content
+
+def test_evaluate_closed_toplevel_elems_max_depth_reached():
+    toplevel_content = [
+        ir0.StaticAssert(ir0.ComparisonExpr(value_of('Factorial', ir0.Literal(ConfigurationKnobs.partial_evaluation_max_depth + 1)),
+                                            ir0.Literal(0), '!='),
+                         message='assertion failed'),
+    ]
+    assert evaluate([factorial_template_defn()], toplevel_content) == toplevel_content
+
+def test_evaluate_closed_toplevel_elems_overflow_not_evaluated():
+    # The overflow must be reported by the C++ compiler.
+    toplevel_content = [
+        ir0.ConstantDef('x', value_of('Factorial', ir0.Literal(30))),
+    ]
+    assert evaluate([factorial_template_defn()], toplevel_content) == toplevel_content
+
+if __name__== '__main__':
+    main(__file__)
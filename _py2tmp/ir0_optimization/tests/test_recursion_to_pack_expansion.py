@@ -0,0 +1,155 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from _py2tmp.ir0 import ir0, GlobalLiterals
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._recursion_to_pack_expansion import rewrite_list_recursion_as_pack_expansion
+
+
+def local_type(cpp_type: str, is_variadic: bool = False):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=is_variadic)
+
+def local_int64(cpp_type: str, is_variadic: bool = False):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.Int64Type(), is_variadic=is_variadic)
+
+def instantiation(template_expr: ir0.AtomicTypeLiteral, *args: ir0.Expr):
+    return ir0.TemplateInstantiation(template_expr=template_expr,
+                                     args=args,
+                                     instantiation_might_trigger_static_asserts=False)
+
+def member(class_type_expr: ir0.Expr, member_name: str, member_type: ir0.ExprType):
+    return ir0.ClassMemberAccess(class_type_expr=class_type_expr, member_name=member_name, member_type=member_type)
+
+def template_literal(name: str, arg_type: ir0.ExprType = ir0.TypeType()):
+    return ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=name,
+                                                       args=[ir0.TemplateArgType(expr_type=arg_type, is_variadic=False)],
+                                                       is_metafunction_that_may_return_error=False,
+                                                       may_be_alias=False)
+
+IS_POINTER = template_literal('IsPointer')
+F = template_literal('F')
+
+def elem(result_expr: ir0.Expr):
+    if result_expr.expr_type.kind == ir0.ExprKind.TYPE:
+        return ir0.Typedef('type', result_expr)
+    return ir0.ConstantDef('value', result_expr)
+
+def list_recursion_template_defn(list_template: ir0.AtomicTypeLiteral,
+                                 first_var: ir0.AtomicTypeLiteral,
+                                 rest_var: ir0.AtomicTypeLiteral,
+                                 base_expr: ir0.Expr,
+                                 step_expr: ir0.Expr):
+    # template <typename L> struct F { <base_expr> };
+    # template <first_var, rest_var...> struct F<list_template<first_var, rest_var...>> { <step_expr> };
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=[ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='L', is_variadic=False)],
+                                                                       patterns=None,
+                                                                       body=[elem(base_expr)],
+                                                                       is_metafunction=True),
+                            specializations=[ir0.TemplateSpecialization(args=[ir0.TemplateArgDecl(expr_type=first_var.expr_type, name=first_var.cpp_type, is_variadic=False),
+                                                                              ir0.TemplateArgDecl(expr_type=rest_var.expr_type, name=rest_var.cpp_type, is_variadic=True)],
+                                                                        patterns=[instantiation(list_template, first_var, ir0.VariadicTypeExpansion(rest_var))],
+                                                                        body=[elem(step_expr)],
+                                                                        is_metafunction=True)],
+                            name='F',
+                            description='',
+                            result_element_names=['type' if base_expr.expr_type.kind == ir0.ExprKind.TYPE else 'value'],
+                            args=[ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='L', is_variadic=False)])
+
+def rewritten_step(template_defn: ir0.TemplateDefn):
+    new_template_defn, needs_another_loop = rewrite_list_recursion_as_pack_expansion(template_defn)
+    assert not needs_another_loop
+    assert new_template_defn.main_definition == template_defn.main_definition
+    [specialization] = new_template_defn.specializations
+    [body_elem] = specialization.body
+    return list(specialization.args), list(specialization.patterns), body_elem.expr
+
+T = local_type('T')
+Ts = local_type('Ts', is_variadic=True)
+n = local_int64('n')
+ns = local_int64('ns', is_variadic=True)
+
+def test_rewrite_list_recursion_as_pack_expansion_and():
+    template_defn = list_recursion_template_defn(GlobalLiterals.LIST, T, Ts,
+                                                 base_expr=ir0.Literal(True),
+                                                 step_expr=ir0.BoolBinaryOpExpr(lhs=member(instantiation(IS_POINTER, T), 'value', ir0.BoolType()),
+                                                                                rhs=member(instantiation(F, instantiation(GlobalLiterals.LIST, ir0.VariadicTypeExpansion(Ts))), 'value', ir0.BoolType()),
+                                                                                op='&&'))
+    is_pointer_exprs = ir0.VariadicTypeExpansion(member(instantiation(IS_POINTER, Ts), 'value', ir0.BoolType()))
+    assert rewritten_step(template_defn) == (
+        [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='Ts', is_variadic=True)],
+        [instantiation(GlobalLiterals.LIST, ir0.VariadicTypeExpansion(Ts))],
+        member(instantiation(GlobalLiterals.STD_IS_SAME,
+                             instantiation(GlobalLiterals.BOOL_LIST, is_pointer_exprs, ir0.Literal(True)),
+                             instantiation(GlobalLiterals.BOOL_LIST, ir0.Literal(True), is_pointer_exprs)),
+               'value', ir0.BoolType()))
+
+def test_rewrite_list_recursion_as_pack_expansion_or_with_recursive_call_first():
+    template_defn = list_recursion_template_defn(GlobalLiterals.LIST, T, Ts,
+                                                 base_expr=ir0.Literal(False),
+                                                 step_expr=ir0.BoolBinaryOpExpr(lhs=member(instantiation(F, instantiation(GlobalLiterals.LIST, ir0.VariadicTypeExpansion(Ts))), 'value', ir0.BoolType()),
+                                                                                rhs=member(instantiation(IS_POINTER, T), 'value', ir0.BoolType()),
+                                                                                op='||'))
+    is_pointer_exprs = ir0.VariadicTypeExpansion(member(instantiation(IS_POINTER, Ts), 'value', ir0.BoolType()))
+    _, _, expr = rewritten_step(template_defn)
+    assert expr == ir0.NotExpr(member(instantiation(GlobalLiterals.STD_IS_SAME,
+                                                    instantiation(GlobalLiterals.BOOL_LIST, is_pointer_exprs, ir0.Literal(False)),
+                                                    instantiation(GlobalLiterals.BOOL_LIST, ir0.Literal(False), is_pointer_exprs)),
+                                      'value', ir0.BoolType()))
+
+def test_rewrite_list_recursion_as_pack_expansion_sum():
+    template_defn = list_recursion_template_defn(GlobalLiterals.INT_LIST, n, ns,
+                                                 base_expr=ir0.Literal(3),
+                                                 step_expr=ir0.Int64BinaryOpExpr(lhs=ir0.Int64BinaryOpExpr(lhs=n, rhs=ir0.Literal(2), op='*'),
+                                                                                 rhs=member(instantiation(F, instantiation(GlobalLiterals.INT_LIST, ir0.VariadicTypeExpansion(ns))), 'value', ir0.Int64Type()),
+                                                                                 op='+'))
+    _, _, expr = rewritten_step(template_defn)
+    assert expr == member(instantiation(GlobalLiterals.INT64_LIST_SUM,
+                                        instantiation(GlobalLiterals.INT_LIST,
+                                                      ir0.VariadicTypeExpansion(ir0.Int64BinaryOpExpr(lhs=ns, rhs=ir0.Literal(2), op='*')),
+                                                      ir0.Literal(3))),
+                          'value', ir0.Int64Type())
+
+def test_rewrite_list_recursion_as_pack_expansion_map():
+    concat = ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type='TypeListConcat',
+                                                         args=[ir0.TemplateArgType(expr_type=ir0.TypeType(), is_variadic=False),
+                                                               ir0.TemplateArgType(expr_type=ir0.TypeType(), is_variadic=False)],
+                                                         is_metafunction_that_may_return_error=False,
+                                                         may_be_alias=False)
+    template_defn = list_recursion_template_defn(GlobalLiterals.LIST, T, Ts,
+                                                 base_expr=instantiation(GlobalLiterals.LIST),
+                                                 step_expr=member(instantiation(concat,
+                                                                                instantiation(GlobalLiterals.LIST, ir0.PointerTypeExpr(T)),
+                                                                                member(instantiation(F, instantiation(GlobalLiterals.LIST, ir0.VariadicTypeExpansion(Ts))), 'type', ir0.TypeType())),
+                                                                  'type', ir0.TypeType()))
+    _, _, expr = rewritten_step(template_defn)
+    assert expr == instantiation(GlobalLiterals.LIST, ir0.VariadicTypeExpansion(ir0.PointerTypeExpr(Ts)))
+
+def test_rewrite_list_recursion_as_pack_expansion_sum_with_recursive_call_first_not_rewritten():
+    # The additions would be done in a different order, so an overflow might happen in a different place.
+    template_defn = list_recursion_template_defn(GlobalLiterals.INT_LIST, n, ns,
+                                                 base_expr=ir0.Literal(0),
+                                                 step_expr=ir0.Int64BinaryOpExpr(lhs=member(instantiation(F, instantiation(GlobalLiterals.INT_LIST, ir0.VariadicTypeExpansion(ns))), 'value', ir0.Int64Type()),
+                                                                                 rhs=n,
+                                                                                 op='+'))
+    assert rewrite_list_recursion_as_pack_expansion(template_defn) == (template_defn, False)
+
+def test_rewrite_list_recursion_as_pack_expansion_elem_expr_using_rest_not_rewritten():
+    template_defn = list_recursion_template_defn(GlobalLiterals.INT_LIST, n, ns,
+                                                 base_expr=ir0.Literal(0),
+                                                 step_expr=ir0.Int64BinaryOpExpr(lhs=member(instantiation(GlobalLiterals.INT64_LIST_SUM, instantiation(GlobalLiterals.INT_LIST, ir0.VariadicTypeExpansion(ns))), 'value', ir0.Int64Type()),
+                                                                                 rhs=member(instantiation(F, instantiation(GlobalLiterals.INT_LIST, ir0.VariadicTypeExpansion(ns))), 'value', ir0.Int64Type()),
+                                                                                 op='+'))
+    assert rewrite_list_recursion_as_pack_expansion(template_defn) == (template_defn, False)
+
+if __name__== '__main__':
+    main(__file__)
@@ -0,0 +1,84 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._specialization_index import SpecializationIndex
+
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def local_type_literal(cpp_type: str, is_variadic: bool = False):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=is_variadic)
+
+def specialization(patterns: List[ir0.Expr], arg_names: List[str]):
+    return ir0.TemplateSpecialization(args=[ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name=name, is_variadic=name.endswith('s'))
+                                            for name in arg_names],
+                                      patterns=patterns,
+                                      body=[],
+                                      is_metafunction=False)
+
+def template_defn(specializations: List[ir0.TemplateSpecialization], num_args: int = 1):
+    return ir0.TemplateDefn(main_definition=None,
+                            specializations=specializations,
+                            name='F',
+                            description='',
+                            result_element_names=[],
+                            args=[ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T%s' % i, is_variadic=False)
+                                  for i in range(num_args)])
+
+def test_specialization_index_discards_different_heads():
+    pointer_specialization = specialization([ir0.PointerTypeExpr(local_type_literal('T'))], ['T'])
+    const_specialization = specialization([ir0.ConstTypeExpr(local_type_literal('T'))], ['T'])
+    int_specialization = specialization([type_literal('int')], [])
+    index = SpecializationIndex(template_defn([pointer_specialization, const_specialization, int_specialization]))
+
+    assert index.get_candidate_specializations([ir0.PointerTypeExpr(type_literal('float'))]) == [pointer_specialization]
+    assert index.get_candidate_specializations([ir0.ConstTypeExpr(type_literal('float'))]) == [const_specialization]
+    assert index.get_candidate_specializations([type_literal('int')]) == [int_specialization]
+    assert index.get_candidate_specializations([type_literal('float')]) == []
+
+def test_specialization_index_discards_different_nested_heads():
+    int_pointer_specialization = specialization([ir0.PointerTypeExpr(type_literal('int'))], [])
+    pointer_specialization = specialization([ir0.PointerTypeExpr(local_type_literal('T'))], ['T'])
+    index = SpecializationIndex(template_defn([int_pointer_specialization, pointer_specialization]))
+
+    assert index.get_candidate_specializations([ir0.PointerTypeExpr(type_literal('int'))]) == [int_pointer_specialization,
+                                                                                                pointer_specialization]
+    assert index.get_candidate_specializations([ir0.PointerTypeExpr(type_literal('float'))]) == [pointer_specialization]
+
+def test_specialization_index_wildcard_in_args_matches_everything():
+    pointer_specialization = specialization([ir0.PointerTypeExpr(type_literal('int')), type_literal('float')], [])
+    const_specialization = specialization([ir0.ConstTypeExpr(local_type_literal('T')), type_literal('double')], ['T'])
+    index = SpecializationIndex(template_defn([pointer_specialization, const_specialization], num_args=2))
+
+    assert index.get_candidate_specializations([local_type_literal('U'), type_literal('float')]) == [pointer_specialization]
+    assert index.get_candidate_specializations([local_type_literal('U'), local_type_literal('V')]) == [pointer_specialization,
+                                                                                                        const_specialization]
+
+def test_specialization_index_variadic_patterns_always_candidates():
+    variadic_specialization = specialization([ir0.FunctionTypeExpr(type_literal('int'),
+                                                                   [ir0.VariadicTypeExpansion(local_type_literal('Ts', is_variadic=True))])],
+                                             ['Ts'])
+    pointer_specialization = specialization([ir0.PointerTypeExpr(local_type_literal('T'))], ['T'])
+    index = SpecializationIndex(template_defn([variadic_specialization, pointer_specialization]))
+
+    assert index.get_candidate_specializations([type_literal('float')]) == [variadic_specialization]
+    assert index.get_candidate_specializations([ir0.FunctionTypeExpr(type_literal('int'), [])]) == [variadic_specialization]
+
+if __name__== '__main__':
+    main(__file__)
@@ -0,0 +1,147 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import List
+
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization._template_deduplication import merge_equivalent_template_defns
+
+
+def type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_type(cpp_type, may_be_alias=False)
+
+def local_type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=False)
+
+def template_literal(template_name: str):
+    return ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                       args=[ir0.TemplateArgType(expr_type=ir0.TypeType(),
+                                                                                 is_variadic=False)],
+                                                       is_metafunction_that_may_return_error=False,
+                                                       may_be_alias=False)
+
+def type_of(template_name: str, arg: ir0.Expr):
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=template_literal(template_name),
+                                                                           args=[arg],
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_name='type',
+                                 member_type=ir0.TypeType())
+
+def template_defn(name: str, arg_name: str, body: List[ir0.TemplateBodyElement]):
+    args = [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name=arg_name, is_variadic=False)]
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                       patterns=None,
+                                                                       body=body,
+                                                                       is_metafunction=True),
+                            specializations=[],
+                            name=name,
+                            description='',
+                            result_element_names=['type'],
+                            args=args)
+
+def pointer_template_defn(name: str, arg_name: str, local_var_name: str):
+    return template_defn(name, arg_name, [
+        ir0.Typedef(local_var_name, ir0.PointerTypeExpr(local_type_literal(arg_name))),
+        ir0.Typedef('type', ir0.PointerTypeExpr(local_type_literal(local_var_name))),
+    ])
+
+def header(template_defns: List[ir0.TemplateDefn], toplevel_content=(), public_names=()):
+    return ir0.Header(template_defns=template_defns,
+                      toplevel_content=toplevel_content,
+                      public_names=set(public_names),
+                      split_template_name_by_old_name_and_result_element_name=dict(),
+                      check_if_error_specializations=[])
+
+def test_merge_equivalent_template_defns_up_to_renaming():
+    result = merge_equivalent_template_defns(header([
+        pointer_template_defn('F', 'T', 'X'),
+        pointer_template_defn('G', 'U', 'Y'),
+        template_defn('H', 'T', [ir0.Typedef('type', ir0.FunctionTypeExpr(type_of('F', local_type_literal('T')),
+                                                                          [type_of('G', local_type_literal('T'))]))]),
+    ], public_names=['H']))
+
+    assert result == header([
+        pointer_template_defn('F', 'T', 'X'),
+        template_defn('H', 'T', [ir0.Typedef('type', ir0.FunctionTypeExpr(type_of('F', local_type_literal('T')),
+                                                                          [type_of('F', local_type_literal('T'))]))]),
+    ], public_names=['H'])
+
+def test_merge_equivalent_template_defns_merges_templates_equivalent_after_merging_others():
+    result = merge_equivalent_template_defns(header([
+        pointer_template_defn('F', 'T', 'X'),
+        pointer_template_defn('G', 'T', 'X'),
+        template_defn('F2', 'T', [ir0.Typedef('type', type_of('F', local_type_literal('T')))]),
+        template_defn('G2', 'T', [ir0.Typedef('type', type_of('G', local_type_literal('T')))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', ir0.FunctionTypeExpr(type_of('F2', type_literal('int')), [type_of('G2', type_literal('int'))])),
+    ]))
+
+    assert result == header([
+        pointer_template_defn('F', 'T', 'X'),
+        template_defn('F2', 'T', [ir0.Typedef('type', type_of('F', local_type_literal('T')))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', ir0.FunctionTypeExpr(type_of('F2', type_literal('int')), [type_of('F2', type_literal('int'))])),
+    ])
+
+def test_merge_equivalent_template_defns_mutually_recursive_templates_merged():
+    result = merge_equivalent_template_defns(header([
+        template_defn('F1', 'T', [ir0.Typedef('type', type_of('F2', ir0.PointerTypeExpr(local_type_literal('T'))))]),
+        template_defn('F2', 'T', [ir0.Typedef('type', type_of('F1', ir0.PointerTypeExpr(local_type_literal('T'))))]),
+        template_defn('G1', 'U', [ir0.Typedef('type', type_of('G2', ir0.PointerTypeExpr(local_type_literal('U'))))]),
+        template_defn('G2', 'U', [ir0.Typedef('type', type_of('G1', ir0.PointerTypeExpr(local_type_literal('U'))))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', ir0.FunctionTypeExpr(type_of('F1', type_literal('int')), [type_of('G1', type_literal('int'))])),
+    ]))
+
+    # F1, F2, G1 and G2 are all equivalent.
+    assert result == header([
+        template_defn('F1', 'T', [ir0.Typedef('type', type_of('F1', ir0.PointerTypeExpr(local_type_literal('T'))))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', ir0.FunctionTypeExpr(type_of('F1', type_literal('int')), [type_of('F1', type_literal('int'))])),
+    ])
+
+def test_merge_equivalent_template_defns_different_templates_not_merged():
+    h = header([
+        pointer_template_defn('F', 'T', 'X'),
+        template_defn('G', 'T', [ir0.Typedef('type', ir0.ReferenceTypeExpr(local_type_literal('T')))]),
+    ], toplevel_content=[
+        ir0.Typedef('X', ir0.FunctionTypeExpr(type_of('F', type_literal('int')), [type_of('G', type_literal('int'))])),
+    ])
+
+    assert merge_equivalent_template_defns(h) == h
+
+def test_merge_equivalent_template_defns_public_templates_not_merged():
+    h = header([
+        pointer_template_defn('F', 'T', 'X'),
+        pointer_template_defn('G', 'T', 'X'),
+    ], public_names=['F', 'G'])
+
+    assert merge_equivalent_template_defns(h) == h
+
+def test_merge_equivalent_template_defns_templates_used_as_types_not_merged():
+    # Merging these would make std::is_same<F<int>, G<int>> true.
+    h = header([
+        pointer_template_defn('F', 'T', 'X'),
+        pointer_template_defn('G', 'T', 'X'),
+    ], toplevel_content=[
+        ir0.Typedef('X', ir0.FunctionTypeExpr(ir0.TemplateInstantiation(template_expr=template_literal('F'),
+                                                                        args=[type_literal('int')],
+                                                                        instantiation_might_trigger_static_asserts=False),
+                                              [type_of('G', type_literal('int'))])),
+    ])
+
+    assert merge_equivalent_template_defns(h) == h
+
+if __name__== '__main__':
+    main(__file__)
@@ -0,0 +1,98 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import itertools
+from typing import List, Dict
+
+from _py2tmp.compiler.output_files import ObjectFileContent
+from _py2tmp.ir0 import ir0
+from _py2tmp.compiler.testing import main
+from _py2tmp.ir0_optimization import ConfigurationKnobs
+from _py2tmp.ir0_optimization._template_instantiation_inlining import perform_template_inlining
+
+
+def local_type_literal(cpp_type: str):
+    return ir0.AtomicTypeLiteral.for_local(cpp_type, expr_type=ir0.TypeType(), is_variadic=False)
+
+def type_of(template_name: str, arg: ir0.Expr):
+    template_expr = ir0.AtomicTypeLiteral.for_nonlocal_template(cpp_type=template_name,
+                                                                args=[ir0.TemplateArgType(expr_type=ir0.TypeType(),
+                                                                                          is_variadic=False)],
+                                                                is_metafunction_that_may_return_error=False,
+                                                                may_be_alias=False)
+    return ir0.ClassMemberAccess(class_type_expr=ir0.TemplateInstantiation(template_expr=template_expr,
+                                                                           args=[arg],
+                                                                           instantiation_might_trigger_static_asserts=False),
+                                 member_name='type',
+                                 member_type=ir0.TypeType())
+
+def template_defn(name: str, body: List[ir0.TemplateBodyElement]):
+    # template <typename T> struct <name> { <body> };
+    args = [ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T', is_variadic=False)]
+    return ir0.TemplateDefn(main_definition=ir0.TemplateSpecialization(args=args,
+                                                                       patterns=None,
+                                                                       body=body,
+                                                                       is_metafunction=True),
+                            specializations=[],
+                            name=name,
+                            description='',
+                            result_element_names=['type'],
+                            args=args)
+
+def pointers_template_defn(name: str, num_pointers: int):
+    # template <typename T> struct <name> { using type = T**...*; };
+    expr = local_type_literal('T')
+    for _ in range(num_pointers):
+        expr = ir0.PointerTypeExpr(expr)
+    return template_defn(name, [ir0.Typedef('type', expr)])
+
+def inline(template_defn: ir0.TemplateDefn,
+           inlineable_template_defns: List[ir0.TemplateDefn],
+           num_references_by_template_name: Dict[str, int]):
+    identifier_generator = ('X%s' % i for i in itertools.count())
+    result, _ = perform_template_inlining(template_defn,
+                                          {inlineable_template_defn.name
+                                           for inlineable_template_defn in inlineable_template_defns},
+                                          {inlineable_template_defn.name: inlineable_template_defn
+                                           for inlineable_template_defn in inlineable_template_defns},
+                                          identifier_generator,
+                                          ObjectFileContent(dict()),
+                                          num_references_by_template_name)
+    return result
+
+def test_template_inlining_small_template_inlined():
+    result = inline(template_defn('F', [ir0.Typedef('type', type_of('G', local_type_literal('T')))]),
+                    [pointers_template_defn('G', 2)],
+                    {'G': 1})
+    assert result == pointers_template_defn('F', 2)
+
+def test_template_inlining_large_template_not_inlined():
+    caller = template_defn('F', [ir0.Typedef('type', type_of('G', local_type_literal('T')))])
+    num_pointers = ConfigurationKnobs.inlining_max_compile_cost_increase + ConfigurationKnobs.inlining_cost_per_template_instantiation + 10
+    result = inline(caller, [pointers_template_defn('G', num_pointers)], {'G': 1})
+    assert result == caller
+
+def test_template_inlining_max_compile_cost_increase_is_configurable():
+    caller = template_defn('F', [ir0.Typedef('type', type_of('G', local_type_literal('T')))])
+    old_max_compile_cost_increase = ConfigurationKnobs.inlining_max_compile_cost_increase
+    ConfigurationKnobs.inlining_max_compile_cost_increase = 0
+    try:
+        # With 1 reference, the instantiation cost that we save is more than the cost of the added nodes.
+        assert inline(caller, [pointers_template_defn('G', 10)], {'G': 1}) == pointers_template_defn('F', 10)
+        # With many references, the C++ compiler would reuse the instantiation so inlining it only increases the cost.
+        assert inline(caller, [pointers_template_defn('G', 10)], {'G': 100}) == caller
+    finally:
+        ConfigurationKnobs.inlining_max_compile_cost_increase = old_max_compile_cost_increase
+
+if __name__== '__main__':
+    main(__file__)
@@ -12,13 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import itertools
-from typing import List, Union, Set
+from typing import List, Union, Set, Dict
 
 import pytest
 
 from _py2tmp.ir0 import ir0
 from _py2tmp.compiler.testing import main
-from _py2tmp.ir0_optimization._unify import UnificationResultKind, _unify as unify_ir0, UnificationResult
+from _py2tmp.ir0_optimization import ConfigurationKnobs
+from _py2tmp.ir0_optimization._unify import UnificationResultKind, _unify as unify_ir0, UnificationResult, \
+    find_matches_in_unification_of_template_instantiation_with_definition, clear_unification_cache
 
 
 def identifier_generator_fun():
@@ -471,5 +473,121 @@ def test_unify_ir0_variadic_type_variable_matches_multiple_variadics():
                                                                     expr_type=ir0.TypeType(), is_variadic=True))]),
     ]
 
+@pytest.fixture
+def empty_unification_cache():
+    old_hit_counter = ConfigurationKnobs.unification_cache_hit_counter
+    old_miss_counter = ConfigurationKnobs.unification_cache_miss_counter
+    clear_unification_cache()
+    try:
+        yield
+    finally:
+        clear_unification_cache()
+        ConfigurationKnobs.unification_cache_hit_counter = old_hit_counter
+        ConfigurationKnobs.unification_cache_miss_counter = old_miss_counter
+
+def _remove_pointer_template_defn(body_description: str = ''):
+    template_arg_decl = ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T', is_variadic=False)
+    specialization = ir0.TemplateSpecialization(args=[template_arg_decl],
+                                                patterns=[ir0.PointerTypeExpr(local_type_literal('T'))],
+                                                body=[ir0.Typedef(name='type', expr=local_type_literal('T'), description=body_description)],
+                                                is_metafunction=True)
+    return ir0.TemplateDefn(main_definition=None,
+                            specializations=[specialization],
+                            name='RemovePointer',
+                            description='',
+                            result_element_names=['type'],
+                            args=[template_arg_decl])
+
+def _remove_pointer_instantiation(template_defn: ir0.TemplateDefn, arg: ir0.Expr):
+    return ir0.TemplateInstantiation(template_expr=ir0.AtomicTypeLiteral.from_nonlocal_template_defn(template_defn,
+                                                                                                     is_metafunction_that_may_return_error=False),
+                                     args=[arg],
+                                     instantiation_might_trigger_static_asserts=False)
+
+def _find_matches(template_instantiation: ir0.TemplateInstantiation,
+                  local_var_definitions: Dict[str, ir0.Expr],
+                  template_defn: ir0.TemplateDefn):
+    identifier_generator = iter(identifier_generator_fun())
+    result = find_matches_in_unification_of_template_instantiation_with_definition(template_instantiation,
+                                                                                   local_var_definitions,
+                                                                                   template_defn,
+                                                                                   identifier_generator,
+                                                                                   verbose=True)
+    # This must always use exactly 1 identifier, regardless of whether the result was cached.
+    assert next(identifier_generator) == 'X_1'
+    return result
+
+def test_find_matches_in_unification_of_template_instantiation_with_definition_uses_cache(empty_unification_cache):
+    template_defn = _remove_pointer_template_defn()
+    template_instantiation = _remove_pointer_instantiation(template_defn, ir0.PointerTypeExpr(local_type_literal('U')))
+    [specialization] = template_defn.specializations
+    expected_result = ([(specialization, [(local_type_literal('T'), ir0.ConstTypeExpr(type_literal('int')))], [])], [])
+
+    result1 = _find_matches(template_instantiation, {'U': ir0.ConstTypeExpr(type_literal('int'))}, template_defn)
+    assert (ConfigurationKnobs.unification_cache_hit_counter, ConfigurationKnobs.unification_cache_miss_counter) == (0, 1)
+    # V is not referenced by the instantiation, so this can reuse the cached result.
+    result2 = _find_matches(template_instantiation,
+                            {'U': ir0.ConstTypeExpr(type_literal('int')), 'V': type_literal('float')},
+                            template_defn)
+    assert (ConfigurationKnobs.unification_cache_hit_counter, ConfigurationKnobs.unification_cache_miss_counter) == (1, 1)
+    assert result1 == expected_result
+    assert result2 == expected_result
+
+def test_find_matches_in_unification_of_template_instantiation_with_definition_cache_distinguishes_definitions(empty_unification_cache):
+    template_defn = _remove_pointer_template_defn()
+    template_instantiation = _remove_pointer_instantiation(template_defn, ir0.PointerTypeExpr(local_type_literal('U')))
+
+    certain_matches1, _ = _find_matches(template_instantiation, {'U': ir0.ConstTypeExpr(type_literal('int'))}, template_defn)
+    certain_matches2, _ = _find_matches(template_instantiation, {'U': ir0.ConstTypeExpr(type_literal('float'))}, template_defn)
+    assert (ConfigurationKnobs.unification_cache_hit_counter, ConfigurationKnobs.unification_cache_miss_counter) == (0, 2)
+    [(_, [(_, value1)], _)] = certain_matches1
+    [(_, [(_, value2)], _)] = certain_matches2
+    assert value1 == ir0.ConstTypeExpr(type_literal('int'))
+    assert value2 == ir0.ConstTypeExpr(type_literal('float'))
+
+def test_find_matches_in_unification_of_template_instantiation_with_definition_cache_returns_current_specializations(empty_unification_cache):
+    template_defn1 = _remove_pointer_template_defn(body_description='old')
+    template_defn2 = _remove_pointer_template_defn(body_description='new')
+    template_instantiation = _remove_pointer_instantiation(template_defn1, ir0.PointerTypeExpr(type_literal('int')))
+
+    _find_matches(template_instantiation, dict(), template_defn1)
+    # Only the bodies are different, so this is a cache hit, but the result must refer to the new specialization.
+    [(specialization, _, _)], _ = _find_matches(template_instantiation, dict(), template_defn2)
+    assert (ConfigurationKnobs.unification_cache_hit_counter, ConfigurationKnobs.unification_cache_miss_counter) == (1, 1)
+    assert specialization is template_defn2.specializations[0]
+
+@pytest.mark.parametrize('arg,local_var_definitions', [
+    (ir0.PointerTypeExpr(type_literal('int')), dict()),
+    (local_type_literal('U'), {'U': ir0.PointerTypeExpr(type_literal('int'))}),
+], ids = [
+    'int*',
+    'U with U=int*',
+])
+def test_find_matches_in_unification_of_template_instantiation_with_definition_with_specialization_index(arg, local_var_definitions, empty_unification_cache):
+    template_arg_decl = ir0.TemplateArgDecl(expr_type=ir0.TypeType(), name='T', is_variadic=False)
+    pointer_specialization = ir0.TemplateSpecialization(args=[template_arg_decl],
+                                                        patterns=[ir0.PointerTypeExpr(local_type_literal('T'))],
+                                                        body=[],
+                                                        is_metafunction=False)
+    float_pointer_specialization = ir0.TemplateSpecialization(args=[],
+                                                              patterns=[ir0.PointerTypeExpr(type_literal('float'))],
+                                                              body=[],
+                                                              is_metafunction=False)
+    const_specialization = ir0.TemplateSpecialization(args=[template_arg_decl],
+                                                      patterns=[ir0.ConstTypeExpr(local_type_literal('T'))],
+                                                      body=[],
+                                                      is_metafunction=False)
+    template_defn = ir0.TemplateDefn(main_definition=None,
+                                     specializations=[const_specialization, float_pointer_specialization, pointer_specialization],
+                                     name='F',
+                                     description='',
+                                     result_element_names=[],
+                                     args=[template_arg_decl])
+    template_instantiation = _remove_pointer_instantiation(template_defn, arg)
+
+    certain_matches, possible_matches = _find_matches(template_instantiation, local_var_definitions, template_defn)
+    assert certain_matches == [(pointer_specialization, [(local_type_literal('T'), type_literal('int'))], [])]
+    assert possible_matches == []
+
 if __name__== '__main__':
     main(__file__)
@@ -0,0 +1,186 @@
+#  Copyright 2017 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Optional, List, Tuple
+
+from _py2tmp.ir2 import ir, get_free_variables
+from _py2tmp.ir2._visitor import Visitor
+
+
+class _ReferencesGlobalFunction(Visitor):
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.found = False
+
+    def visit_var_reference(self, var_reference: ir.VarReference):
+        if var_reference.is_global_function and var_reference.name == self.function_name:
+            self.found = True
+
+def _references_global_function(expr: ir.Expr, function_name: str):
+    visitor = _ReferencesGlobalFunction(function_name)
+    visitor.visit_expr(expr)
+    return visitor.found
+
+def _get_counter_var_and_base_value(cond_expr: ir.Expr) -> Optional[Tuple[str, int]]:
+    # n == c or c == n
+    if not isinstance(cond_expr, ir.EqualityComparison):
+        return None
+    for var, literal in ((cond_expr.lhs, cond_expr.rhs), (cond_expr.rhs, cond_expr.lhs)):
+        if (isinstance(var, ir.VarReference)
+                and not var.is_global_function
+                and var.expr_type == ir.IntType()
+                and isinstance(literal, ir.IntLiteral)):
+            return var.name, literal.value
+    return None
+
+def _get_base_and_recursive_return_stmts(body: List[ir.Stmt]) -> Optional[Tuple[ir.Expr, ir.ReturnStmt, ir.ReturnStmt]]:
+    # if <cond>:
+    #   return <base>
+    # else:
+    #   return <recursive call>
+    #
+    # (the "else:" is optional)
+    if len(body) == 1 and isinstance(body[0], ir.IfStmt) and len(body[0].else_stmts) == 1:
+        [if_stmt] = body
+        [recursive_return_stmt] = if_stmt.else_stmts
+    elif len(body) == 2 and isinstance(body[0], ir.IfStmt) and not body[0].else_stmts:
+        if_stmt, recursive_return_stmt = body
+    else:
+        return None
+    if len(if_stmt.if_stmts) != 1:
+        return None
+    [base_return_stmt] = if_stmt.if_stmts
+    if not isinstance(base_return_stmt, ir.ReturnStmt) or not isinstance(recursive_return_stmt, ir.ReturnStmt):
+        return None
+    return if_stmt.cond_expr, base_return_stmt, recursive_return_stmt
+
+def _is_var_reference(expr: ir.Expr, name: str):
+    return isinstance(expr, ir.VarReference) and not expr.is_global_function and expr.name == name
+
+def _int_binary_op(lhs: ir.Expr, rhs: ir.Expr, op: str):
+    if isinstance(rhs, ir.IntLiteral) and rhs.value == 0 and op in ('+', '-'):
+        return lhs
+    if isinstance(lhs, ir.IntLiteral) and lhs.value == 0 and op == '+':
+        return rhs
+    return ir.IntBinaryOpExpr(lhs=lhs, rhs=rhs, op=op)
+
+def _call_with_args(call: ir.FunctionCall, replacement_arg_by_index: List[Tuple[int, ir.Expr]]):
+    args = list(call.args)
+    for index, arg in replacement_arg_by_index:
+        args[index] = arg
+    return ir.FunctionCall(fun_expr=call.fun_expr, args=args, may_throw=call.may_throw)
+
+def _rewrite_function_defn(function_defn: ir.FunctionDefn) -> Optional[ir.FunctionDefn]:
+    result = _get_base_and_recursive_return_stmts(function_defn.body)
+    if result is None:
+        return None
+    cond_expr, base_return_stmt, recursive_return_stmt = result
+    counter_var_and_base_value = _get_counter_var_and_base_value(cond_expr)
+    if counter_var_and_base_value is None:
+        return None
+    counter_var_name, base_value = counter_var_and_base_value
+
+    call = recursive_return_stmt.expr
+    if not (isinstance(call, ir.FunctionCall)
+            and isinstance(call.fun_expr, ir.VarReference)
+            and call.fun_expr.is_global_function
+            and call.fun_expr.source_module is None
+            and call.fun_expr.name == function_defn.name):
+        return None
+
+    # The base case must return the state arg unchanged.
+    if not isinstance(base_return_stmt.expr, ir.VarReference) or base_return_stmt.expr.is_global_function:
+        return None
+    state_var_name = base_return_stmt.expr.name
+
+    arg_names = [arg.name for arg in function_defn.args]
+    if counter_var_name not in arg_names or state_var_name not in arg_names or counter_var_name == state_var_name:
+        return None
+    counter_arg_index = arg_names.index(counter_var_name)
+    state_arg_index = arg_names.index(state_var_name)
+    if function_defn.args[state_arg_index].expr_type != function_defn.return_type:
+        return None
+
+    for index, (arg_name, arg_expr) in enumerate(zip(arg_names, call.args)):
+        if index == counter_arg_index:
+            # f(..., n - 1, ...)
+            if not (isinstance(arg_expr, ir.IntBinaryOpExpr)
+                    and arg_expr.op == '-'
+                    and _is_var_reference(arg_expr.lhs, counter_var_name)
+                    and isinstance(arg_expr.rhs, ir.IntLiteral)
+                    and arg_expr.rhs.value == 1):
+                return None
+        elif index == state_arg_index:
+            # f(..., g(t), ...) where g doesn't depend on n.
+            if counter_var_name in get_free_variables(arg_expr) or _references_global_function(arg_expr, function_defn.name):
+                return None
+        elif not _is_var_reference(arg_expr, arg_name):
+            # Other args must be passed through unchanged.
+            return None
+
+    # f(t, n) == g^(n-c)(t), so we can compute it as f(f(t, c + (n - c) // 2), n - (n - c) // 2).
+    #
+    # if n == c:
+    #   return t
+    # elif n == c + 1:
+    #   return f(g(t), n - 1)
+    # else:
+    #   return f(f(t, c + (n - c) // 2), n - (n - c) // 2)
+    counter_var = ir.VarReference(expr_type=ir.IntType(),
+                                  name=counter_var_name,
+                                  is_global_function=False,
+                                  is_function_that_may_throw=False)
+    half = ir.IntBinaryOpExpr(lhs=_int_binary_op(counter_var, ir.IntLiteral(base_value), '-'),
+                              rhs=ir.IntLiteral(2),
+                              op='//')
+    first_half_call = _call_with_args(call, [(state_arg_index, base_return_stmt.expr),
+                                             (counter_arg_index, _int_binary_op(ir.IntLiteral(base_value), half, '+'))])
+    second_half_call = _call_with_args(call, [(state_arg_index, first_half_call),
+                                              (counter_arg_index, ir.IntBinaryOpExpr(lhs=counter_var, rhs=half, op='-'))])
+    body = [
+        ir.IfStmt(cond_expr=cond_expr,
+                  if_stmts=[base_return_stmt],
+                  else_stmts=[
+                      ir.IfStmt(cond_expr=ir.EqualityComparison(lhs=counter_var, rhs=ir.IntLiteral(base_value + 1)),
+                                if_stmts=[recursive_return_stmt],
+                                else_stmts=[ir.ReturnStmt(second_half_call)])
+                  ])
+    ]
+    return ir.FunctionDefn(name=function_defn.name,
+                           args=function_defn.args,
+                           body=body,
+                           return_type=function_defn.return_type)
+
+# Rewrites functions of the form:
+#
+# def f(t: T, n: int) -> T:
+#     if n == 0:
+#         return t
+#     else:
+#         return f(g(t), n - 1)
+#
+# (where g doesn't depend on n) so that they recurse on n // 2 instead of n - 1. This makes the depth of the template
+# instantiations O(log n) instead of O(n), so that large values of n don't hit the compiler's template depth limit.
+# The number of template instantiations is still O(n) and the applications of g happen in the same order, so any error
+# is still reported in the same way.
+def rewrite_counting_recursion_with_logarithmic_depth(module: ir.Module):
+    function_defns = []
+    for function_defn in module.function_defns:
+        new_function_defn = _rewrite_function_defn(function_defn)
+        function_defns.append(new_function_defn if new_function_defn is not None else function_defn)
+
+    return ir.Module(function_defns=function_defns,
+                     assertions=module.assertions,
+                     custom_types=module.custom_types,
+                     public_names=module.public_names)
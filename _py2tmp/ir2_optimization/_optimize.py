@@ -13,9 +13,11 @@
 # limitations under the License.
 from _py2tmp.compiler.output_files import ObjectFileContent
 from _py2tmp.ir2 import ir2
+from _py2tmp.ir2_optimization._logarithmic_depth_recursion import rewrite_counting_recursion_with_logarithmic_depth
 from _py2tmp.ir2_optimization._recalculate_function_can_throw_info import recalculate_function_can_throw_info
 
 
 def optimize_module(module: ir2.Module, context_object_file_content: ObjectFileContent):
     module = recalculate_function_can_throw_info(module, context_object_file_content)
+    module = rewrite_counting_recursion_with_logarithmic_depth(module)
     return module
@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import List, Union, Dict, Tuple, Optional
+from typing import List, Union, Dict, Tuple, Optional, Sequence, FrozenSet
 
 from _py2tmp.unification import UnificationAmbiguousException, UnificationFailedException
 from _py2tmp.unification._strategy import TermT, UnificationStrategy, ListExpansion
@@ -20,10 +20,15 @@ from _py2tmp.unification._utils import ensure_list, exprs_to_string, expr_to_str
 _NonListExpr = Union[str, TermT]
 _Expr = Union[_NonListExpr, List[_NonListExpr]]
 
+# An equation between the sublists lhs[lhs_begin:lhs_end] and rhs[rhs_begin:rhs_end]. We use index ranges instead of
+# slicing the lists so that processing long lists one element at a time stays linear.
+# The sequences in these equations are never modified.
+_ListListEquation = Tuple[Sequence[_NonListExpr], int, int,
+                          Sequence[_NonListExpr], int, int]
+
 class _UnificationContext:
     def __init__(self,
-                 expr_expr_equations: List[Tuple[List[_NonListExpr],
-                                                 List[_NonListExpr]]],
+                 expr_expr_equations: List[_ListListEquation],
                  context_var_expr_equations: Dict[str, _NonListExpr],
                  strategy: UnificationStrategy[TermT]):
         self.expr_expr_equations = expr_expr_equations
@@ -34,38 +39,88 @@ class _UnificationContext:
         self.var_expr_equations: Dict[str, _NonListExpr] = dict()
         # Each (var, exprs) entry here represents an equation: ListExpansion(var)=exprs
         self.expanded_var_expr_equations: Dict[str, List[_NonListExpr]] = dict()
+        # A union-find forest over the var=var equations in var_expr_equations, with path compression. This is only used
+        # to speed up lookups, the result is still computed from var_expr_equations.
+        self.parent_var_by_var: Dict[str, str] = dict()
+        # id(term) -> (term, free vars in term). We keep a reference to the term so that the id can't be reused.
+        self.free_vars_by_term_id: Dict[int, Tuple[TermT, FrozenSet[str]]] = dict()
+
+    def push_equation(self,
+                      lhs: Sequence[_NonListExpr], lhs_begin: int, lhs_end: int,
+                      rhs: Sequence[_NonListExpr], rhs_begin: int, rhs_end: int):
+        self.expr_expr_equations.append((lhs, lhs_begin, lhs_end, rhs, rhs_begin, rhs_end))
+
+    def push_single_elem_equation(self, lhs: _NonListExpr, rhs: Sequence[_NonListExpr], rhs_begin: int, rhs_end: int):
+        self.expr_expr_equations.append(((lhs,), 0, 1, rhs, rhs_begin, rhs_end))
+
+    def set_var_expr_equation(self, var: str, expr: _NonListExpr):
+        if var in self.var_expr_equations:
+            # This can invalidate the compressed paths, so we start from scratch.
+            self.parent_var_by_var = dict()
+            for var1, expr1 in self.var_expr_equations.items():
+                if isinstance(expr1, str):
+                    self.parent_var_by_var[var1] = expr1
+            self.parent_var_by_var.pop(var, None)
+        self.var_expr_equations[var] = expr
+        if isinstance(expr, str):
+            self.parent_var_by_var[var] = expr
+
+    # Given a var in var_expr_equations, follows the chain of var=var equations and returns the value of the last one
+    # (a term, a var with no value or a var with a value only in context_var_expr_equations).
+    def get_var_value(self, var: str) -> _NonListExpr:
+        root = var
+        while root in self.parent_var_by_var:
+            root = self.parent_var_by_var[root]
+        while var != root:
+            next_var = self.parent_var_by_var[var]
+            self.parent_var_by_var[var] = root
+            var = next_var
+        return self.var_expr_equations.get(root, root)
 
 def unify(initial_expr_expr_equations: List[Tuple[_Expr, _Expr]],
           context_var_expr_equations: Dict[str, _NonListExpr],
           strategy: UnificationStrategy[TermT]) -> Tuple[Dict[str, Union[str, _Expr]],
                                                          Dict[str, List[_NonListExpr]]]:
 
-    context = _UnificationContext(expr_expr_equations=[(ensure_list(lhs), ensure_list(rhs))
-                                                       for lhs, rhs in initial_expr_expr_equations],
+    context = _UnificationContext(expr_expr_equations=[],
                                   context_var_expr_equations=context_var_expr_equations,
                                   strategy=strategy)
+    for lhs, rhs in initial_expr_expr_equations:
+        lhs = ensure_list(lhs)
+        rhs = ensure_list(rhs)
+        context.push_equation(lhs, 0, len(lhs), rhs, 0, len(rhs))
 
     while context.expr_expr_equations:
-        lhs_list, rhs_list = context.expr_expr_equations.pop()
-        _process_list_list_equation(lhs_list, rhs_list, context)
+        lhs_list, lhs_begin, lhs_end, rhs_list, rhs_begin, rhs_end = context.expr_expr_equations.pop()
+        _process_list_list_equation(lhs_list, lhs_begin, lhs_end, rhs_list, rhs_begin, rhs_end, context)
 
     return context.var_expr_equations, context.expanded_var_expr_equations
 
-
-def _process_list_list_equation(lhs_list: List[_NonListExpr], rhs_list: List[_NonListExpr], context: _UnificationContext):
-    if not (len(lhs_list) == 1 and (isinstance(lhs_list[0], str) or (isinstance(lhs_list[0], ListExpansion)
-                                                                     and isinstance(lhs_list[0].expr, str)))):
-        lhs_list, rhs_list = rhs_list, lhs_list
-
-    if len(lhs_list) == 1 and (isinstance(lhs_list[0], str) or (isinstance(lhs_list[0], ListExpansion)
-                                                                and isinstance(lhs_list[0].expr, str))):
-        [lhs] = lhs_list
-        _process_var_expr_equation(lhs, rhs_list, context)
+def _is_var_or_expanded_var(expr: _NonListExpr):
+    return isinstance(expr, str) or (isinstance(expr, ListExpansion) and isinstance(expr.expr, str))
+
+def _can_match_elems(lhs: _NonListExpr, rhs: _NonListExpr):
+    return ((not isinstance(lhs, ListExpansion) and not isinstance(rhs, ListExpansion))
+            or (isinstance(lhs, ListExpansion)
+                and isinstance(rhs, ListExpansion)
+                and isinstance(lhs.expr, str)
+                and isinstance(rhs.expr, str)
+                and lhs.expr == rhs.expr))
+
+def _process_list_list_equation(lhs_list: Sequence[_NonListExpr], lhs_begin: int, lhs_end: int,
+                                rhs_list: Sequence[_NonListExpr], rhs_begin: int, rhs_end: int,
+                                context: _UnificationContext):
+    if not (lhs_end - lhs_begin == 1 and _is_var_or_expanded_var(lhs_list[lhs_begin])):
+        lhs_list, lhs_begin, lhs_end, rhs_list, rhs_begin, rhs_end = rhs_list, rhs_begin, rhs_end, lhs_list, lhs_begin, lhs_end
+
+    if lhs_end - lhs_begin == 1 and _is_var_or_expanded_var(lhs_list[lhs_begin]):
+        _process_var_expr_equation(lhs_list[lhs_begin], rhs_list, rhs_begin, rhs_end, context)
         return
 
-    if len(lhs_list) == 1 and len(rhs_list) == 1 and not isinstance(lhs_list[0], ListExpansion) and not isinstance(rhs_list[0], ListExpansion):
-        [lhs] = lhs_list
-        [rhs] = rhs_list
+    if (lhs_end - lhs_begin == 1 and rhs_end - rhs_begin == 1
+            and not isinstance(lhs_list[lhs_begin], ListExpansion) and not isinstance(rhs_list[rhs_begin], ListExpansion)):
+        lhs = lhs_list[lhs_begin]
+        rhs = rhs_list[rhs_begin]
         assert not isinstance(lhs, str)
         assert not isinstance(rhs, str)
         _process_term_term_equation(lhs, rhs, context)
@@ -73,64 +128,53 @@ def _process_list_list_equation(lhs_list: List[_NonListExpr], rhs_list: List[_No
 
     removed_something = False
 
-    while (lhs_list and rhs_list
-           and ((not isinstance(lhs_list[0], ListExpansion) and not isinstance(rhs_list[0], ListExpansion))
-                or (isinstance(lhs_list[0], ListExpansion)
-                    and isinstance(rhs_list[0], ListExpansion)
-                    and isinstance(lhs_list[0].expr, str)
-                    and isinstance(rhs_list[0].expr, str)
-                    and lhs_list[0].expr == rhs_list[0].expr))):
+    while lhs_begin < lhs_end and rhs_begin < rhs_end and _can_match_elems(lhs_list[lhs_begin], rhs_list[rhs_begin]):
         # We can match the first element.
-        context.expr_expr_equations.append(([lhs_list[0]], [rhs_list[0]]))
-        lhs_list = lhs_list[1:]
-        rhs_list = rhs_list[1:]
+        context.push_equation(lhs_list, lhs_begin, lhs_begin + 1, rhs_list, rhs_begin, rhs_begin + 1)
+        lhs_begin += 1
+        rhs_begin += 1
         removed_something = True
 
-    while (lhs_list and rhs_list
-           and ((not isinstance(lhs_list[-1], ListExpansion) and not isinstance(rhs_list[-1], ListExpansion))
-                or (isinstance(lhs_list[-1], ListExpansion)
-                    and isinstance(rhs_list[-1], ListExpansion)
-                    and isinstance(lhs_list[-1].expr, str)
-                    and isinstance(rhs_list[-1].expr, str)
-                    and lhs_list[-1].expr == rhs_list[-1].expr))):
+    while lhs_begin < lhs_end and rhs_begin < rhs_end and _can_match_elems(lhs_list[lhs_end - 1], rhs_list[rhs_end - 1]):
         # We can match the last element.
-        context.expr_expr_equations.append(([lhs_list[-1]], [rhs_list[-1]]))
-        lhs_list = lhs_list[:-1]
-        rhs_list = rhs_list[:-1]
+        context.push_equation(lhs_list, lhs_end - 1, lhs_end, rhs_list, rhs_end - 1, rhs_end)
+        lhs_end -= 1
+        rhs_end -= 1
         removed_something = True
 
-    if not lhs_list and not rhs_list:
+    if lhs_begin == lhs_end and rhs_begin == rhs_end:
         # We already matched everything.
         return
 
     strategy = context.strategy
-    if not any(isinstance(lhs, ListExpansion)
-               for lhs in lhs_list) \
-            and not any(isinstance(rhs, ListExpansion)
-                        for rhs in rhs_list):
+    if not any(isinstance(lhs_list[i], ListExpansion)
+               for i in range(lhs_begin, lhs_end)) \
+            and not any(isinstance(rhs_list[i], ListExpansion)
+                        for i in range(rhs_begin, rhs_end)):
         # There are no list expansions but one of the two sides still has unmatched elems.
         if context.expanded_non_syntactically_comparable_expr:
             raise UnificationAmbiguousException('Deduced %s = %s, which differ in length and have no list vars\nAfter expanding a non-syntactically-comparable expr:\n%s' % (
-                exprs_to_string(strategy, lhs_list), exprs_to_string(strategy, rhs_list), expr_to_string(strategy, context.expanded_non_syntactically_comparable_expr)))
+                exprs_to_string(strategy, lhs_list[lhs_begin:lhs_end]), exprs_to_string(strategy, rhs_list[rhs_begin:rhs_end]), expr_to_string(strategy, context.expanded_non_syntactically_comparable_expr)))
         else:
             raise UnificationFailedException('Deduced %s = %s, which differ in length and have no list vars' % (
-                exprs_to_string(strategy, lhs_list), exprs_to_string(strategy, rhs_list)))
+                exprs_to_string(strategy, lhs_list[lhs_begin:lhs_end]), exprs_to_string(strategy, rhs_list[rhs_begin:rhs_end])))
 
     if removed_something:
         # We put back the trimmed lists and re-process them from the start (we might have a var-expr or term-term
         # equation now).
-        context.expr_expr_equations.append((lhs_list, rhs_list))
+        context.push_equation(lhs_list, lhs_begin, lhs_end, rhs_list, rhs_begin, rhs_end)
         return
 
-    if not rhs_list:
-        rhs_list, lhs_list = lhs_list, rhs_list
+    if rhs_begin == rhs_end:
+        lhs_list, lhs_begin, lhs_end, rhs_list, rhs_begin, rhs_end = rhs_list, rhs_begin, rhs_end, lhs_list, lhs_begin, lhs_end
 
-    if not lhs_list:
-        for arg in rhs_list:
+    if lhs_begin == lhs_end:
+        for i in range(rhs_begin, rhs_end):
+            arg = rhs_list[i]
             if isinstance(arg, ListExpansion) and isinstance(arg.expr, str):
                 # If we always pick this branch in the loop, it's an equality of the form:
                 # [] = [*l1, ... *ln]
-                context.expr_expr_equations.append(([arg], []))
+                context.push_equation(rhs_list, i, i + 1, (), 0, 0)
             else:
                 if context.expanded_non_syntactically_comparable_expr:
                     raise UnificationAmbiguousException()
@@ -143,12 +187,15 @@ def _process_list_list_equation(lhs_list: List[_NonListExpr], rhs_list: List[_No
     # [*l1, *l2] = [*l3, *l4]
     # ['x', *l1] = [*l2, *l3]
     raise UnificationAmbiguousException('Deduced %s = %s' % (
-        exprs_to_string(strategy, lhs_list), exprs_to_string(strategy, rhs_list)))
+        exprs_to_string(strategy, lhs_list[lhs_begin:lhs_end]), exprs_to_string(strategy, rhs_list[rhs_begin:rhs_end])))
 
 
-def _process_var_expr_equation(lhs: Union[str, ListExpansion], rhs_list: List[_NonListExpr], context: _UnificationContext):
-    if len(rhs_list) == 1:
-        [rhs] = rhs_list
+def _process_var_expr_equation(lhs: Union[str, ListExpansion],
+                               rhs_list: Sequence[_NonListExpr], rhs_begin: int, rhs_end: int,
+                               context: _UnificationContext):
+    rhs_len = rhs_end - rhs_begin
+    if rhs_len == 1:
+        rhs = rhs_list[rhs_begin]
         if isinstance(lhs, str) and isinstance(rhs, str) and lhs == rhs:
             return
 
@@ -158,57 +205,60 @@ def _process_var_expr_equation(lhs: Union[str, ListExpansion], rhs_list: List[_N
             return
 
     if isinstance(lhs, str) and lhs in context.var_expr_equations:
-        context.expr_expr_equations.append(([context.var_expr_equations[lhs]], rhs_list))
+        context.push_single_elem_equation(context.get_var_value(lhs), rhs_list, rhs_begin, rhs_end)
         return
 
     if isinstance(lhs, str) and lhs in context.context_var_expr_equations:
-        context.expr_expr_equations.append(([context.context_var_expr_equations[lhs]], rhs_list))
+        context.push_single_elem_equation(context.context_var_expr_equations[lhs], rhs_list, rhs_begin, rhs_end)
         return
 
     if isinstance(lhs, ListExpansion) and lhs.expr in context.expanded_var_expr_equations:
-        context.expr_expr_equations.append((context.expanded_var_expr_equations[lhs.expr], rhs_list))
+        value = context.expanded_var_expr_equations[lhs.expr]
+        context.push_equation(value, 0, len(value), rhs_list, rhs_begin, rhs_end)
         return
 
     assert not (isinstance(lhs, ListExpansion) and lhs.expr in context.context_var_expr_equations)
 
-    if len(rhs_list) == 1 and isinstance(rhs_list[0], str):
-        if rhs_list[0] in context.var_expr_equations:
-            context.expr_expr_equations.append(([lhs], [context.var_expr_equations[rhs_list[0]]]))
+    if rhs_len == 1 and isinstance(rhs_list[rhs_begin], str):
+        rhs = rhs_list[rhs_begin]
+        if rhs in context.var_expr_equations:
+            context.push_single_elem_equation(lhs, (context.get_var_value(rhs),), 0, 1)
             return
-        if rhs_list[0] in context.context_var_expr_equations:
-            context.expr_expr_equations.append(([lhs], [context.context_var_expr_equations[rhs_list[0]]]))
+        if rhs in context.context_var_expr_equations:
+            context.push_single_elem_equation(lhs, (context.context_var_expr_equations[rhs],), 0, 1)
             return
 
-    if len(rhs_list) == 1 and isinstance(rhs_list[0], ListExpansion) and isinstance(rhs_list[0].expr, str):
-        if rhs_list[0].expr in context.expanded_var_expr_equations:
-            context.expr_expr_equations.append(([lhs], context.expanded_var_expr_equations[rhs_list[0].expr]))
+    if rhs_len == 1 and isinstance(rhs_list[rhs_begin], ListExpansion) and isinstance(rhs_list[rhs_begin].expr, str):
+        rhs_var = rhs_list[rhs_begin].expr
+        if rhs_var in context.expanded_var_expr_equations:
+            value = context.expanded_var_expr_equations[rhs_var]
+            context.push_equation((lhs,), 0, 1, value, 0, len(value))
             return
-        assert rhs_list[0].expr not in context.context_var_expr_equations
+        assert rhs_var not in context.context_var_expr_equations
 
-    if len(rhs_list) != 1 and not isinstance(lhs, ListExpansion) and not any(isinstance(expr, ListExpansion)
-                                                                             for expr in rhs_list):
+    if rhs_len != 1 and not isinstance(lhs, ListExpansion) and not any(isinstance(rhs_list[i], ListExpansion)
+                                                                       for i in range(rhs_begin, rhs_end)):
         # Different number of args and no list expansion to consider.
         strategy = context.strategy
         if context.expanded_non_syntactically_comparable_expr:
             raise UnificationAmbiguousException('Found expr lists of different lengths with no list exprs: %s vs %s\nAfter expanding a non-syntactically-comparable expr:\n%s' % (
-                exprs_to_string(strategy, [lhs]), exprs_to_string(strategy, rhs_list), expr_to_string(strategy, context.expanded_non_syntactically_comparable_expr)))
+                exprs_to_string(strategy, [lhs]), exprs_to_string(strategy, rhs_list[rhs_begin:rhs_end]), expr_to_string(strategy, context.expanded_non_syntactically_comparable_expr)))
         else:
             raise UnificationFailedException('Found expr lists of different lengths with no list exprs: %s vs %s' % (
-                exprs_to_string(strategy, [lhs]), exprs_to_string(strategy, rhs_list)))
+                exprs_to_string(strategy, [lhs]), exprs_to_string(strategy, rhs_list[rhs_begin:rhs_end])))
 
     if isinstance(lhs, str):
-        for rhs in rhs_list:
-            _occurence_check(lhs, rhs, context)
-        [rhs] = rhs_list
-        context.var_expr_equations[lhs] = rhs
+        for i in range(rhs_begin, rhs_end):
+            _occurence_check(lhs, rhs_list[i], context)
+        context.set_var_expr_equation(lhs, rhs_list[rhs_begin])
     else:
         assert isinstance(lhs, ListExpansion)
-        for rhs in rhs_list:
-            _occurence_check(lhs.expr, rhs, context)
-        if len(rhs_list) == 1 and isinstance(rhs_list[0], ListExpansion):
-            context.var_expr_equations[lhs.expr] = rhs_list[0].expr
+        for i in range(rhs_begin, rhs_end):
+            _occurence_check(lhs.expr, rhs_list[i], context)
+        if rhs_len == 1 and isinstance(rhs_list[rhs_begin], ListExpansion):
+            context.set_var_expr_equation(lhs.expr, rhs_list[rhs_begin].expr)
         else:
-            context.expanded_var_expr_equations[lhs.expr] = rhs_list
+            context.expanded_var_expr_equations[lhs.expr] = list(rhs_list[rhs_begin:rhs_end])
 
 
 def _process_term_term_equation(lhs: TermT, rhs: TermT, context: _UnificationContext):
@@ -233,47 +283,83 @@ def _process_term_term_equation(lhs: TermT, rhs: TermT, context: _UnificationCon
         context.expanded_non_syntactically_comparable_expr = expanding_non_syntactically_comparable_expr
     lhs_args = strategy.get_term_args(lhs)
     rhs_args = strategy.get_term_args(rhs)
-    context.expr_expr_equations.append((lhs_args, rhs_args))
+    context.push_equation(lhs_args, 0, len(lhs_args), rhs_args, 0, len(rhs_args))
+
+def _get_free_vars(expr: _NonListExpr, context: _UnificationContext) -> FrozenSet[str]:
+    if isinstance(expr, str):
+        return frozenset((expr,))
+    while isinstance(expr, ListExpansion):
+        expr = expr.expr
+        if isinstance(expr, str):
+            return frozenset((expr,))
+
+    cache_entry = context.free_vars_by_term_id.get(id(expr))
+    if cache_entry is not None:
+        return cache_entry[1]
+
+    # We use an explicit stack instead of recursion, since terms can be deeply nested.
+    # Each entry is (term, args, whether the args have already been pushed).
+    terms_to_process: List[Tuple[TermT, List[_NonListExpr], bool]] = [(expr, context.strategy.get_term_args(expr), False)]
+    while terms_to_process:
+        term, args, args_pushed = terms_to_process.pop()
+        if id(term) in context.free_vars_by_term_id:
+            continue
+        subterms = []
+        for arg in args:
+            while isinstance(arg, ListExpansion):
+                arg = arg.expr
+            if not isinstance(arg, str) and id(arg) not in context.free_vars_by_term_id:
+                subterms.append(arg)
+        if subterms and not args_pushed:
+            terms_to_process.append((term, args, True))
+            for subterm in subterms:
+                terms_to_process.append((subterm, context.strategy.get_term_args(subterm), False))
+            continue
+        free_vars = set()
+        for arg in args:
+            while isinstance(arg, ListExpansion):
+                arg = arg.expr
+            if isinstance(arg, str):
+                free_vars.add(arg)
+            else:
+                free_vars.update(context.free_vars_by_term_id[id(arg)][1])
+        context.free_vars_by_term_id[id(term)] = (term, frozenset(free_vars))
 
-def _occurence_check(var1: str, expr1: _Expr, context: _UnificationContext):
+    return context.free_vars_by_term_id[id(expr)][1]
+
+def _occurence_check(var: str, expr1: _NonListExpr, context: _UnificationContext):
     strategy = context.strategy
-    if isinstance(expr1, str):
-        var_expr_pairs_to_check = [(var1, expr1, None)]
-    elif isinstance(expr1, ListExpansion):
+    if isinstance(expr1, ListExpansion):
         if not context.expanded_non_syntactically_comparable_expr:
             context.expanded_non_syntactically_comparable_expr = expr1
-        var_expr_pairs_to_check = [(var1, expr1, context.expanded_non_syntactically_comparable_expr)]
-    else:
+    elif not isinstance(expr1, str):
         if not context.expanded_non_syntactically_comparable_expr and not strategy.equality_requires_syntactical_equality(expr1):
             context.expanded_non_syntactically_comparable_expr = expr1
-        var_expr_pairs_to_check = [(var1, expr1, context.expanded_non_syntactically_comparable_expr)]
 
-    while var_expr_pairs_to_check:
-        var, expr, only_expanded_terms_with_syntactical_equality = var_expr_pairs_to_check.pop()
-        if isinstance(expr, str):
-            if var == expr:
-                if context.expanded_non_syntactically_comparable_expr:
-                    raise UnificationAmbiguousException("Ambiguous occurrence check for var %s while checking %s in %s with equations:\n%s\nSince the following non-syntactically-comparable expr has been expanded:\n%s" % (
-                        var,
-                        var1,
-                        expr_to_string(strategy, expr1),
-                        {var: expr_to_string(strategy, expr)
-                         for var, expr in context.var_expr_equations.items()},
-                        expr_to_string(strategy, context.expanded_non_syntactically_comparable_expr)))
-                else:
-                    raise UnificationFailedException("Failed occurrence check for var %s while checking %s in %s with equations:\n%s" % (
-                        var, var1, expr_to_string(strategy, expr1), {var: expr_to_string(strategy, expr)
-                                                                     for var, expr in context.var_expr_equations.items()}))
-            if expr in context.var_expr_equations:
-                var_expr_pairs_to_check.append((var, context.var_expr_equations[expr], only_expanded_terms_with_syntactical_equality))
-            if expr in context.expanded_var_expr_equations:
-                for elem in context.var_expr_equations[expr]:
-                    var_expr_pairs_to_check.append((var, elem, only_expanded_terms_with_syntactical_equality))
-            if expr in context.context_var_expr_equations:
-                var_expr_pairs_to_check.append((var, context.context_var_expr_equations[expr], only_expanded_terms_with_syntactical_equality))
-        elif isinstance(expr, ListExpansion):
-            var_expr_pairs_to_check.append((var, expr.expr, False))
-        else:
-            is_term_with_syntactical_equality = strategy.equality_requires_syntactical_equality(expr)
-            for arg in strategy.get_term_args(expr):
-                var_expr_pairs_to_check.append((var, arg, only_expanded_terms_with_syntactical_equality and is_term_with_syntactical_equality))
+    vars_to_check = list(_get_free_vars(expr1, context))
+    checked_vars = set()
+    while vars_to_check:
+        var1 = vars_to_check.pop()
+        if var1 in checked_vars:
+            continue
+        checked_vars.add(var1)
+        if var1 == var:
+            if context.expanded_non_syntactically_comparable_expr:
+                raise UnificationAmbiguousException("Ambiguous occurrence check for var %s while checking %s in %s with equations:\n%s\nSince the following non-syntactically-comparable expr has been expanded:\n%s" % (
+                    var1,
+                    var,
+                    expr_to_string(strategy, expr1),
+                    {var: expr_to_string(strategy, expr)
+                     for var, expr in context.var_expr_equations.items()},
+                    expr_to_string(strategy, context.expanded_non_syntactically_comparable_expr)))
+            else:
+                raise UnificationFailedException("Failed occurrence check for var %s while checking %s in %s with equations:\n%s" % (
+                    var1, var, expr_to_string(strategy, expr1), {var: expr_to_string(strategy, expr)
+                                                                 for var, expr in context.var_expr_equations.items()}))
+        if var1 in context.var_expr_equations:
+            vars_to_check.extend(_get_free_vars(context.var_expr_equations[var1], context))
+        if var1 in context.expanded_var_expr_equations:
+            for elem in context.expanded_var_expr_equations[var1]:
+                vars_to_check.extend(_get_free_vars(elem, context))
+        if var1 in context.context_var_expr_equations:
+            vars_to_check.extend(_get_free_vars(context.context_var_expr_equations[var1], context))
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 from typing import List, Union, Tuple, Dict
 
 import pytest
@@ -548,5 +549,97 @@ def test_unify_lists_many_to_many_list_vars_ok_if_same(canonicalize):
     ], canonicalize)
     assert equations == {}
 
+def test_unify_var_chain():
+    equations = unify([
+        ('x', 'y'),
+        ('y', 'z'),
+        ('z', Term('f', [])),
+        ('x', Term('f', [])),
+        ('y', 'z'),
+        ('x', 'z'),
+    ], canonicalize=False)
+    assert equations == {
+        'x': 'z',
+        'y': 'z',
+        'z': 'f()',
+    }
+
+def test_unification_context_get_var_value_chain():
+    context = _unification._UnificationContext([], dict(), ExampleUnificationStrategy([]))
+    context.set_var_expr_equation('a', 'b')
+    context.set_var_expr_equation('b', 'c')
+    context.set_var_expr_equation('c', 'd')
+    f = Term('f', [])
+    context.set_var_expr_equation('d', f)
+    # The second time the paths have been compressed.
+    assert context.get_var_value('a') is f
+    assert context.get_var_value('a') is f
+    assert context.get_var_value('b') is f
+    assert context.get_var_value('c') is f
+    assert context.parent_var_by_var == {'a': 'd', 'b': 'd', 'c': 'd'}
+    # The equations themselves are not changed.
+    assert context.var_expr_equations == {'a': 'b', 'b': 'c', 'c': 'd', 'd': f}
+
+def test_unification_context_get_var_value_var_with_no_value():
+    context = _unification._UnificationContext([], dict(), ExampleUnificationStrategy([]))
+    context.set_var_expr_equation('a', 'b')
+    context.set_var_expr_equation('b', 'c')
+    assert context.get_var_value('a') == 'c'
+    assert context.get_var_value('a') == 'c'
+    assert context.get_var_value('b') == 'c'
+
+def test_unification_context_set_var_expr_equation_overwrite():
+    context = _unification._UnificationContext([], dict(), ExampleUnificationStrategy([]))
+    context.set_var_expr_equation('a', 'b')
+    context.set_var_expr_equation('b', 'c')
+    assert context.get_var_value('a') == 'c'
+    assert context.parent_var_by_var == {'a': 'c', 'b': 'c'}
+
+    # Overwriting the value of b must not leave a stale compressed path from a to c.
+    context.set_var_expr_equation('b', 'd')
+    assert context.parent_var_by_var == {'a': 'b', 'b': 'd'}
+    assert context.get_var_value('a') == 'd'
+    assert context.get_var_value('b') == 'd'
+
+    f = Term('f', [])
+    context.set_var_expr_equation('b', f)
+    assert context.parent_var_by_var == {'a': 'b'}
+    assert context.get_var_value('a') is f
+
+def _nested_term(var: str, depth: int):
+    term = var
+    for _ in range(depth):
+        term = Term('f', [term])
+    return term
+
+def test_unify_deeply_nested_term_occurrence_check():
+    term = _nested_term('y', 5000)
+    var_expr_equations, _ = _unification.unify([('x', term)], dict(), ExampleUnificationStrategy([]))
+    assert var_expr_equations == {'x': term}
+
+def test_unify_nested_term_occurrence_check_failure():
+    # Not as deep as above, since the error message contains the term.
+    term = _nested_term('y', 100)
+    with pytest.raises(UnificationFailedException):
+        _unification.unify([('y', term)], dict(), ExampleUnificationStrategy([]))
+
+@pytest.mark.parametrize('num_elems', [10, 100, 1000])
+def test_unify_long_lists_benchmark(num_elems):
+    lhs = ['x%s' % i for i in range(num_elems)] + [ListExpansion('l')] + ['y%s' % i for i in range(num_elems)]
+    rhs = [Term('f%s' % i, []) for i in range(num_elems)] + [ListExpansion('m')] + [Term('g%s' % i, []) for i in range(num_elems)]
+
+    start_time = time.perf_counter()
+    var_expr_equations, expanded_var_expr_equations = _unification.unify([(lhs, rhs)], dict(), ExampleUnificationStrategy([]))
+    elapsed_seconds = time.perf_counter() - start_time
+    print('Unification of two lists with %s elements took %.3fs' % (len(lhs), elapsed_seconds))
+
+    assert {var: expr.name if isinstance(expr, Term) else expr
+            for var, expr in var_expr_equations.items()} == {
+        **{'x%s' % i: 'f%s' % i for i in range(num_elems)},
+        **{'y%s' % i: 'g%s' % i for i in range(num_elems)},
+        'm': 'l',
+    }
+    assert expanded_var_expr_equations == {}
+
 if __name__== '__main__':
     main(__file__)